@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    ./bench.py [options] record <cache_directory> <fixture_directory> [<chain>...]
+    ./bench.py [options] run <fixture_directory> [<chain>...]
+
+Options:
+    -h,--help               Help
+    --pages=<n>             Max no of store pages to record per chain [default: 50]
+    --repeat=<n>            Runs each benchmark <n> times and keeps the fastest [default: 3]
+    --sizes=<sizes>         No of entries in the cache benchmarks [default: 1000,10000]
+    --rows=<n>              No of rows in the output benchmarks [default: 10000]
+    --save=<file>           Saves the results to <file> (json)
+    --baseline=<file>       Compares with the results saved by an earlier run
+    --tolerance=<t>         Max slowdown compared with the baseline [default: 0.2]
+
+Description:
+    Benchmarks the hot paths of the spiders on recorded pages, without
+    Firefox, MapQuest or the net.
+
+    "record" copies the sitemaps, store lists and up to --pages store pages
+    of each chain from a daily cache, e.g. cache/2021-03-04, to
+    <fixture_directory>/<chain>.json, together with the chain's files in
+    the cache directory (kronans_store_pages.json, hjartat_api.json).
+
+    "run" times, for each chain with a fixture:
+        crawl     the whole run of the spider (write_output) on the recorded
+                  pages: page store, daily cache, parsing, geo-location and
+                  output. Firefox is replaced by FixtureDriver and MapQuest
+                  by FixtureGeocoder. The parse, cache and output timers of
+                  the spider's metrics are reported per page.
+        sitemap   filtering the recorded sitemaps for store pages
+    and, on the pages of all chains:
+        cache     writing and reading --sizes pages to the caches
+        output    writing --rows rows in each output format
+
+    Each benchmark reports its throughput (the fastest of --repeat runs)
+    and its peak memory (traced in an extra run). With --baseline, the
+    exit status is 1 if a benchmark is more than --tolerance slower.
+
+    Example:
+        ./bench.py record cache/2021-03-04 bench_fixtures
+        ./bench.py --save=bench.json run bench_fixtures
+        ./bench.py --baseline=bench.json run bench_fixtures
+"""
+import hashlib
+import json
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import requests
+from bs4 import BeautifulSoup
+from loguru import logger
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+
+import skrapa
+from export import open_cache
+from geocoding import MapQuestGeocoder
+from jsonshelve import JSONLogShelve, JSONShelve
+from output import available_formats, read_rows, write_rows
+from pagestore import BodyStore, CompressedPages
+from sitemaps import iter_sitemap
+
+# the files in the cache directory a chain needs besides its pages
+CHAIN_FILES = {
+    "kronans": ["kronans_store_pages.json"],
+    "hjartat": ["hjartat_api.json"],
+}
+
+
+class BenchFailure(Exception):
+    """A benchmark did not do what it times, e.g. a crawl that crashed"""
+
+
+def page_body(value):
+    """The page source of a cache value, or None if it is not a page"""
+    if isinstance(value, dict):
+        value = value.get("body")
+    return value if isinstance(value, str) else None
+
+
+class FixtureElement(object):
+    """An element on a FixtureDriver page"""
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    @property
+    def text(self):
+        return self.tag.get_text()
+
+    def get_attribute(self, name):
+        return self.tag.get(name)
+
+    get_property = get_attribute
+
+    def find_elements_by_tag_name(self, name):
+        return [FixtureElement(tag) for tag in self.tag.find_all(name)]
+
+    def click(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def send_keys(self, *keys):
+        pass
+
+
+class FixtureDriver(object):
+    """Stands in for Firefox, serving the recorded pages. A wait
+    condition on an element that is not on the page fails at once
+    instead of waiting for it."""
+
+    SELECTORS = {
+        By.CSS_SELECTOR: "{}",
+        By.ID: "#{}",
+        By.CLASS_NAME: ".{}",
+        By.TAG_NAME: "{}",
+    }
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.current_url = "about:blank"
+        self.page_source = "<html></html>"
+        self.no_pages = 0
+        self._soup = None
+
+    def get(self, url):
+        self.no_pages += 1
+        self.current_url = url
+        self.page_source = page_body(self.pages.get(url)) or "<html></html>"
+        self._soup = None
+
+    def find_elements(self, by=By.ID, value=None):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.page_source, "lxml")
+        selector = self.SELECTORS[by].format(value)
+        return [FixtureElement(tag) for tag in self._soup.select(selector)]
+
+    def find_element(self, by=By.ID, value=None):
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise TimeoutException(f"'{value}' is not on the recorded page {self.current_url}")
+        return elements[0]
+
+    def find_element_by_css_selector(self, value):
+        return self.find_element(By.CSS_SELECTOR, value)
+
+    def find_element_by_class_name(self, value):
+        return self.find_element(By.CLASS_NAME, value)
+
+    def execute_script(self, script, *args):
+        return None
+
+    def implicitly_wait(self, seconds):
+        pass
+
+    def quit(self):
+        pass
+
+
+class FixtureSession(requests.Session):
+    """Answers the plain http requests of a spider with the recorded
+    pages, and with 404 Not Found for the others"""
+
+    def __init__(self, pages):
+        super().__init__()
+        self.pages = pages
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.url = url
+        body = page_body(self.pages.get(url))
+        response.status_code = 200 if body is not None else 404
+        response._content = (body or "").encode("utf-8")
+        response.headers["Content-Type"] = "text/html; charset=utf-8"
+        return response
+
+
+class FixtureGeocoder(MapQuestGeocoder):
+    """Answers like MapQuest, with a made-up location in Sweden for
+    each address. The postal code is the one in the address, if any."""
+
+    def __init__(self):
+        super().__init__("bench")
+        self.no_locations = 0
+
+    def response(self, location):
+        self.no_locations += 1
+        if isinstance(location, dict):
+            lat, lng = location["latLng"]["lat"], location["latLng"]["lng"]
+            street, postal_code = "Fixturgatan 1", "11122"
+        else:
+            digest = int(hashlib.sha1(location.encode("utf-8")).hexdigest()[:8], 16)
+            lat = 55.5 + (digest % 10000) / 10000 * 10
+            lng = 12.5 + (digest // 10000 % 10000) / 10000 * 8
+            street = location.split(",")[1].strip() if "," in location else location
+            postal_code = "".join(re.findall(r"\b\d{3} ?\d{2}\b", location)[:1]) or "11122"
+        return {
+            "info": {"statuscode": 0},
+            "results": [
+                {
+                    "providedLocation": {"location": location},
+                    "locations": [
+                        {
+                            "street": street,
+                            "postalCode": postal_code.replace(" ", ""),
+                            "latLng": {"lat": lat, "lng": lng},
+                        }
+                    ],
+                }
+            ],
+        }
+
+    def geocode(self, address_string):
+        return self.response(address_string)
+
+    def _batch(self, locations):
+        return {key: self.response(location) for key, location in locations.items()}
+
+
+def record(cache_directory, fixture_directory, chains, max_pages=50):
+    """Copies the pages of the chains in a daily cache to fixtures.
+    Sitemaps, json apis and store lists are always recorded,
+    the store pages up to max_pages."""
+    cache_directory = Path(cache_directory)
+    fixture_directory = Path(fixture_directory)
+    if not fixture_directory.is_dir():
+        fixture_directory.mkdir(parents=True)
+    for chain in chains:
+        spider_class = skrapa.CHAINS[chain]
+        path = Path.joinpath(cache_directory, f"{spider_class.__name__}.jsonl")
+        if not path.is_file():
+            path = path.with_suffix(".json")
+        if not path.is_file():
+            logger.warning(f"{chain}: No cache in {cache_directory}")
+            continue
+        files = {}
+        for name in CHAIN_FILES.get(chain, []):
+            file_path = Path.joinpath(cache_directory.parent, name)
+            if file_path.is_file():
+                files[name] = json.loads(file_path.read_text())
+        api_urls = {url for urls in files.get("hjartat_api.json", {}).values() for url in urls}
+        start_urls = set(
+            [spider_class.START_URLS]
+            if isinstance(spider_class.START_URLS, str)
+            else spider_class.START_URLS
+        )
+        cache = open_cache(path)
+        pages, daily, no_store_pages = {}, {}, 0
+        for key in cache:
+            value = cache[key]
+            body = page_body(value)
+            if body is None:
+                # e.g. Hjärtat's store lists
+                daily[key] = value
+            elif ".xml" in key or key in api_urls or key in start_urls:
+                pages[key] = body
+            elif no_store_pages < max_pages:
+                pages[key] = body
+                no_store_pages += 1
+        fixture = JSONShelve(Path.joinpath(fixture_directory, f"{chain}.json"))
+        fixture.data = {
+            "spider": spider_class.__name__,
+            "recorded_from": str(path),
+            "pages": pages,
+            "daily": daily,
+            "files": files,
+        }
+        fixture.sync()
+        logger.info(f"{chain}: Recorded {len(pages)} pages, {no_store_pages} store pages")
+
+
+def load_fixtures(fixture_directory, chains=None):
+    """chain -> fixture, for the chains with a fixture"""
+    fixtures = {}
+    for path in sorted(Path(fixture_directory).glob("*.json")):
+        if path.stem in skrapa.CHAINS and (not chains or path.stem in chains):
+            fixtures[path.stem] = JSONShelve(path).data
+    return fixtures
+
+
+def measure(function, repeat=3):
+    """Runs function() repeat times and once more with memory tracing.
+    function returns the no of items it handled.
+    Returns the fastest time, the no of items and the peak memory in MB."""
+    seconds = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        no_items = function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(seconds), no_items, peak / 2 ** 20
+
+
+def result(name, unit, seconds, no_items, peak_mb, **details):
+    return dict(
+        name=name,
+        unit=unit,
+        items=no_items,
+        seconds=round(seconds, 6),
+        per_second=round(no_items / seconds, 1) if seconds else 0,
+        peak_mb=round(peak_mb, 2),
+        **details,
+    )
+
+
+def crawl_directory(parent, chain, fixture):
+    """A cache directory and config file for a crawl on the fixture,
+    with the recorded pages in the persistent page store"""
+    spider_name = fixture["spider"]
+    directory = Path(tempfile.mkdtemp(dir=parent))
+    cache_directory = Path.joinpath(directory, "cache")
+    daily_directory = Path.joinpath(cache_directory, "bench")
+    for subdirectory in ("pages", "bodies", "bench"):
+        Path.joinpath(cache_directory, subdirectory).mkdir(parents=True)
+    bodies = BodyStore(Path.joinpath(cache_directory, "bodies"), spider_name)
+    page_store = CompressedPages(
+        JSONLogShelve(Path.joinpath(cache_directory, "pages", f"{spider_name}.jsonl")), bodies
+    )
+    fetched_at = datetime.now().isoformat(timespec="seconds")
+    for url, body in fixture["pages"].items():
+        page_store[url] = {"body": body, "fetched_at": fetched_at, "etag": None, "last_modified": None}
+    page_store.sync()
+    daily = JSONLogShelve(Path.joinpath(daily_directory, f"{spider_name}.jsonl"))
+    for key, value in fixture["daily"].items():
+        daily[key] = value
+    daily.sync()
+    bodies.close()
+    for name, content in fixture["files"].items():
+        Path.joinpath(cache_directory, name).write_text(json.dumps(content))
+    config_path = Path.joinpath(directory, "bench.secrets")
+    config_path.write_text(f"[mapquest]\nkey = bench\n\n[cache_ttl]\n{spider_name} = 24\n")
+    return directory
+
+
+def bench_crawl(chain, fixture, parent, repeat=3):
+    """Times write_output on the recorded pages of a chain. Only the
+    recorded store pages are crawled. Raises BenchFailure if a crawl
+    did not finish or wrote no rows."""
+    spider_class = skrapa.CHAINS[chain]
+    pages = fixture["pages"]
+    runs = []
+
+    def crawl():
+        # the caches are set up again for each run, outside the timing
+        spider = runs.pop()
+        spider.write_output(str(Path.joinpath(spider.bench_directory, "output.csv")), "csv")
+        # write_output logs its exceptions instead of raising them,
+        # and only marks its output as finished if it got to the end
+        output = spider.checkpoint.output()
+        if not (output and output["finished"]):
+            raise BenchFailure(f"The crawl of {chain} failed, see the log")
+        return spider.NO_VISITED_PAGES
+
+    def new_spider():
+        directory = crawl_directory(parent, chain, fixture)
+        spider = spider_class(
+            cache_parent_directory=Path.joinpath(directory, "cache"),
+            config_path=Path.joinpath(directory, "bench.secrets"),
+            geckodriver_log_directory=directory,
+            ignore_errors_when_parsing_info_page=True,
+            rate_limit=1e9,
+            cache_date="bench",
+        )
+        spider.bench_directory = directory
+        spider.driver = FixtureDriver(pages)
+        spider.http_session = FixtureSession(pages)
+        spider.geocoder = FixtureGeocoder()
+        get_info_page_urls = spider.get_info_page_urls
+
+        def recorded_info_page_urls(start_url):
+            for url in get_info_page_urls(start_url):
+                if url in pages or not spider.needs_page(url):
+                    yield url
+
+        spider.get_info_page_urls = recorded_info_page_urls
+        return spider
+
+    spiders = []
+    for _ in range(max(1, repeat) + 1):
+        spiders.append(new_spider())
+    runs.extend(reversed(spiders))
+    seconds, no_pages, peak_mb = measure(crawl, repeat)
+    # the metrics of the first (timed) run
+    metrics = spiders[0].metrics.as_dict()
+    timers = {}
+    for timer in metrics["timers"]:
+        count, total = timers.get(timer["name"], (0, 0.0))
+        timers[timer["name"]] = (count + timer["count"], total + timer["seconds"])
+    output_path = Path.joinpath(spiders[0].bench_directory, "output.csv")
+    no_rows = sum(1 for _ in read_rows(output_path))
+    if not no_rows:
+        raise BenchFailure(f"The crawl of {chain} wrote no rows, see the log")
+    failed_pages = sum(
+        counter["value"]
+        for counter in metrics["counters"]
+        if counter["name"] == "store_pages" and counter["labels"].get("result") == "failed"
+    )
+    if failed_pages:
+        logger.warning(f"{chain}: {failed_pages} of the recorded store pages failed")
+    ms_per_call = {
+        name: round(total / count * 1000, 3)
+        for name, (count, total) in timers.items()
+        if name in ("parse", "cache_read", "cache_write", "geocode")
+    }
+    return result(
+        f"crawl/{chain}",
+        "pages",
+        seconds,
+        no_pages,
+        peak_mb,
+        rows=no_rows,
+        failed_pages=failed_pages,
+        ms_per_call=ms_per_call,
+    ), output_path
+
+
+def bench_sitemaps(chain, fixture, repeat=3):
+    """Times filtering the recorded sitemaps for store pages"""
+    predicate = getattr(skrapa.CHAINS[chain], "is_store_url", None)
+    sitemaps = [body for url, body in fixture["pages"].items() if ".xml" in url]
+    if not sitemaps:
+        return None
+
+    def filter_sitemaps():
+        return sum(1 for sitemap in sitemaps for _ in iter_sitemap(sitemap, predicate))
+
+    return result(f"sitemap/{chain}", "urls", *measure(filter_sitemaps, repeat))
+
+
+def open_caches(directory):
+    """The caches in the benchmark: name -> a function opening the cache"""
+    return {
+        # one json file, written as a whole on sync
+        "json": lambda: JSONShelve(Path.joinpath(directory, "cache.json")),
+        # the daily cache before pages were compressed, see jsonshelve.py
+        "log": lambda: JSONLogShelve(Path.joinpath(directory, "cache.jsonl")),
+        # the daily cache and page store, see pagestore.py
+        "compressed": lambda: CompressedPages(
+            JSONLogShelve(Path.joinpath(directory, "pages.jsonl")),
+            BodyStore(Path.joinpath(directory, "bodies"), "Bench"),
+        ),
+    }
+
+
+def bench_caches(bodies, sizes, parent, repeat=3):
+    """Times writing and reading 'size' pages to each cache. The pages
+    are the recorded store pages, made distinct. The log caches are synced
+    after each page, like the daily cache, the json cache once."""
+    results = []
+    for size in sizes:
+        for name in open_caches(parent):
+            directories = []
+
+            def write():
+                directory = Path(tempfile.mkdtemp(dir=parent))
+                directories.append(directory)
+                cache = open_caches(directory)[name]()
+                for no in range(size):
+                    body = bodies[no % len(bodies)]
+                    cache[f"https://bench/{no}"] = f"{body}<!-- {no} -->"
+                    if name != "json":
+                        cache.sync()
+                cache.sync()
+                return size
+
+            def read():
+                cache = open_caches(directories[0])[name]()
+                for key in cache:
+                    cache[key]
+                return size
+
+            results.append(result(f"cache_write/{name}/{size}", "pages", *measure(write, repeat)))
+            results.append(result(f"cache_read/{name}/{size}", "pages", *measure(read, repeat)))
+            for directory in directories:
+                shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_output(rows, no_rows, parent, repeat=3):
+    """Times writing no_rows rows in each output format"""
+    rows = [rows[no % len(rows)] for no in range(no_rows)]
+    results = []
+    for output_format in available_formats():
+        path = Path.joinpath(Path(parent), f"output.{output_format}")
+
+        def write():
+            write_rows(rows, str(path), output_format)
+            return len(rows)
+
+        results.append(result(f"output/{output_format}", "rows", *measure(write, repeat)))
+    return results
+
+
+def run(fixtures, sizes=(1000, 10000), no_rows=10000, repeat=3):
+    """Runs all benchmarks on the fixtures. Returns the results."""
+    results = []
+    with tempfile.TemporaryDirectory() as parent:
+        rows = []
+        for chain, fixture in fixtures.items():
+            logger.info(f"Benchmarking {chain}")
+            crawl_result, output_path = bench_crawl(chain, fixture, parent, repeat)
+            results.append(crawl_result)
+            rows.extend(read_rows(output_path))
+            sitemap_result = bench_sitemaps(chain, fixture, repeat)
+            if sitemap_result:
+                results.append(sitemap_result)
+        bodies = [
+            body
+            for fixture in fixtures.values()
+            for url, body in fixture["pages"].items()
+            if ".xml" not in url
+        ]
+        if bodies:
+            results.extend(bench_caches(bodies, sizes, parent, repeat))
+        if rows:
+            results.extend(bench_output(rows, no_rows, parent, repeat))
+    return results
+
+
+def regressions(results, baseline, tolerance=0.2):
+    """The benchmarks that are more than 'tolerance' slower than in
+    the baseline, as (name, baseline per second, per second)"""
+    before = {r["name"]: r["per_second"] for r in baseline}
+    return [
+        (r["name"], before[r["name"]], r["per_second"])
+        for r in results
+        if before.get(r["name"]) and r["per_second"] < before[r["name"]] * (1 - tolerance)
+    ]
+
+
+def report_lines(results):
+    lines = [f"{'benchmark':32} {'items':>7} {'seconds':>9} {'per sec':>10} {'peak MB':>8}"]
+    for r in results:
+        lines.append(
+            f"{r['name']:32} {r['items']:>7} {r['seconds']:>9.3f} "
+            f"{r['per_second']:>10.1f} {r['peak_mb']:>8.1f}"
+        )
+        if r.get("ms_per_call"):
+            calls = ", ".join(f"{name} {ms} ms" for name, ms in sorted(r["ms_per_call"].items()))
+            lines.append(f"    per call: {calls}")
+    return lines
+
+
+def test_fixture_driver():
+    driver = FixtureDriver({"https://a/": "<html><body><p id='x' class='y'>Hej</p></body></html>"})
+    driver.get("https://a/")
+    assert driver.find_element(By.ID, "x").text == "Hej"
+    assert driver.find_element_by_class_name("y").get_attribute("id") == "x"
+    driver.get("https://b/")
+    try:
+        driver.find_element_by_css_selector("p")
+    except TimeoutException:
+        pass
+    else:
+        assert False, "should fail at once"
+    response = FixtureSession({"https://a/s.xml": "<urlset/>"}).get("https://a/s.xml")
+    assert response.ok and response.text == "<urlset/>"
+    assert FixtureSession({}).get("https://a/").status_code == 404
+
+
+def test_bench(tmp_path):
+    page = (
+        "<html><head><title>Apoteket {name} - Apoteket</title></head><body>"
+        "<div id='main'><div><div><p>{street}, 412 51 Göteborg</p></div></div>"
+        "<ul class='underlined-list'><li><span class='date'>Måndag</span>"
+        "<span class='time'>09:00-18:00</span></li></ul></div>{map}</body></html>"
+    )
+    map_image = "<div id='pharmaciesmap-root'><div><a><img src='https://m/?c=57.6954,11.9812'></a></div></div>"
+    pages = {
+        "https://www.apoteket.se/sitemap.xml": "<urlset>"
+        + "".join(
+            f"<url><loc>https://www.apoteket.se/apotek/{name}/</loc></url>"
+            for name in ("ekorren-goteborg", "kronhuset-goteborg", "not-recorded")
+        )
+        + "</urlset>",
+        "https://www.apoteket.se/apotek/ekorren-goteborg/": page.format(
+            name="Ekorren", street="Ekorrens väg 1", map=map_image
+        ),
+        "https://www.apoteket.se/apotek/kronhuset-goteborg/": page.format(
+            name="Kronhuset", street="Postgatan 2", map=""
+        ),
+    }
+    tmp_path.joinpath("cache", "2021-03-04").mkdir(parents=True)
+    cache = JSONLogShelve(tmp_path.joinpath("cache", "2021-03-04", "ApoteketSpider.jsonl"))
+    for url, body in pages.items():
+        cache[url] = body
+    cache.sync()
+    record(tmp_path.joinpath("cache", "2021-03-04"), tmp_path.joinpath("fixtures"), ["apoteket", "lloyds"])
+    fixtures = load_fixtures(tmp_path.joinpath("fixtures"))
+    assert list(fixtures) == ["apoteket"]
+    assert fixtures["apoteket"]["pages"] == pages
+    results = {r["name"]: r for r in run(fixtures, sizes=[20], no_rows=50, repeat=1)}
+    crawl = results["crawl/apoteket"]
+    # the sitemap and the two recorded store pages, with one weekday each
+    assert crawl["items"] == 3 and crawl["rows"] == 2 and crawl["failed_pages"] == 0
+    assert crawl["ms_per_call"]["geocode"] > 0
+    assert results["sitemap/apoteket"]["items"] == 3
+    assert results["cache_write/compressed/20"]["items"] == 20
+    assert results["output/csv"]["items"] == 50
+    assert all(r["per_second"] > 0 for r in results.values())
+    slower = dict(results["output/csv"], per_second=results["output/csv"]["per_second"] / 2)
+    assert regressions([slower], [results["output/csv"]]) == [
+        ("output/csv", results["output/csv"]["per_second"], slower["per_second"])
+    ]
+    assert regressions([results["output/csv"]], [results["output/csv"]]) == []
+    # a crawl that finds no store pages is not reported as a fast one
+    try:
+        bench_crawl("apoteket", dict(fixtures["apoteket"], pages={}), str(tmp_path), repeat=1)
+    except BenchFailure:
+        pass
+    else:
+        assert False, "no rows"
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    # the spiders log each page at INFO
+    logger.remove()
+    logger.add(sys.stderr, level="INFO" if arguments["record"] else "WARNING")
+    chains = arguments["<chain>"] or list(skrapa.CHAINS)
+    unknown = [chain for chain in chains if chain not in skrapa.CHAINS]
+    if unknown:
+        logger.critical(f"Unknown chain {', '.join(unknown)}, use {', '.join(skrapa.CHAINS)}")
+        sys.exit(1)
+    if arguments["record"]:
+        record(
+            arguments["<cache_directory>"],
+            arguments["<fixture_directory>"],
+            chains,
+            int(arguments["--pages"]),
+        )
+        sys.exit(0)
+    fixtures = load_fixtures(arguments["<fixture_directory>"], chains)
+    if not fixtures:
+        logger.critical(f"No fixtures in {arguments['<fixture_directory>']}, see ./bench.py record")
+        sys.exit(1)
+    try:
+        results = run(
+            fixtures,
+            sizes=[int(size) for size in arguments["--sizes"].split(",")],
+            no_rows=int(arguments["--rows"]),
+            repeat=int(arguments["--repeat"]),
+        )
+    except BenchFailure as failure:
+        logger.critical(str(failure))
+        sys.exit(1)
+    for line in report_lines(results):
+        print(line)
+    if arguments["--save"]:
+        Path(arguments["--save"]).write_text(json.dumps(results, indent=2))
+    if arguments["--baseline"]:
+        baseline = json.loads(Path(arguments["--baseline"]).read_text())
+        slower = regressions(results, baseline, float(arguments["--tolerance"]))
+        for name, before, now in slower:
+            print(f"REGRESSION {name}: {now:.1f}/s, was {before:.1f}/s")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,111 @@
+"""Firefox settings for the spiders. The "fast" profile only loads what we
+need to read the DOM: no images or web fonts, no third-party trackers, and
+driver.get returns as soon as the DOM is ready ("eager") instead of
+waiting for every resource."""
+from selenium import webdriver
+
+# third-party hosts the store pages load scripts, pixels and fonts from.
+# Requests to these hosts (and their subdomains) are sent to a dead proxy.
+BLOCKED_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googleadservices.com",
+    "doubleclick.net",
+    "googlesyndication.com",
+    "facebook.net",
+    "facebook.com",
+    "hotjar.com",
+    "bing.com",
+    "clarity.ms",
+    "linkedin.com",
+    "licdn.com",
+    "adform.net",
+    "adnxs.com",
+    "criteo.com",
+    "criteo.net",
+    "snapchat.com",
+    "tiktok.com",
+    "pinterest.com",
+    "fonts.googleapis.com",
+    "fonts.gstatic.com",
+    "use.typekit.net",
+    "trustpilot.com",
+    "vimeo.com",
+    "youtube.com",
+)
+
+# name -> settings, selected with MySpider.BROWSER_PROFILE or the
+# [browser_profile] section of the config file
+PROFILES = {
+    # Firefox as it comes, ie everything on the page is loaded
+    "default": {
+        "images": True,
+        "fonts": True,
+        "blocked_hosts": (),
+        "page_load_strategy": "normal",
+    },
+    "fast": {
+        # the <img> elements and their src are still in the DOM,
+        # eg the map on Apoteket's store pages
+        "images": False,
+        "fonts": False,
+        "blocked_hosts": BLOCKED_HOSTS,
+        # driver.get returns at DOMContentLoaded,
+        # the spiders' wait conditions take it from there
+        "page_load_strategy": "eager",
+    },
+}
+
+
+def blocking_pac_script(blocked_hosts):
+    """A proxy auto-config script that sends the requests to
+    blocked_hosts to a closed port, ie they fail at once"""
+    hosts = ", ".join(f'"{host}"' for host in blocked_hosts)
+    return (
+        "function FindProxyForURL(url, host) {"
+        f" var blocked = [{hosts}];"
+        " for (var i = 0; i < blocked.length; i++) {"
+        "  if (host === blocked[i] || dnsDomainIs(host, '.' + blocked[i])) {"
+        "   return 'PROXY 127.0.0.1:9'; } }"
+        " return 'DIRECT'; }"
+    )
+
+
+def firefox_options(profile="default", headless=False):
+    """Returns the FirefoxOptions of a profile in PROFILES"""
+    settings = PROFILES[profile]
+    options = webdriver.FirefoxOptions()
+    # allow prompting for geo-location
+    options.set_preference("geo.prompt.testing", True)
+    # automatically deny requests for geo-location
+    options.set_preference("geo.prompt.testing.allow", False)
+    if not settings["images"]:
+        # 2 = block all images
+        options.set_preference("permissions.default.image", 2)
+    if not settings["fonts"]:
+        options.set_preference("browser.display.use_document_fonts", 0)
+        options.set_preference("gfx.downloadable_fonts.enabled", False)
+    if settings["blocked_hosts"]:
+        # 2 = proxy auto-config
+        options.set_preference("network.proxy.type", 2)
+        options.set_preference(
+            "network.proxy.autoconfig_url",
+            "data:text/javascript," + blocking_pac_script(settings["blocked_hosts"]),
+        )
+        options.set_preference("privacy.trackingprotection.enabled", True)
+    options.page_load_strategy = settings["page_load_strategy"]
+    options.headless = headless  # run headless or not?
+    return options
+
+
+def test_firefox_options():
+    fast = firefox_options("fast", headless=True)
+    assert fast.preferences["permissions.default.image"] == 2
+    assert fast.preferences["network.proxy.type"] == 2
+    assert '"doubleclick.net"' in fast.preferences["network.proxy.autoconfig_url"]
+    assert fast.page_load_strategy == "eager"
+    default = firefox_options("default")
+    assert "permissions.default.image" not in default.preferences
+    assert "network.proxy.type" not in default.preferences
+    assert default.preferences["geo.prompt.testing.allow"] is False
+    assert default.page_load_strategy == "normal"
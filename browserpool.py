@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    ./browserpool.py [options] start <pool_directory>
+    ./browserpool.py [options] stop <pool_directory>
+    ./browserpool.py [options] status <pool_directory>
+
+Options:
+    -h,--help               Help
+    --size=<n>              No of Firefox instances in the pool [default: 2]
+    --profile=<profile>     The browser profile of the instances, see browser.py [default: fast]
+    -s,--headless           Run Firefox headless
+
+Description:
+    A pool of long-lived Firefox instances that the spiders attach to,
+    instead of starting a new Firefox for each chain and run.
+    Each instance (slot) is a geckodriver process listening on a local
+    port and an open Firefox session. The state of the slots is kept in
+    <pool_directory>, e.g. cache/browsers, and a spider holds a slot by
+    locking its lock file. The lock is released if the spider dies.
+
+    "start" starts all slots ahead of the first run. Slots are otherwise
+    started the first time a spider needs them. A slot is restarted when
+    it does not answer, when it has loaded MAX_PAGES pages, or when its
+    processes use more than MAX_MEMORY_MB. "stop" stops all slots.
+"""
+import fcntl
+import json
+import os
+import signal
+import socket
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+from selenium import webdriver
+
+from browser import firefox_options
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree_memory_mb(ps_output, pid):
+    """The resident memory of a process and all its children in MB,
+    from the output of "ps -A -o pid=,ppid=,rss=" (rss in kB)"""
+    children, rss = {}, {}
+    for line in ps_output.splitlines():
+        fields = line.split()
+        if len(fields) != 3 or not all(field.isdigit() for field in fields):
+            continue
+        child, parent, kb = (int(field) for field in fields)
+        children.setdefault(parent, []).append(child)
+        rss[child] = kb
+    total, todo = 0, [pid]
+    while todo:
+        process = todo.pop()
+        total += rss.get(process, 0)
+        todo.extend(children.get(process, []))
+    return total / 1024
+
+
+class PooledDriver(webdriver.Remote):
+    """A Firefox session in the pool. Attaches to the already open session
+    instead of creating one, and gives the slot back on quit().
+    Counts the pages it loads."""
+
+    def __init__(self, pool, slot_no, state, lock_file):
+        self.pool = pool
+        self.slot_no = slot_no
+        self.state = state
+        self.lock_file = lock_file
+        super().__init__(
+            command_executor=f"http://127.0.0.1:{state['port']}",
+            options=firefox_options(state["profile"], state["headless"]),
+        )
+
+    def start_session(self, *args, **kwargs):
+        # attach to the session of the slot
+        self.session_id = self.state["session_id"]
+        self.caps = {}
+
+    def get(self, url):
+        self.state["pages"] += 1
+        super().get(url)
+
+    def quit(self):
+        """Gives the slot back to the pool"""
+        self.pool.release(self)
+
+
+class BrowserPool(object):
+    """Hands out the Firefox instances of the pool, one spider or
+    fetch worker per instance.
+
+        >>> pool = BrowserPool("cache/browsers", size=2)
+        >>> driver = pool.acquire("fast", headless=True)  # None if all are in use
+        >>> driver.get(url)
+        >>> driver.quit()  # the instance keeps running
+    """
+
+    MAX_PAGES = 1000  # pages loaded before the instance is restarted
+    MAX_MEMORY_MB = 2048  # of geckodriver, Firefox and its content processes
+    START_TIMEOUT = 30  # sec to wait for geckodriver to listen
+
+    def __init__(
+        self,
+        directory,
+        size=2,
+        max_pages=MAX_PAGES,
+        max_memory_mb=MAX_MEMORY_MB,
+        geckodriver="geckodriver",
+    ):
+        self.directory = Path(directory)
+        if not self.directory.is_dir():
+            self.directory.mkdir(parents=True)
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.geckodriver = geckodriver
+
+    def _path(self, slot_no, suffix):
+        return Path.joinpath(self.directory, f"slot{slot_no}.{suffix}")
+
+    def read_state(self, slot_no):
+        """The saved state of a slot, or None if it has not been started"""
+        try:
+            return json.loads(self._path(slot_no, "json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_state(self, slot_no, state):
+        path = self._path(slot_no, "json")
+        if state is None:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        else:
+            path.write_text(json.dumps(state))
+
+    def _lock(self, slot_no, blocking=False):
+        """Locks the slot. Returns the open lock file, or None
+        if the slot is held by another spider."""
+        lock_file = open(self._path(slot_no, "lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def acquire(self, profile="fast", headless=False):
+        """Returns a driver attached to a free instance, which is
+        started or restarted if needed. Returns None if all slots are
+        in use, or no instance could be started."""
+        for slot_no in range(self.size):
+            lock_file = self._lock(slot_no)
+            if lock_file is None:
+                continue
+            try:
+                return self._attach(slot_no, profile, headless, lock_file)
+            except Exception as pool_error:
+                logger.error(f"Browser pool: Could not use slot {slot_no}: {pool_error}")
+                lock_file.close()
+        return None
+
+    def _attach(self, slot_no, profile, headless, lock_file):
+        state = self.read_state(slot_no)
+        if state and (state["profile"], state["headless"]) == (profile, headless):
+            driver = PooledDriver(self, slot_no, state, lock_file)
+            if self.healthy(driver):
+                logger.info(f"Browser pool: Attached to slot {slot_no}")
+                return driver
+            logger.warning(f"Browser pool: Slot {slot_no} does not answer, restarting it")
+        if state:
+            self.stop_slot(slot_no, state)
+        state = self.start_slot(slot_no, profile, headless)
+        return PooledDriver(self, slot_no, state, lock_file)
+
+    def healthy(self, driver):
+        """Returns True if the instance answers"""
+        if not self.is_running(driver.state["pid"]):
+            return False
+        try:
+            driver.get("about:blank")
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def memory_mb(self, state):
+        """The memory used by geckodriver, Firefox and its content processes"""
+        try:
+            ps_output = subprocess.run(
+                ["ps", "-A", "-o", "pid=,ppid=,rss="],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return 0
+        return process_tree_memory_mb(ps_output, state["pid"])
+
+    def needs_restart(self, state):
+        """Returns the reason to restart an instance, or None"""
+        if state["pages"] >= self.max_pages:
+            return f"{state['pages']} pages loaded"
+        memory = self.memory_mb(state)
+        if memory > self.max_memory_mb:
+            return f"uses {memory:.0f} MB"
+        return None
+
+    def start_slot(self, slot_no, profile, headless):
+        """Starts geckodriver and opens a Firefox session that is
+        left open when this process exits"""
+        port = free_port()
+        log_file = open(self._path(slot_no, "log"), "a")
+        geckodriver = subprocess.Popen(
+            [self.geckodriver, "--port", str(port)],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            # its own process group, ie it outlives the spider and
+            # Firefox can be stopped together with geckodriver
+            start_new_session=True,
+        )
+        log_file.close()
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or geckodriver.poll() is not None:
+                    self._kill(geckodriver.pid)
+                    raise RuntimeError(f"geckodriver did not start on port {port}")
+                time.sleep(0.2)
+        driver = webdriver.Remote(
+            command_executor=f"http://127.0.0.1:{port}",
+            options=firefox_options(profile, headless),
+        )
+        state = {
+            "port": port,
+            "pid": geckodriver.pid,
+            "session_id": driver.session_id,
+            "profile": profile,
+            "headless": headless,
+            "pages": 0,
+            "started_at": datetime.now().isoformat(),
+        }
+        self.write_state(slot_no, state)
+        logger.info(f"Browser pool: Started slot {slot_no} on port {port}")
+        return state
+
+    def stop_slot(self, slot_no, state):
+        """Stops geckodriver and Firefox"""
+        self._kill(state["pid"])
+        self.write_state(slot_no, None)
+        logger.info(f"Browser pool: Stopped slot {slot_no}")
+
+    def _kill(self, pid):
+        """Stops geckodriver's process group, ie Firefox as well"""
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def release(self, driver):
+        """Saves the page count of the instance and unlocks its slot.
+        The instance is restarted the next time it is acquired if it
+        has loaded too many pages or uses too much memory."""
+        try:
+            reason = self.needs_restart(driver.state)
+            if reason:
+                logger.info(f"Browser pool: Recycling slot {driver.slot_no}, {reason}")
+                self._kill(driver.state["pid"])
+                self.write_state(driver.slot_no, None)
+            else:
+                self.write_state(driver.slot_no, driver.state)
+        finally:
+            driver.lock_file.close()
+
+    def start(self, profile="fast", headless=False):
+        """Starts all slots that are not running"""
+        drivers = [self.acquire(profile, headless) for _ in range(self.size)]
+        for driver in drivers:
+            if driver:
+                driver.quit()
+
+    def stop(self):
+        """Stops all slots, waiting for the spiders using them"""
+        for slot_no in range(self.size):
+            lock_file = self._lock(slot_no, blocking=True)
+            state = self.read_state(slot_no)
+            if state:
+                self._kill(state["pid"])
+                self.write_state(slot_no, None)
+            lock_file.close()
+
+    def status(self):
+        """Returns the state of each slot, with "in_use" and "memory_mb" """
+        slots = []
+        for slot_no in range(self.size):
+            state = self.read_state(slot_no) or {}
+            lock_file = self._lock(slot_no)
+            if lock_file:
+                lock_file.close()
+            running = bool(state) and self.is_running(state["pid"])
+            state.update(
+                slot=slot_no,
+                in_use=lock_file is None,
+                running=running,
+                memory_mb=round(self.memory_mb(state)) if running else 0,
+            )
+            slots.append(state)
+        return slots
+
+
+def test_process_tree_memory_mb():
+    ps_output = """
+      1     0   4000
+    100     1  10240
+    101   100 512000
+    102   101 204800
+    103   101 102400
+    200     1  99999
+    """
+    # geckodriver, Firefox and two content processes
+    assert process_tree_memory_mb(ps_output, 100) == 810
+    assert process_tree_memory_mb(ps_output, 102) == 200
+    assert process_tree_memory_mb(ps_output, 999) == 0
+
+
+def test_browser_pool_slots(tmp_path):
+    pool = BrowserPool(tmp_path.joinpath("browsers"), size=2, max_pages=10)
+    state = {"port": 1, "pid": os.getpid(), "session_id": "s", "pages": 3}
+    pool.write_state(0, state)
+    assert pool.read_state(0) == state
+    assert pool.read_state(1) is None
+    lock_file = pool._lock(0)
+    assert pool._lock(0) is None  # held by someone else
+    lock_file.close()
+    assert pool._lock(0) is not None
+    state["pages"] = 10
+    assert pool.needs_restart(state) == "10 pages loaded"
+    pool.write_state(0, None)
+    assert pool.read_state(0) is None
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    pool = BrowserPool(arguments["<pool_directory>"], size=int(arguments["--size"]))
+    if arguments["start"]:
+        pool.start(arguments["--profile"], arguments["--headless"])
+    elif arguments["stop"]:
+        pool.stop()
+    for slot in pool.status():
+        print(json.dumps(slot))
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 """
 Usage:
-    ./check_scraping [options] <config_file_path> <firefox_profile_path>
+    ./check_scraping [options] <config_file_path>
 
 Options:
-    -h,--help      Help
+    -h,--help               Help
+    --browser-pool=<dir>    Tests a Firefox instance in the browser pool in <dir>
 
 Description:
     Runs a test to see if all the required programs are installed and working.
@@ -31,10 +32,11 @@ if __name__ == "__main__":
         cache_parent_directory=temp_dir,
         config_path=arguments["<config_file_path>"],
         geckodriver_log_directory=temp_dir,
-        my_firefox_profile=arguments["<firefox_profile_path>"],
         quit_when_finished=True,
         headless=True,
+        browser_pool=arguments["--browser-pool"],
     )
     spider.make_soup("https://www.google.com/")
-    spider.driver.quit()
+    # gives a pooled instance back to the pool
+    spider.quit_driver()
     spider.write_cache()
@@ -0,0 +1,144 @@
+"""The progress of a chain's crawl, saved as it goes, so that a run that
+stopped halfway (Firefox crashed, the box rebooted, an exception) can be
+continued with --resume instead of starting over.
+
+The checkpoint of a chain is kept next to its daily cache, e.g.
+"cache/2021-03-04/ApoteketSpider.checkpoint.jsonl", as an append-only log
+(see jsonshelve.JSONLogShelve) synced after each record:
+
+    "urls <start url>"      the store pages found from a start url
+    "page <url>"            the page has been parsed into this many stores
+    "store <no> <url>"      a store of the page, geo-located (Store.as_dict)
+    "output"                the output file, and whether it was finished
+
+A page is completed when it has been parsed and all its stores have been
+geo-located. A resumed run reads the stores of the completed pages from
+the checkpoint, without fetching, parsing or geo-locating them again.
+"""
+from pathlib import Path
+
+from jsonshelve import JSONLogShelve
+from stores import Store
+
+
+class Checkpoint(object):
+    """The checkpoint of one chain and day.
+
+        >>> checkpoint = Checkpoint("cache/2021-03-04/ApoteketSpider.checkpoint.jsonl")
+        >>> checkpoint.save_urls(start_url, urls)
+        >>> checkpoint.save_page(url, no_stores=1)
+        >>> checkpoint.save_store(store)
+        >>> checkpoint.completed(url)
+        True
+        >>> checkpoint.stores(url)
+        [<stores.Store object>]
+
+    Without resume, the checkpoint of a previous run is removed. Without
+    a path, e.g. when replaying a day, the checkpoint is only kept in
+    memory and the files of the day are left alone.
+    """
+
+    def __init__(self, path, resume=False):
+        if path is None:
+            self.log = {}
+        else:
+            path = Path(path)
+            if not resume:
+                for old_path in (path, path.with_name(path.name + ".idx")):
+                    try:
+                        old_path.unlink()
+                    except FileNotFoundError:
+                        pass
+            self.log = JSONLogShelve(path)
+        self.no_stores = {}  # url -> no of stores the page was parsed into
+        self.no_saved_stores = {}  # url -> no of geo-located stores saved
+        for key in self.log:
+            kind, _, rest = key.partition(" ")
+            if kind == "page":
+                self.no_stores[rest] = self.log[key]
+            elif kind == "store":
+                no, _, url = rest.partition(" ")
+                self.no_saved_stores[url] = max(self.no_saved_stores.get(url, 0), int(no) + 1)
+
+    def _save(self, key, value):
+        self.log[key] = value
+        if isinstance(self.log, JSONLogShelve):
+            self.log.sync()
+
+    def urls(self, start_url):
+        """The store pages found from start_url, or None"""
+        return self.log.get(f"urls {start_url}")
+
+    def save_urls(self, start_url, urls):
+        self._save(f"urls {start_url}", list(urls))
+
+    def save_page(self, url, no_stores):
+        self.no_stores[url] = no_stores
+        self._save(f"page {url}", no_stores)
+
+    def restart_page(self, url):
+        """Forgets the stores saved for a page that is parsed again"""
+        self.no_saved_stores.pop(url, None)
+
+    def save_store(self, store):
+        no = self.no_saved_stores.get(store.url, 0)
+        self.no_saved_stores[store.url] = no + 1
+        self._save(f"store {no} {store.url}", store.as_dict())
+
+    def completed(self, url):
+        """True if the page has been parsed and all its stores geo-located"""
+        return url in self.no_stores and self.no_saved_stores.get(url, 0) >= self.no_stores[url]
+
+    def stores(self, url):
+        """The geo-located stores of a completed page"""
+        return [Store.from_dict(self.log[f"store {no} {url}"]) for no in range(self.no_stores[url])]
+
+    def output(self):
+        """The output file as {"path": ..., "finished": ...}, or None"""
+        return self.log.get("output")
+
+    def save_output(self, path, finished=False):
+        self._save("output", {"path": str(path), "finished": finished})
+
+    def close(self):
+        if isinstance(self.log, JSONLogShelve):
+            self.log.close()
+
+
+def test_checkpoint(tmp_path):
+    path = tmp_path.joinpath("ApoteketSpider.checkpoint.jsonl")
+    checkpoint = Checkpoint(path)
+    urls = ["https://www.apoteket.se/apotek/a/", "https://www.apoteket.se/apotek/b c/"]
+    checkpoint.save_urls("https://www.apoteket.se/sitemap.xml", urls)
+    checkpoint.save_output("output/apoteket.xlsx")
+    for url in urls:
+        store = Store("ApoteketSpider", url, "Apoteket", city="Göteborg")
+        store.add_hours(1, "Måndag", "09:00-18:00")
+        store.mq_lat, store.geo_source = 57.69, "net"
+        checkpoint.save_page(url, 1)
+        if url == urls[0]:
+            checkpoint.save_store(store)
+    checkpoint.close()
+    # the run stopped before the second store was geo-located
+    checkpoint = Checkpoint(path, resume=True)
+    assert checkpoint.urls("https://www.apoteket.se/sitemap.xml") == urls
+    assert checkpoint.completed(urls[0]) and not checkpoint.completed(urls[1])
+    [store] = checkpoint.stores(urls[0])
+    assert (store.url, store.mq_lat, store.geo_source) == (urls[0], 57.69, "net")
+    assert store.opening_hours[0].hours == "09:00-18:00"
+    assert checkpoint.output() == {"path": "output/apoteket.xlsx", "finished": False}
+    checkpoint.close()
+    assert Checkpoint(path).urls("https://www.apoteket.se/sitemap.xml") is None
+
+
+def test_checkpoint_in_memory(tmp_path):
+    path = tmp_path.joinpath("ApoteketSpider.checkpoint.jsonl")
+    checkpoint = Checkpoint(path)
+    checkpoint.save_output("output/apoteket.xlsx", finished=True)
+    checkpoint.close()
+    replay = Checkpoint(None)
+    replay.save_page("https://www.apoteket.se/apotek/a/", 0)
+    assert replay.completed("https://www.apoteket.se/apotek/a/") and replay.output() is None
+    replay.close()
+    # the checkpoint of the replayed day is untouched
+    assert Checkpoint(path, resume=True).output()["finished"]
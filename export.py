@@ -0,0 +1,189 @@
+"""Exports the pages in a cache as text files, one per store page,
+named after the store. Used by --export-cache and by
+misc/extract_html_pages_from_cache.py.
+
+The pages are parsed in a pool of processes and each text file is
+written as soon as its page is parsed. A page that has not changed
+since the last export is not parsed again: its previous text file is
+linked into the new export directory."""
+import hashlib
+import os
+import shelve
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+from loguru import logger
+
+from jsonshelve import JSONLogShelve, JSONShelve
+from pagestore import BodyStore, CompressedPages
+
+
+def store_name(soup, name_selector=None):
+    """The name of the store on a page: the text of name_selector,
+    or the page title"""
+    if name_selector:
+        return soup.select_one(name_selector).text
+    return soup.title.text
+
+
+def page_text(source, name_selector=None):
+    """Returns the file name and the text of a page, or None
+    if the page has no store name. Runs in the worker processes."""
+    soup = BeautifulSoup(source, features="lxml")
+    try:
+        name = store_name(soup, name_selector)
+        text = soup.body.text
+    except AttributeError:
+        return None
+    return name.strip().replace("/", "-") + ".txt", text
+
+
+def wanted_page(key, value):
+    """Sitemaps and the other non-pages in the caches are not exported"""
+    if ".xml" in key or "hjartat_store_list" in key:
+        return False
+    return isinstance(value, str) or isinstance(value, dict)
+
+
+def open_cache(path):
+    """Opens a page cache of any format for reading: the page log (.jsonl)
+    with its bodies in cache/bodies, a json cache (.json), or a legacy
+    shelve cache (.pickle). A page log is opened read-only, as a running
+    crawl may be appending to it."""
+    path = Path(path)
+    if path.suffix == ".jsonl":
+        pages = JSONLogShelve(path, read_only=True)
+        bodies_directory = Path.joinpath(path.parent.parent, "bodies")
+        if Path.joinpath(bodies_directory, f"{path.stem}.pack").is_file():
+            pages = CompressedPages(
+                pages, BodyStore(bodies_directory, path.stem, read_only=True)
+            )
+        return pages
+    if path.suffix == ".json":
+        return JSONShelve(path)
+    return shelve.open(str(path), "r")
+
+
+def _page_digest(cache, key):
+    """The digest of a page without reading its body, if the cache knows it"""
+    if isinstance(cache, CompressedPages):
+        return cache.digest(key)
+    return None
+
+
+def export_cache(
+    cache, output_directory, manifest_path=None, name_selector=None, processes=None
+):
+    """Exports the pages in 'cache' to text files in output_directory.
+    The manifest (a json file) remembers the digest and text file of each
+    exported page, so that unchanged pages are not parsed again.
+    Returns the no of exported, unchanged and failed pages."""
+    output = Path(output_directory)
+    if not output.is_dir():
+        output.mkdir(parents=True)
+    manifest = JSONShelve(manifest_path) if manifest_path else {}
+    processes = processes or os.cpu_count() or 1
+    counts = {"exported": 0, "unchanged": 0, "failed": 0}
+
+    def changed_pages():
+        for key in cache:
+            digest = _page_digest(cache, key)
+            previous = manifest.get(key)
+            if digest and previous and previous["digest"] == digest:
+                if link_previous(previous["path"]):
+                    counts["unchanged"] += 1
+                    continue
+            source = cache[key]
+            if not wanted_page(key, source):
+                continue
+            if isinstance(source, dict):
+                source = source.get("body", "")
+            digest = digest or hashlib.sha256(source.encode("utf-8")).hexdigest()
+            if previous and previous["digest"] == digest and link_previous(previous["path"]):
+                counts["unchanged"] += 1
+                continue
+            yield key, digest, source
+
+    def link_previous(previous_path):
+        """Links the text file of a previous export into output"""
+        previous_path = Path(previous_path)
+        path = Path.joinpath(output, previous_path.name)
+        if path == previous_path and path.is_file():
+            return True
+        try:
+            os.link(previous_path, path)
+        except FileExistsError:
+            path.unlink()
+            os.link(previous_path, path)
+        except OSError:
+            if not previous_path.is_file():
+                return False
+            shutil.copyfile(previous_path, path)
+        return True
+
+    def write(key, digest, result):
+        if result is None:
+            logger.warning(f"Could not export {key}, has no title")
+            counts["failed"] += 1
+            return
+        file_name, text = result
+        path = Path.joinpath(output, file_name)
+        if path.is_file():
+            # may be a link to the file of a previous export
+            path.unlink()
+        with open(path, "w") as page:
+            logger.info(f"Exporting to {file_name}")
+            page.write(text)
+        manifest[key] = {"digest": digest, "path": str(path)}
+        counts["exported"] += 1
+
+    if processes == 1:
+        for key, digest, source in changed_pages():
+            write(key, digest, page_text(source, name_selector))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = {}  # future -> (key, digest)
+            for key, digest, source in changed_pages():
+                pending[executor.submit(page_text, source, name_selector)] = (key, digest)
+                if len(pending) >= processes * 4:
+                    # keeps a few pages per process in memory, not the whole cache
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(*pending.pop(future), future.result())
+            for future in list(pending):
+                write(*pending.pop(future), future.result())
+    if manifest_path:
+        manifest.sync()
+    return counts
+
+
+def test_export_cache(tmp_path):
+    bodies = BodyStore(tmp_path.joinpath("bodies"), "KronansApotekSpider", use_zstd=False)
+    cache = CompressedPages(JSONLogShelve(tmp_path.joinpath("day1.jsonl")), bodies)
+    page = "<html><title>Kronans</title><body><h2 class='t'>{}</h2>Öppet {}</body></html>"
+    cache["https://www.kronansapotek.se/a"] = page.format("Apotek A", "9-18")
+    cache["https://www.kronansapotek.se/b"] = page.format("Apotek B/C", "9-18")
+    cache["https://www.kronansapotek.se/sitemap.xml"] = "<urlset></urlset>"
+    cache["https://www.kronansapotek.se/c"] = "<html>no title</html>"
+    manifest = tmp_path.joinpath("manifest.json")
+    day1 = tmp_path.joinpath("export", "2021-03-04")
+    counts = export_cache(cache, day1, manifest, name_selector="h2.t", processes=2)
+    assert counts == {"exported": 2, "unchanged": 0, "failed": 1}
+    assert day1.joinpath("Apotek B-C.txt").read_text() == "Apotek B/CÖppet 9-18"
+    # the next day, one page has changed
+    cache["https://www.kronansapotek.se/a"] = page.format("Apotek A", "10-18")
+    day2 = tmp_path.joinpath("export", "2021-03-05")
+    counts = export_cache(cache, day2, manifest, name_selector="h2.t", processes=1)
+    assert counts == {"exported": 1, "unchanged": 1, "failed": 1}
+    assert day2.joinpath("Apotek A.txt").read_text() == "Apotek AÖppet 10-18"
+    assert day1.joinpath("Apotek A.txt").read_text() == "Apotek AÖppet 9-18"
+    assert day2.joinpath("Apotek B-C.txt").stat().st_ino == day1.joinpath("Apotek B-C.txt").stat().st_ino
+    # a legacy shelve cache
+    with shelve.open(str(tmp_path.joinpath("HjartatSpider.pickle"))) as legacy:
+        legacy["https://www.apotekhjartat.se/x"] = page.format("", "8-20")
+    legacy = open_cache(tmp_path.joinpath("HjartatSpider.pickle"))
+    counts = export_cache(legacy, tmp_path.joinpath("legacy"), processes=1)
+    assert tmp_path.joinpath("legacy", "Kronans.txt").is_file()
+    legacy.close()
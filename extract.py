@@ -0,0 +1,93 @@
+"""Extraction of the fields we need from a store page, using lxml and
+selectors that are compiled once per spider class instead of building
+a BeautifulSoup tree of the whole page."""
+from lxml import etree, html
+from lxml.cssselect import CSSSelector
+
+# one parser for all pages. Comments and processing instructions
+# are never used by the spiders, so they are not added to the tree
+HTML_PARSER = html.HTMLParser(
+    encoding="utf-8", remove_comments=True, remove_pis=True
+)
+
+
+def css(selector):
+    """Compiles a css selector to XPath"""
+    return CSSSelector(selector, translator="html")
+
+
+def xpath(expression):
+    """Compiles a XPath expression"""
+    return etree.XPath(expression)
+
+
+def text_of(element, separator=""):
+    """Returns all the text in an element, like BeautifulSoup's get_text"""
+    if element is None:
+        return None
+    return separator.join(element.itertext())
+
+
+class ExtractedPage(object):
+    """The fields of a parsed page. The fields are the compiled selectors
+    declared in the FIELDS dictionary of each spider.
+
+        >>> FIELDS = {"title": css("title"), "hours": css("span.time")}
+        >>> page = ExtractedPage(page_source, FIELDS)
+        >>> page.text("title")
+        'Apoteket Ekorren, Göteborg - Apoteket'
+        >>> page.all("hours")
+        [<Element span at 0x7f...>, ...]
+    """
+
+    def __init__(self, page_source, fields):
+        if isinstance(page_source, str):
+            page_source = page_source.encode("utf-8")
+        self.tree = html.fromstring(page_source, parser=HTML_PARSER)
+        self.fields = fields
+
+    def all(self, name, element=None):
+        """All the elements matching a field. If element is set, only
+        the elements inside it are matched"""
+        return self.fields[name](self.tree if element is None else element)
+
+    def first(self, name, element=None):
+        """The first element matching a field, or None"""
+        hits = self.all(name, element)
+        return hits[0] if hits else None
+
+    def text(self, name, element=None, separator=""):
+        """The text of the first element matching a field, or None"""
+        return text_of(self.first(name, element), separator)
+
+
+def test_extracted_page():
+    fields = {
+        "title": css("title"),
+        "days": css("ul.underlined-list li"),
+        "weekday": css("span.date"),
+        "street_address": xpath('//*[@itemprop="streetAddress"]'),
+        "map": css("#pharmaciesmap-root img"),
+    }
+    page = ExtractedPage(
+        """<?xml version="1.0" encoding="utf-8"?>
+        <html><head><title>Apoteket Ekorren, Göteborg - Apoteket</title></head>
+        <body><!-- comment -->
+        <span itemprop="streetAddress">Storgatan <b>1</b></span>
+        <ul class="underlined-list">
+          <li><span class="date">Måndag</span><span class="time">09-18</span></li>
+          <li><span class="date">Tisdag</span><span class="time">09-18</span></li>
+        </ul>
+        <div id="pharmaciesmap-root"><div><a><img src="map?57.7,11.9"></a></div></div>
+        </body></html>""",
+        fields,
+    )
+    assert page.text("title") == "Apoteket Ekorren, Göteborg - Apoteket"
+    assert page.text("street_address") == "Storgatan 1"
+    assert [page.text("weekday", day) for day in page.all("days")] == [
+        "Måndag",
+        "Tisdag",
+    ]
+    assert page.first("map").get("src") == "map?57.7,11.9"
+    assert page.text("title", separator=";") == page.text("title")
+    assert page.first("weekday", page.tree.body) is not None
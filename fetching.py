@@ -0,0 +1,76 @@
+"""Rate limiting of the requests we send to each web server."""
+import threading
+import time
+import urllib.parse as p
+
+
+class TokenBucket(object):
+    """A token bucket. Each request takes one token.
+    The bucket is refilled with 'rate' tokens per second
+    and holds at most 'capacity' tokens.
+
+        >>> bucket = TokenBucket(rate=0.5, capacity=1)
+        >>> bucket.take()  # returns at once
+        >>> bucket.take()  # waits two seconds
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Waits until there is a token in the bucket and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class HostRateLimiter(object):
+    """Keeps one token bucket per host, ie a
+    slow host does not hold back requests to other hosts.
+
+        >>> limiter = HostRateLimiter(rate=1)
+        >>> limiter.wait("https://www.apoteket.se/sitemap.xml")
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Waits until we are allowed to send another request to the url's host"""
+        if not self.rate:
+            # no rate limit
+            return
+        host = p.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.capacity)
+            bucket = self.buckets[host]
+        bucket.take()
+
+
+def test_host_rate_limiter():
+    limiter = HostRateLimiter(rate=50)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait("https://www.apoteket.se/apotek/a/")
+    # the first request is free, the next four wait 1/50 s each
+    assert time.monotonic() - start >= 0.07
+    start = time.monotonic()
+    limiter.wait("https://www.lloydsapotek.se/sitemap.xml")
+    assert time.monotonic() - start < 0.02
@@ -0,0 +1,61 @@
+"""Keeps track of which store pages a spider has already seen."""
+import urllib.parse as p
+
+
+def normalize_url(url):
+    """Returns a normalized version of a url, so that small differences
+    in how the same page is linked do not make it look like a new page:
+        * "&amp;" in sitemap urls is unescaped
+        * scheme and host are lower case
+        * trailing slashes and fragments are removed
+        * query parameters are sorted"""
+    url = url.strip().replace("&amp;", "&")
+    scheme, netloc, path, query, _ = p.urlsplit(url)
+    path = path.rstrip("/")
+    query = p.urlencode(sorted(p.parse_qsl(query, keep_blank_values=True)))
+    return p.urlunsplit((scheme.lower(), netloc.lower(), path, query, ""))
+
+
+class CrawlFrontier(object):
+    """The set of urls a spider has seen during the current session.
+
+        >>> frontier = CrawlFrontier()
+        >>> frontier.add("https://www.apoteket.se/apotek/apoteket-ekorren-goteborg/")
+        True
+        >>> frontier.add("https://www.apoteket.se/apotek/apoteket-ekorren-goteborg")
+        False
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.no_duplicates = 0
+
+    def add(self, url):
+        """Adds a url. Returns False if the url has already been seen."""
+        key = normalize_url(url)
+        if key in self.seen:
+            self.no_duplicates += 1
+            return False
+        self.seen.add(key)
+        return True
+
+    def __contains__(self, url):
+        return normalize_url(url) in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+
+def test_crawl_frontier():
+    frontier = CrawlFrontier()
+    assert frontier.add(
+        "https://www.lloydsapotek.se/vitusapotek/lase_pos_1?lat=59.33&amp;long=18.06"
+    )
+    assert not frontier.add(
+        "https://www.lloydsapotek.se/vitusapotek/lase_pos_1?long=18.06&lat=59.33"
+    )
+    assert frontier.add("https://www.apotekhjartat.se/hitta-apotek-hjartat/skane/a/")
+    assert not frontier.add("HTTPS://www.apotekhjartat.se/hitta-apotek-hjartat/skane/a")
+    assert "https://www.apotekhjartat.se/hitta-apotek-hjartat/skane/a/#map" in frontier
+    assert len(frontier) == 2
+    assert frontier.no_duplicates == 2
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    ./geocache.py [options] nearest <database> <lat> <lng>
+
+Options:
+    -h,--help           Help
+    -n=<n>              No of locations [default: 5]
+
+Description:
+    The geo cache: the geo-locations found by MapQuest, kept in a SQLite
+    database (cache/geocache.sqlite) under a canonical form of the address,
+    so that the same address written differently by different chains is
+    only geo-located once. Run as a script, it prints the geo-located
+    addresses nearest to a point, e.g.
+
+        ./geocache.py nearest cache/geocache.sqlite 57.6954 11.9812
+"""
+import json
+import math
+import re
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+
+from loguru import logger
+
+ZIPCODE = re.compile(r"([0-9]{3}\s{0,1}[0-9]{2}\s{0,1})")
+# parts of an address that say nothing about where it is
+COUNTRY = {"sweden", "sverige", "se"}
+PUNCTUATION = re.compile(r"[.;:()\"']")
+WHITESPACE = re.compile(r"\s+")
+
+# (min lat, min lng, max lat, max lng), coordinates outside
+# are taken as parsing errors, e.g. lat and long swapped
+SWEDEN = (55.0, 10.5, 69.1, 24.2)
+
+# a geo-location from MapQuest. lat and lng are None
+# if MapQuest could not find the address
+Location = namedtuple("Location", ["street", "postal_code", "lat", "lng"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    key TEXT PRIMARY KEY,
+    query TEXT,
+    street TEXT,
+    postal_code TEXT,
+    lat REAL,
+    lng REAL
+);
+"""
+
+
+def separate_zip_from_city(txt):
+    """Separates postal code from city"""
+    zip_code = ZIPCODE.findall(txt)
+    if zip_code:
+        zip_code = zip_code[0].replace(" ", "").strip()
+    else:
+        zip_code = None
+    city = ZIPCODE.sub("", txt).strip()
+    return zip_code, city
+
+
+def canonical_address(address_string):
+    """The address in a canonical form, used as key in the geo cache:
+    lower case, single spaces, no punctuation or country, and the postal
+    code without spaces, e.g. "Apoteket Ekorren, Ekorrens väg 1,412 51
+    Göteborg, Sweden" -> "apoteket ekorren, ekorrens väg 1, 41251 göteborg" """
+    parts = []
+    for part in (address_string or "").split(","):
+        part = WHITESPACE.sub(" ", PUNCTUATION.sub(" ", part.lower())).strip()
+        if not part or part in COUNTRY or part == "none":
+            continue
+        zip_code, rest = separate_zip_from_city(part)
+        if zip_code:
+            part = f"{zip_code} {rest}".strip()
+        parts.append(part)
+    return ", ".join(parts)
+
+
+def address_key(address, zip_code, city):
+    """The canonical form of a street address, without the store name,
+    ie the same for every chain with a store at the address"""
+    return canonical_address(f"{address}, {zip_code or ''} {city}")
+
+
+def page_coordinates(lat, lng):
+    """The coordinates found on a store page as floats, or None if they
+    are missing or not in Sweden"""
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        return None
+    min_lat, min_lng, max_lat, max_lng = SWEDEN
+    if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng:
+        return lat, lng
+    return None
+
+
+def latlng_key(lat, lng):
+    """The key of a reverse geo-location in the geo cache,
+    rounded to about one meter"""
+    return f"latlng:{lat:.5f},{lng:.5f}"
+
+
+def zip_mismatch(zip_code, other_zip_code):
+    """True if two postal codes are in different postal areas,
+    ie differ in the first three digits. False if one is missing."""
+    digits = [re.sub(r"\D", "", str(z or "")) for z in (zip_code, other_zip_code)]
+    if not all(len(d) == 5 for d in digits):
+        return False
+    return digits[0][:3] != digits[1][:3]
+
+
+def location_from_response(geo_info):
+    """The first location in a response from MapQuest, or
+    an empty Location if there is none"""
+    for result in (geo_info or {}).get("results") or []:
+        if result and result.get("locations"):
+            location = result["locations"][0]
+            lat_lng = location.get("latLng") or {}
+            return Location(
+                location.get("street"),
+                location.get("postalCode"),
+                lat_lng.get("lat"),
+                lat_lng.get("lng"),
+            )
+    return Location(None, None, None, None)
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+class GridIndex(object):
+    """A spatial index of points in cells of cell_size degrees.
+    nearest() searches the cells in growing rings around a point.
+
+        >>> grid = GridIndex()
+        >>> grid.add("a", 57.6954, 11.9812)
+        >>> grid.nearest(57.6950, 11.9810)
+        [(44.8, "a")]
+    """
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.cells = {}  # (row, column) -> [(lat, lng, item)]
+        self.no_points = 0
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.cell_size), math.floor(lng / self.cell_size)
+
+    def add(self, item, lat, lng):
+        self.cells.setdefault(self.cell(lat, lng), []).append((lat, lng, item))
+        self.no_points += 1
+
+    @staticmethod
+    def _ring(row, column, ring):
+        """The cells at distance 'ring' from a cell"""
+        if ring == 0:
+            yield row, column
+            return
+        for c in range(column - ring, column + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, column - ring
+            yield r, column + ring
+
+    def nearest(self, lat, lng, n=1, max_distance=None):
+        """The n items nearest to the point as a list of (meters, item),
+        nearest first, optionally only those within max_distance meters"""
+        if not self.no_points:
+            return []
+        row, column = self.cell(lat, lng)
+        # the shortest side of a cell in meters, the longitude side
+        # shrinks towards the poles
+        cell_m = distance_m(lat, lng, lat, lng + self.cell_size)
+        found = []
+        ring = 0
+        while True:
+            if (2 * ring + 1) ** 2 > len(self.cells):
+                # sparse points, it is cheaper to check the remaining cells
+                for (r, c), points in self.cells.items():
+                    if max(abs(r - row), abs(c - column)) >= ring:
+                        found.extend(
+                            (distance_m(lat, lng, point_lat, point_lng), item)
+                            for point_lat, point_lng, item in points
+                        )
+                found.sort(key=lambda hit: hit[0])
+                break
+            for r, c in self._ring(row, column, ring):
+                for point_lat, point_lng, item in self.cells.get((r, c), []):
+                    found.append((distance_m(lat, lng, point_lat, point_lng), item))
+            found.sort(key=lambda hit: hit[0])
+            # everything outside the searched rings is at least this far away
+            searched_m = ring * cell_m
+            if max_distance is not None and searched_m > max_distance:
+                break
+            if len(found) >= n and found[n - 1][0] <= searched_m:
+                break
+            ring += 1
+        if max_distance is not None:
+            found = [hit for hit in found if hit[0] <= max_distance]
+        return found[:n]
+
+
+class GeoCache(object):
+    """The geo-locations of the addresses, by canonical address.
+
+        >>> geo_cache = GeoCache("cache/geocache.sqlite")
+        >>> geo_cache.add("Apoteket Ekorren, Ekorrens väg 1, 41251 Göteborg, Sweden", response)
+        >>> geo_cache.get("apoteket ekorren, ekorrens väg 1,412 51 göteborg")
+        Location(street="Ekorrens väg 1", postal_code="41251", lat=57.69, lng=11.98)
+        >>> geo_cache.nearest(57.69, 11.98)
+        [(12.0, "apoteket ekorren, ekorrens väg 1, 41251 göteborg", Location(...))]
+
+    Several processes can use the same database at the same time. An
+    address that is not in memory is looked up in the database, where
+    another process, e.g. another chain with --parallel, may have saved it.
+    """
+
+    def __init__(self, path, cell_size=0.01):
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.grid = GridIndex(cell_size)
+        self.locations = {}  # key -> Location
+        for key, street, postal_code, lat, lng in self.db.execute(
+            "SELECT key, street, postal_code, lat, lng FROM locations"
+        ):
+            self._remember(key, Location(street, postal_code, lat, lng))
+
+    def _remember(self, key, location):
+        self.locations[key] = location
+        if location.lat is not None and location.lng is not None:
+            self.grid.add(key, float(location.lat), float(location.lng))
+
+    def _lookup(self, key):
+        if key not in self.locations:
+            row = self.db.execute(
+                "SELECT street, postal_code, lat, lng FROM locations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, Location(*row))
+        return self.locations[key]
+
+    def __contains__(self, address_string):
+        return self._lookup(canonical_address(address_string)) is not None
+
+    def __len__(self):
+        return len(self.locations)
+
+    def get(self, address_string):
+        """The Location of an address, or None if it
+        has not been geo-located"""
+        return self._lookup(canonical_address(address_string))
+
+    def get_key(self, key):
+        """The Location saved under a key that is not an address,
+        e.g. a latlng_key"""
+        return self._lookup(key)
+
+    def add(self, address_string, geo_info, key=None):
+        """Saves the first location in a response from MapQuest,
+        under the canonical address, or under 'key' if given"""
+        self.add_location(address_string, location_from_response(geo_info), key)
+
+    def add_location(self, address_string, location, key=None):
+        key = key or canonical_address(address_string)
+        if key in self.locations:
+            if self.locations[key] == location:
+                return
+            # a new location for a known address: rebuild the grid without the old one
+            self.locations[key] = location
+            self.grid = GridIndex(self.grid.cell_size)
+            for known_key, known in list(self.locations.items()):
+                if known.lat is not None and known.lng is not None:
+                    self.grid.add(known_key, float(known.lat), float(known.lng))
+        else:
+            self._remember(key, location)
+        self.db.execute(
+            "INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?)",
+            (key, address_string, *location),
+        )
+
+    def nearest(self, lat, lng, n=1, max_distance=None):
+        """The geo-located addresses nearest to a point, as a list
+        of (meters, key, Location), nearest first"""
+        return [
+            (meters, key, self.locations[key])
+            for meters, key in self.grid.nearest(
+                float(lat), float(lng), n=n, max_distance=max_distance
+            )
+        ]
+
+    def import_json(self, path):
+        """Imports a geo cache from before the SQLite database, ie a json
+        file with the responses from MapQuest by address"""
+        path = Path(path)
+        with open(path, "r") as f:
+            responses = json.loads(f.read())
+        for address_string, geo_info in responses.items():
+            if canonical_address(address_string) not in self.locations:
+                self.add(address_string, geo_info)
+        self.sync()
+        logger.info(f"Imported {len(responses)} geo-locations from {path}")
+
+    def sync(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def test_canonical_address():
+    # Lloyds and Kronans write the same address differently
+    lloyds = "Lloyds Apotek Ekorren, Ekorrens väg 1,412 51 Göteborg, Sweden"
+    kronans = "LLOYDS APOTEK EKORREN,  Ekorrens  väg 1, 41251 Göteborg. , Sweden"
+    assert canonical_address(lloyds) == canonical_address(kronans)
+    assert canonical_address(lloyds) == "lloyds apotek ekorren, ekorrens väg 1, 41251 göteborg"
+    assert address_key("Ekorrens väg 1", "412 51", "Göteborg") == "ekorrens väg 1, 41251 göteborg"
+    assert address_key("Ekorrens väg 1", None, "Göteborg") == "ekorrens väg 1, göteborg"
+
+
+def test_page_coordinates():
+    assert page_coordinates("57.6954", "11.9812") == (57.6954, 11.9812)
+    assert page_coordinates(11.9812, 57.6954) is None  # swapped
+    assert page_coordinates("", None) is None
+    assert latlng_key(57.6954, 11.98121234) == "latlng:57.69540,11.98121"
+    assert zip_mismatch("412 51", "41263") is False
+    assert zip_mismatch("41251", "98131") is True
+    assert zip_mismatch("41251", None) is False
+
+
+def test_geo_cache(tmp_path):
+    def response(lat, lng):
+        location = {"street": "Ekorrens väg 1", "postalCode": "41251", "latLng": {"lat": lat, "lng": lng}}
+        return {"results": [{"locations": [location]}]}
+
+    json_cache = tmp_path.joinpath("geocache.json")
+    json_cache.write_text(
+        json.dumps(
+            {
+                "Apoteket Ekorren, Ekorrens väg 1, 41251 Göteborg, Sweden": response(57.6954, 11.9812),
+                "Apoteket Nowhere, Sweden": {"results": [{"locations": []}]},
+            }
+        )
+    )
+    geo_cache = GeoCache(tmp_path.joinpath("geocache.sqlite"))
+    geo_cache.import_json(json_cache)
+    geo_cache.add("Apoteket Kiruna, 98131 Kiruna, Sweden", response(67.8558, 20.2253))
+    geo_cache.add("Apoteket Malmö, 21122 Malmö, Sweden", response(55.6050, 13.0038))
+    geo_cache.close()
+    geo_cache = GeoCache(tmp_path.joinpath("geocache.sqlite"))
+    assert len(geo_cache) == 4
+    location = geo_cache.get("apoteket ekorren, ekorrens väg 1,412 51 göteborg")
+    assert location == Location("Ekorrens väg 1", "41251", 57.6954, 11.9812)
+    assert "Apoteket Nowhere,  Sweden" in geo_cache
+    assert geo_cache.get("Apoteket Nowhere, Sweden").lat is None
+    # the same building, a few meters away
+    (meters, key, location), = geo_cache.nearest(57.6955, 11.9813)
+    assert meters < 20 and key.startswith("apoteket ekorren")
+    assert geo_cache.nearest(57.70, 11.99, max_distance=50) == []
+    nearest = geo_cache.nearest(59.33, 18.06, n=3)
+    assert [key.split(",")[0] for _, key, _ in nearest] == [
+        "apoteket ekorren",
+        "apoteket malmö",
+        "apoteket kiruna",
+    ]
+    # another process geo-locates an address after we opened the cache
+    other_process = GeoCache(tmp_path.joinpath("geocache.sqlite"))
+    other_process.add("Apoteket Luleå, 97231 Luleå, Sweden", response(65.5848, 22.1547))
+    other_process.close()
+    assert geo_cache.get("Apoteket Luleå, 97231 Luleå, Sweden").lat == 65.5848
+    geo_cache.close()
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    geo_cache = GeoCache(arguments["<database>"])
+    for meters, key, location in geo_cache.nearest(
+        arguments["<lat>"], arguments["<lng>"], n=int(arguments["-n"])
+    ):
+        print(f"{meters:8.0f} m  {key}  ({location.lat}, {location.lng})")
@@ -0,0 +1,154 @@
+"""Geo-location of street addresses using MapQuest's geocoding API."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from loguru import logger
+
+
+class MapQuestGeocoder(object):
+    """Sends addresses to MapQuest's geocoding API over one
+    keep-alive session.
+
+        >>> geocoder = MapQuestGeocoder(key)
+        >>> geocoder.geocode("Apoteket Ekorren, Göteborg, Sweden")
+        {"results": [{"locations": [...], ...}], ...}
+        >>> geocoder.batch_geocode(["address 1", "address 2"])
+        {"address 1": {"results": [...]}, "address 2": {"results": [...]}}
+        >>> geocoder.batch_reverse({"a": (57.6954, 11.9812)})
+        {"a": {"results": [{"locations": [{"postalCode": "41251", ...}]}]}}
+
+    The responses have the same format for both functions, so
+    they can be saved in the same geo cache.
+    """
+
+    BASE_URL = "http://www.mapquestapi.com/geocoding/v1"
+    BATCH_SIZE = 100  # max no of locations per batch request
+
+    def __init__(self, key, base_url=None, timeout=60):
+        self.key = key
+        self.base_url = (base_url or self.BASE_URL).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def geocode(self, address_string):
+        """Geo-locates one address. Returns the response from
+        MapQuest or None if the request failed."""
+        r = self.session.post(
+            f"{self.base_url}/address",
+            params={"key": self.key},
+            data={"location": address_string},
+            timeout=self.timeout,
+        )
+        if r:
+            return r.json()
+        logger.error(f"Geocoding failed with status {r.status_code}: {address_string}")
+        return None
+
+    def batch_geocode(self, addresses):
+        """Geo-locates a list of addresses, BATCH_SIZE addresses per request.
+        Returns a dictionary with the address as key and the response
+        as value. Addresses in failed requests are left out."""
+        addresses = list(addresses)
+        return self._batch(dict(zip(addresses, addresses)))
+
+    def batch_reverse(self, points):
+        """Finds the street address and postal code of points, given as a
+        dictionary of key -> (lat, lng). Returns a dictionary with the
+        same keys and the responses as values."""
+        return self._batch(
+            {key: {"latLng": {"lat": lat, "lng": lng}} for key, (lat, lng) in points.items()}
+        )
+
+    def _batch(self, locations):
+        """Sends the locations (key -> address or latLng) to the batch
+        API, BATCH_SIZE locations per request"""
+        keys = list(locations)
+        geo_info = {}
+        for start in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[start : start + self.BATCH_SIZE]
+            r = self.session.post(
+                f"{self.base_url}/batch",
+                params={"key": self.key},
+                json={
+                    "locations": [locations[key] for key in batch],
+                    "options": {"thumbMaps": False},
+                },
+                timeout=self.timeout,
+            )
+            if not r:
+                logger.error(
+                    f"Batch geocoding of {len(batch)} locations failed with status {r.status_code}"
+                )
+                continue
+            response = r.json()
+            # the results are in the same order as the locations
+            for key, result in zip(batch, response["results"]):
+                geo_info[key] = {
+                    "info": response.get("info", {}),
+                    "results": [result],
+                }
+        return geo_info
+
+
+class _StandInMapQuest(BaseHTTPRequestHandler):
+    """Answers geocoding requests like MapQuest. Used for testing."""
+
+    requests_received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests_received.append(self.path)
+        locations = json.loads(body)["locations"]
+        results = [
+            {
+                "providedLocation": {"location": location},
+                "locations": [
+                    {
+                        "street": location.split(",")[0]
+                        if isinstance(location, str)
+                        else "Reverse gatan 1",
+                        "postalCode": "19272",
+                        "latLng": {"lat": 59.4, "lng": 17.9},
+                    }
+                ],
+            }
+            for location in locations
+        ]
+        response = json.dumps({"info": {"statuscode": 0}, "results": results})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_batch_geocode():
+    server = HTTPServer(("127.0.0.1", 0), _StandInMapQuest)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        geocoder = MapQuestGeocoder(
+            "secret", base_url=f"http://127.0.0.1:{server.server_port}/geocoding/v1"
+        )
+        geocoder.BATCH_SIZE = 2
+        addresses = [f"Storgatan {n}, Sollentuna, Sweden" for n in range(5)]
+        geo_info = geocoder.batch_geocode(addresses)
+    finally:
+        server.shutdown()
+    assert len(_StandInMapQuest.requests_received) == 3
+    assert _StandInMapQuest.requests_received[0] == "/geocoding/v1/batch?key=secret"
+    assert list(geo_info) == addresses
+    location = geo_info[addresses[3]]["results"][0]["locations"][0]
+    assert location["street"] == "Storgatan 3"
+    server = HTTPServer(("127.0.0.1", 0), _StandInMapQuest)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        geocoder.base_url = f"http://127.0.0.1:{server.server_port}/geocoding/v1"
+        geo_info = geocoder.batch_reverse({"a": (59.4, 17.9), "b": (59.5, 17.8)})
+    finally:
+        server.shutdown()
+    assert geo_info["b"]["results"][0]["locations"][0]["postalCode"] == "19272"
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    ./history.py [options] <database>
+
+Options:
+    -h,--help           Help
+    --chain=<chain>     Only stores from <chain>, e.g. LloydsSpider
+    --since=<date>      Only changes found on or after <date>, e.g. 2021-03-01
+
+Description:
+    The history of all the scraped stores, kept in a SQLite database
+    (cache/history.sqlite). Each run appends one snapshot per store.
+    Run as a script, it prints the stores whose opening hours, address or
+    geo-location changed from one snapshot to the next, as csv.
+"""
+import csv
+import hashlib
+import json
+import sqlite3
+import sys
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_snapshots (
+    chain TEXT NOT NULL,
+    url TEXT NOT NULL,
+    scraped_at TEXT NOT NULL,
+    store_name TEXT,
+    address TEXT,
+    zip_code TEXT,
+    city TEXT,
+    long TEXT,
+    lat TEXT,
+    mq_lat TEXT,
+    mq_long TEXT,
+    hours_digest TEXT,
+    address_digest TEXT,
+    geo_digest TEXT
+);
+CREATE INDEX IF NOT EXISTS store_snapshots_index
+    ON store_snapshots (chain, url, scraped_at);
+CREATE TABLE IF NOT EXISTS opening_hours (
+    chain TEXT NOT NULL,
+    url TEXT NOT NULL,
+    weekday_no INTEGER,
+    scraped_at TEXT NOT NULL,
+    weekday TEXT,
+    hours TEXT,
+    open_minutes INTEGER,
+    close_minutes INTEGER,
+    closed INTEGER,
+    open_24h INTEGER,
+    deviating INTEGER
+);
+CREATE INDEX IF NOT EXISTS opening_hours_index
+    ON opening_hours (chain, url, weekday_no, scraped_at);
+"""
+
+# the columns compared between snapshots
+CHANGE_KINDS = ("hours", "address", "geo")
+
+
+def _digest(*values):
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _hours_digest(store):
+    """The digest of the normalized opening hours, sorted by day. Unlike
+    the rows on the page, they stay the same from one day to the next
+    for rows like "Idag" or "Imorgon"."""
+    if store.normalized_hours is None:
+        return _digest(*store.opening_hours)
+    days = []
+    for normalized in store.normalized_hours:
+        _, weekday, hours = store.opening_hours[normalized.entry]
+        day = list(normalized[1:])
+        if normalized.deviating:
+            # holidays and other dates have no day_no
+            day.append(weekday)
+        if normalized.open_minutes is None and not normalized.closed:
+            # hours we could not parse
+            day.append(hours)
+        days.append(day)
+    return _digest(*sorted(days, key=json.dumps))
+
+
+class HistoryStore(object):
+    """Append-only history of the stores.
+
+        >>> history = HistoryStore("cache/history.sqlite")
+        >>> stores = history.record(spider.scrape(), only_changes=True)
+        >>> history.changes(since="2021-03-01")
+        [{"chain": "LloydsSpider", "url": ..., "changed": "hours", ...}]
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        # several spiders may write at the same time
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def previous_snapshot(self, chain, url, before="9999"):
+        """The last snapshot of a store taken before 'before', or None"""
+        return self.db.execute(
+            "SELECT * FROM store_snapshots WHERE chain = ? AND url = ? AND scraped_at < ? "
+            "ORDER BY scraped_at DESC, rowid DESC LIMIT 1",
+            (chain, url, before),
+        ).fetchone()
+
+    def has_snapshot(self, store):
+        """True if this very snapshot has been added, e.g. by a run
+        that stopped and was resumed"""
+        return (
+            self.db.execute(
+                "SELECT 1 FROM store_snapshots WHERE chain = ? AND url = ? AND scraped_at = ?",
+                (store.chain, store.url, store.scraped_at),
+            ).fetchone()
+            is not None
+        )
+
+    def changed(self, store, previous):
+        """What changed since the previous snapshot, e.g. ["hours", "geo"].
+        Everything has changed for a new store."""
+        if previous is None:
+            return list(CHANGE_KINDS)
+        digests = self.digests(store)
+        return [
+            kind for kind in CHANGE_KINDS if digests[kind] != previous[f"{kind}_digest"]
+        ]
+
+    def digests(self, store):
+        return {
+            "hours": _hours_digest(store),
+            "address": _digest(store.store_name, store.address, store.zip_code, store.city),
+            "geo": _digest(
+                *[_text(v) for v in (store.long, store.lat, store.mq_lat, store.mq_long)]
+            ),
+        }
+
+    def add(self, store):
+        """Appends a snapshot of the store"""
+        digests = self.digests(store)
+        self.db.execute(
+            "INSERT INTO store_snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                store.chain,
+                store.url,
+                store.scraped_at,
+                store.store_name,
+                store.address,
+                _text(store.zip_code),
+                store.city,
+                _text(store.long),
+                _text(store.lat),
+                _text(store.mq_lat),
+                _text(store.mq_long),
+                digests["hours"],
+                digests["address"],
+                digests["geo"],
+            ),
+        )
+        self.db.executemany(
+            "INSERT INTO opening_hours VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    row["chain"],
+                    row["url"],
+                    row["day_no"],
+                    row["datetime"],
+                    row["weekday"],
+                    row["hours"],
+                    row["open_minutes"],
+                    row["close_minutes"],
+                    row["closed"],
+                    row["open_24h"],
+                    row["deviating"],
+                )
+                for row in store.rows()
+            ],
+        )
+
+    def record(self, stores, only_changes=False):
+        """Adds a snapshot of each store while passing the stores on.
+        With only_changes, the stores that have not changed since
+        their last snapshot are left out.
+        Each snapshot is committed before the store is passed on, as the
+        crawl goes on in between and other spiders write to the same
+        database at the same time."""
+        for store in stores:
+            if store.parsing_failed:
+                # dummy stores for pages we could not parse
+                yield store
+                continue
+            changed = self.changed(
+                store, self.previous_snapshot(store.chain, store.url, store.scraped_at)
+            )
+            if not self.has_snapshot(store):
+                self.add(store)
+                self.db.commit()
+            if changed or not only_changes:
+                yield store
+        self.db.commit()
+
+    def changes(self, chain=None, since=None):
+        """Returns the snapshots that differ from the previous snapshot of
+        the same store. 'changed' lists what changed, e.g. "hours,geo".
+        New stores are not included."""
+        query = """
+            SELECT * FROM (
+                SELECT chain, url, store_name, scraped_at,
+                    LAG(scraped_at) OVER w AS previous_scraped_at,
+                    hours_digest != LAG(hours_digest) OVER w AS hours,
+                    address_digest != LAG(address_digest) OVER w AS address,
+                    geo_digest != LAG(geo_digest) OVER w AS geo
+                FROM store_snapshots
+                WHERE chain = coalesce(?, chain)
+                WINDOW w AS (PARTITION BY chain, url ORDER BY scraped_at, rowid)
+            )
+            WHERE scraped_at >= coalesce(?, '') AND (hours OR address OR geo)
+            ORDER BY scraped_at, chain, url
+        """
+        changes = []
+        for row in self.db.execute(query, (chain, since)):
+            change = {
+                key: row[key]
+                for key in ("chain", "url", "store_name", "scraped_at", "previous_scraped_at")
+            }
+            change["changed"] = ",".join(kind for kind in CHANGE_KINDS if row[kind])
+            changes.append(change)
+        return changes
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def test_history_store():
+    from stores import Store
+
+    def snapshot(hours, lat):
+        store = Store("LloydsSpider", "url", "Lloyds Centralen", lat=lat, long=18.06)
+        store.add_hours("1", "Måndag", hours)
+        return store
+
+    history = HistoryStore(":memory:")
+    runs = [("09-18", 59.33), ("09-18", 59.33), ("10-18", 59.33), ("10-18", 59.34)]
+    emitted = []
+    for hours, lat in runs:
+        stores = [snapshot(hours, lat), Store.failed("LloydsSpider", "x", "FAILED")]
+        emitted.append(len(list(history.record(stores, only_changes=True))))
+    # the new store, the failed store is always passed on
+    assert emitted == [2, 1, 2, 2]
+    changes = history.changes()
+    assert [change["changed"] for change in changes] == ["hours", "geo"]
+    assert history.changes(chain="KronansApotekSpider") == []
+    assert history.changes(since="9999") == []
+    no_rows = history.db.execute(
+        "SELECT count(*) FROM opening_hours WHERE chain = ? AND url = ?",
+        ("LloydsSpider", "url"),
+    ).fetchone()[0]
+    assert no_rows == 4
+    # a store resumed from the checkpoint of a run that stopped
+    # is compared with the snapshot before that run, and not added again
+    resumed = snapshot("11-18", 59.34)
+    assert len(list(history.record([resumed], only_changes=True))) == 1
+    assert len(list(history.record([resumed], only_changes=True))) == 1
+    assert [change["changed"] for change in history.changes()] == ["hours", "geo", "hours"]
+    history.close()
+
+
+def test_parallel_history(tmp_path):
+    from stores import Store
+
+    path = tmp_path.joinpath("history.sqlite")
+    first, second = HistoryStore(path), HistoryStore(path)
+    second.db.execute("PRAGMA busy_timeout = 0")  # fails at once if locked
+    first_stores = first.record([Store("LloydsSpider", url, "Lloyds") for url in "ab"])
+    second_stores = second.record([Store("KronansApotekSpider", url, "Kronans") for url in "ab"])
+    # the spiders take turns while they crawl
+    for _ in range(2):
+        next(first_stores)
+        next(second_stores)
+    list(first_stores), list(second_stores)
+    assert first.db.execute("SELECT count(*) FROM store_snapshots").fetchone()[0] == 4
+    first.close()
+    second.close()
+
+
+def test_hours_digest():
+    from hours import normalize_stores
+    from stores import Store
+
+    def snapshot(rows):
+        store = Store("LloydsSpider", "url", "Lloyds Centralen")
+        for row in rows:
+            store.add_hours(*row)
+        return next(normalize_stores([store]))
+
+    # the same hours seen on a Wednesday and on a Thursday
+    wednesday = snapshot([("3", "Idag", "09-18"), ("4", "Imorgon", "10-18")])
+    thursday = snapshot([("3", "Onsdag", "09-18"), ("4", "Idag", "10-18")])
+    assert _hours_digest(wednesday) == _hours_digest(thursday)
+    changed = snapshot([("3", "Onsdag", "09-18"), ("4", "Idag", "10-19")])
+    assert _hours_digest(changed) != _hours_digest(thursday)
+    holiday = snapshot([("3", "Onsdag", "09-18"), ("", "24 december", "10-14")])
+    other_holiday = snapshot([("3", "Onsdag", "09-18"), ("", "31 december", "10-14")])
+    assert _hours_digest(holiday) != _hours_digest(other_holiday)
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    history = HistoryStore(arguments["<database>"])
+    changes = history.changes(arguments["--chain"], arguments["--since"])
+    writer = csv.DictWriter(
+        sys.stdout,
+        ["scraped_at", "previous_scraped_at", "chain", "url", "store_name", "changed"],
+    )
+    writer.writeheader()
+    writer.writerows(changes)
+    history.close()
@@ -0,0 +1,190 @@
+"""Normalization of the opening hours on the store pages, e.g.
+"Måndag-Fredag: 09:00-17:00", to minutes after midnight per weekday."""
+import re
+
+from stores import NormalizedHours
+
+WEEKDAYS = {
+    "måndag": "1",
+    "tisdag": "2",
+    "onsdag": "3",
+    "torsdag": "4",
+    "fredag": "5",
+    "lördag": "6",
+    "söndag": "7",
+    "mån-fre": "1,2,3,4,5",
+    "må": "1",
+    "ti": "2",
+    "on": "3",
+    "to": "4",
+    "fr": "5",
+    "lö": "6",
+    "sö": "7",
+    "lördag-söndag": "6,7",
+    "måndag-tisdag": "1,2",
+    "måndag-onsdag": "1,2,3",
+    "måndag-torsdag": "1,2,3,4",
+    "måndag-fredag": "1,2,3,4,5",
+    "måndag-lördag": "1,2,3,4,5,6",
+    "måndag-söndag": "1,2,3,4,5,6,7",
+}
+
+# WEEKDAYS as tuples of day numbers, plus the other
+# ways the chains write days
+DAY_NUMBERS = {key: tuple(int(n) for n in value.split(",")) for key, value in WEEKDAYS.items()}
+DAY_NUMBERS.update(
+    {
+        "mån": (1,),
+        "tis": (2,),
+        "ons": (3,),
+        "tor": (4,),
+        "tors": (4,),
+        "fre": (5,),
+        "lör": (6,),
+        "sön": (7,),
+        "lör-sön": (6, 7),
+        "vardagar": (1, 2, 3, 4, 5),
+        "helger": (6, 7),
+        "helgdagar": (6, 7),
+    }
+)
+
+DAY_RANGE = re.compile(r"^(\w+)\s*[-–]\s*(\w+)$")
+# e.g. "Första maj (01/05)" or "Julafton 24/12"
+DATE = re.compile(r"\d{1,2}/\d{1,2}")
+CLOSED = re.compile(r"stängt|stängd|closed")
+OPEN_24H = re.compile(r"dygnet runt|24\s*h|24/7")
+TIME_RANGE = re.compile(r"(\d{1,2})(?:[:.](\d{2}))?\s*[-–]\s*(\d{1,2})(?:[:.](\d{2}))?")
+
+
+def day_numbers(weekday_no, weekday):
+    """Returns the day numbers (1 for Monday) of a row of opening hours.
+    weekday_no is the output of weekday_text_to_int, e.g. "1,2,3,4,5",
+    which already handles "idag" and "imorgon". If it is missing,
+    the weekday text is looked up in DAY_NUMBERS."""
+    if weekday_no and all(n.isdigit() for n in str(weekday_no).split(",")):
+        return tuple(int(n) for n in str(weekday_no).split(","))
+    txt = (weekday or "").lower().strip()
+    if txt in DAY_NUMBERS:
+        return DAY_NUMBERS[txt]
+    match = DAY_RANGE.match(txt)
+    if match and match.group(1) in DAY_NUMBERS and match.group(2) in DAY_NUMBERS:
+        first, last = DAY_NUMBERS[match.group(1)][0], DAY_NUMBERS[match.group(2)][-1]
+        return tuple(range(first, last + 1))
+    return ()
+
+
+def parse_hours(hours):
+    """Returns (open_minutes, close_minutes, closed, open_24h)
+    for an opening hours text like "09:00-18:00" """
+    txt = (hours or "").lower()
+    if CLOSED.search(txt):
+        return None, None, True, False
+    if OPEN_24H.search(txt):
+        return 0, 1440, False, True
+    match = TIME_RANGE.search(txt)
+    if not match:
+        return None, None, False, False
+    open_h, open_m, close_h, close_m = match.groups()
+    open_minutes = int(open_h) * 60 + int(open_m or 0)
+    close_minutes = int(close_h) * 60 + int(close_m or 0)
+    if open_minutes == close_minutes == 0:
+        # Lloyds writes closed days as 00:00-00:00
+        return None, None, True, False
+    if close_minutes <= open_minutes:
+        # closes at or after midnight
+        close_minutes += 1440
+    return open_minutes, close_minutes, False, (open_minutes, close_minutes) == (0, 1440)
+
+
+def normalize_entry(weekday_no, weekday, hours):
+    """Returns a list of (day_no, open_minutes, close_minutes, closed,
+    open_24h, deviating), one per day the row of opening hours is for.
+    Rows for holidays and other dates are 'deviating' with no day_no."""
+    days = day_numbers(weekday_no, weekday)
+    deviating = not days or bool(DATE.search(weekday or ""))
+    parsed = parse_hours(hours)
+    if deviating:
+        return [(None, *parsed, True)]
+    return [(day_no, *parsed, False) for day_no in days]
+
+
+def normalize_stores(stores):
+    """Adds normalized opening hours to each store as it passes through.
+    The chains use only a few different texts, so each distinct row of
+    opening hours is parsed once and the result is reused.
+
+        >>> store.add_hours("1,2,3,4,5", "Måndag-Fredag", "09:00-17:00")
+        >>> next(normalize_stores([store])).normalized_hours
+        [NormalizedHours(entry=0, day_no=1, open_minutes=540, close_minutes=1020, ...), ...]
+    """
+    parsed = {}
+    for store in stores:
+        if store.normalized_hours is None:
+            for entry in store.opening_hours:
+                if entry not in parsed:
+                    parsed[entry] = normalize_entry(*entry)
+            store.normalized_hours = [
+                NormalizedHours(index, *normalized)
+                for index, entry in enumerate(store.opening_hours)
+                for normalized in parsed[entry]
+            ]
+        yield store
+
+
+def test_normalize_entry():
+    assert normalize_entry("1", "Måndag", "09:00-18:00") == [
+        (1, 540, 1080, False, False, False)
+    ]
+    assert normalize_entry("1,2,3,4,5", "Måndag-Fredag", "09:00-17:00")[4] == (
+        5, 540, 1020, False, False, False
+    )
+    assert normalize_entry("6,7", "Lördag-Söndag", "00:00-00:00") == [
+        (6, None, None, True, False, False),
+        (7, None, None, True, False, False),
+    ]
+    assert normalize_entry(None, "Första maj (01/05)", "11:00-16:00") == [
+        (None, 660, 960, False, False, True)
+    ]
+    assert normalize_entry("7", "Söndag", "Stängt")[0][3]
+    assert normalize_entry(None, "Tis-Tors", "09 - 18") == [
+        (day_no, 540, 1080, False, False, False) for day_no in (2, 3, 4)
+    ]
+    assert normalize_entry("3", "Idag", "Öppet dygnet runt") == [
+        (3, 0, 1440, False, True, False)
+    ]
+    assert normalize_entry("5", "Fredag", "10:00-01:00")[0][1:3] == (600, 1500)
+    assert normalize_entry("1", "måndag", "") == [(1, None, None, False, False, False)]
+
+
+def test_normalize_stores():
+    from stores import Store
+
+    stores = []
+    for n in range(3):
+        store = Store("LloydsSpider", f"url{n}", f"Lloyds {n}")
+        store.add_hours("1,2,3,4,5", "Måndag-Fredag", "09:00-17:00")
+        store.add_hours(None, "Första maj (01/05)", "11:00-16:00")
+        stores.append(store)
+    stores.append(Store.failed("LloydsSpider", "url3", "COULD NOT PARSE PAGE"))
+    stores = list(normalize_stores(stores))
+    assert len(stores) == 4
+    assert len(stores[2].normalized_hours) == 6
+    rows = list(stores[0].rows())
+    assert [row["day_no"] for row in rows] == [1, 2, 3, 4, 5, None]
+    assert rows[5]["weekday"] == "Första maj (01/05)"
+    assert rows[5]["deviating"]
+    assert list(stores[3].rows())[0]["day_no"] == "COULD NOT PARSE PAGE"
+
+
+def test_normalize_stores_streams():
+    from stores import Store
+
+    def scrape():
+        store = Store("LloydsSpider", "url0", "Lloyds 0")
+        store.add_hours("1", "Måndag", "09:00-17:00")
+        yield store
+        raise AssertionError("the first store was held back")
+
+    store = next(normalize_stores(scrape()))
+    assert store.normalized_hours[0].open_minutes == 540
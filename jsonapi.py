@@ -0,0 +1,178 @@
+"""Reading store data from the json that a chain's own web pages load,
+instead of rendering the pages in Firefox.
+
+The json requests a page makes are found with the browser's resource
+timing entries (see XHR_URLS_SCRIPT). The stores in a json response
+are found by their keys, since each chain names them differently."""
+import json
+
+# returns the urls of the XHR/fetch requests the current page has made
+XHR_URLS_SCRIPT = """
+return performance.getEntriesByType("resource")
+    .filter(e => e.initiatorType === "xmlhttprequest" || e.initiatorType === "fetch")
+    .map(e => e.name);
+"""
+
+# lower case key -> field
+KEYS = {
+    "name": "name",
+    "title": "name",
+    "pharmacyname": "name",
+    "storename": "name",
+    "displayname": "name",
+    "url": "url",
+    "link": "url",
+    "href": "url",
+    "pageurl": "url",
+    "streetaddress": "address",
+    "address": "address",
+    "street": "address",
+    "address1": "address",
+    "postalcode": "zip_code",
+    "zipcode": "zip_code",
+    "zip": "zip_code",
+    "postcode": "zip_code",
+    "city": "city",
+    "addresslocality": "city",
+    "locality": "city",
+    "town": "city",
+    "lat": "lat",
+    "latitude": "lat",
+    "lng": "long",
+    "lon": "long",
+    "long": "long",
+    "longitude": "long",
+    "openinghours": "opening_hours",
+    "openhours": "opening_hours",
+    "opening_hours": "opening_hours",
+    "hours": "opening_hours",
+}
+WEEKDAY_KEYS = ("day", "dayofweek", "weekday", "name", "label")
+HOURS_KEYS = ("hours", "time", "openinghours", "value", "text")
+
+
+def _flatten(record):
+    """The keys of a record and of the dicts in it, e.g.
+    {"address": {"city": ...}, "geo": {"lat": ...}}"""
+    fields, nested = {}, []
+    for key, value in record.items():
+        field = KEYS.get(key.lower())
+        if isinstance(value, dict) and field != "opening_hours":
+            nested.append(value)
+        elif field:
+            fields.setdefault(field, value)
+    # the keys of the record itself come first
+    for value in nested:
+        for sub_field, sub_value in _flatten(value).items():
+            fields.setdefault(sub_field, sub_value)
+    return fields
+
+
+def _hours_text(entry):
+    """The opening hours of one day as text, e.g. "08:00-20:00" """
+    keys = {key.lower(): value for key, value in entry.items()}
+    if keys.get("closed") is True or keys.get("isclosed") is True:
+        return "Stängt"
+    opens = keys.get("opens") or keys.get("open") or keys.get("from")
+    closes = keys.get("closes") or keys.get("close") or keys.get("to")
+    if opens and closes:
+        return f"{opens}-{closes}"
+    return next((str(keys[key]) for key in HOURS_KEYS if keys.get(key)), "")
+
+
+def opening_hours(value):
+    """Returns a list of (weekday, hours) from the opening hours in a record,
+    either a list of days or a dict with the day as key"""
+    if isinstance(value, dict):
+        return [
+            (day, hours if isinstance(hours, str) else _hours_text(hours))
+            for day, hours in value.items()
+        ]
+    days = []
+    for entry in value if isinstance(value, list) else []:
+        if isinstance(entry, dict):
+            keys = {key.lower(): value for key, value in entry.items()}
+            weekday = next((keys[key] for key in WEEKDAY_KEYS if keys.get(key)), None)
+            if weekday:
+                days.append((str(weekday), _hours_text(entry)))
+        elif isinstance(entry, str) and ":" in entry:
+            # e.g. "Måndag: 08-20"
+            weekday, hours = entry.split(":", 1)
+            days.append((weekday.strip(), hours.strip()))
+    return days
+
+
+def store_fields(record):
+    """The fields of a store in a json record, or None if the
+    record does not look like a store, ie has no name, or neither
+    address nor opening hours"""
+    fields = _flatten(record)
+    if not isinstance(fields.get("name"), str):
+        return None
+    if not (fields.get("address") or fields.get("opening_hours")):
+        return None
+    fields["opening_hours"] = opening_hours(fields.get("opening_hours"))
+    for key in ("url", "address", "zip_code", "city", "lat", "long"):
+        value = fields.get(key)
+        fields[key] = "" if value is None or isinstance(value, (dict, list)) else str(value)
+    return fields
+
+
+def find_stores(data):
+    """Yields the fields of each store in a json response"""
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return
+    if isinstance(data, dict):
+        fields = store_fields(data)
+        if fields:
+            yield fields
+            return
+        data = list(data.values())
+    if isinstance(data, list):
+        for item in data:
+            if isinstance(item, (dict, list)):
+                yield from find_stores(item)
+
+
+def test_find_stores():
+    response = json.dumps(
+        {
+            "region": "Skåne",
+            "pharmacies": [
+                {
+                    "id": 1,
+                    "displayName": "Apotek Hjärtat Ystad",
+                    "pageUrl": "/hitta-apotek-hjartat/skane/apotek_hjartat_ystad/",
+                    "address": {"street": "Stora Östergatan 1", "postalCode": "27134", "city": "Ystad"},
+                    "coordinates": {"latitude": 55.43, "longitude": 13.82},
+                    "openingHours": [
+                        {"dayOfWeek": "Måndag", "opens": "09:00", "closes": "18:00"},
+                        {"dayOfWeek": "Söndag", "closed": True},
+                    ],
+                },
+                {"displayName": "Kampanj", "url": "/kampanj/"},
+                {
+                    "name": "Apotek Hjärtat Malmö",
+                    "streetAddress": "Södergatan 2",
+                    "openingHours": {"Måndag": "08-20", "Tisdag": {"from": "08", "to": "20"}},
+                },
+            ],
+        }
+    )
+    stores = list(find_stores(response))
+    assert len(stores) == 2
+    ystad, malmo = stores
+    assert ystad["url"] == "/hitta-apotek-hjartat/skane/apotek_hjartat_ystad/"
+    assert (ystad["address"], ystad["zip_code"], ystad["city"]) == (
+        "Stora Östergatan 1",
+        "27134",
+        "Ystad",
+    )
+    assert (ystad["lat"], ystad["long"]) == ("55.43", "13.82")
+    assert ystad["opening_hours"] == [("Måndag", "09:00-18:00"), ("Söndag", "Stängt")]
+    assert malmo["opening_hours"] == [("Måndag", "08-20"), ("Tisdag", "08-20")]
+    assert malmo["url"] == ""
+    assert list(find_stores("<html>not json</html>")) == []
@@ -1,6 +1,9 @@
 from pathlib import Path
+import io
+import os
 import json
 from collections import UserDict
+from collections.abc import MutableMapping
 
 
 class JSONShelve(UserDict):
@@ -13,10 +16,13 @@ class JSONShelve(UserDict):
         >>> f.sync()
     """
 
-    def __init__(self, path):
+    def __init__(self, path, save_to=None):
         """Reads data from json-file (if it exists)
-        as a dictionary."""
+        as a dictionary.
+        If save_to is set, the data is saved to that
+        file instead of the one it was read from."""
         self.path = Path(path)
+        self.save_to = Path(save_to) if save_to else self.path
         if self.path.exists() and self.path.is_file():
             # read previous saved file
             with open(path, "r") as f:
@@ -26,8 +32,207 @@ class JSONShelve(UserDict):
 
     def sync(self):
         """Saves all data to json file"""
-        with open(self.path, "w") as f:
+        with open(self.save_to, "w") as f:
             f.write(json.dumps(self.data))
 
     def close(self):
         self.sync()
+
+
+class JSONLogShelve(MutableMapping):
+    """Implements a shelf-like class based on an
+    append-only log of json records. Each call to
+    __setitem__ appends one line to the log file, so
+    saving a new entry never rewrites the older ones.
+
+    The log file ("<name>.jsonl") holds one record per line:
+
+        <json key>\\t<json value>\\n
+
+    The index file ("<name>.jsonl.idx") holds one line per record
+    with the key, the byte offset and the length of the record in
+    the log. Values are read from disc when requested.
+
+        >>> f = JSONLogShelve("path_to_file.jsonl")
+        >>> f["hello"]="world"
+        >>> f.sync()
+
+    A crash loses at most the last, half-written record, which is
+    skipped the next time the file is opened.
+
+    With read_only, e.g. for exporting a cache while a crawl appends to
+    it, the log and its index are never written to.
+    """
+
+    def __init__(self, path, read_only=False):
+        """Opens the log (creating it if needed) and reads the index"""
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self.index = {}  # key -> (offset, length)
+        self.read_only = read_only
+        if self.path.is_file():
+            self._read_index()
+        self._log = self._index_file = None
+        if not read_only:
+            self._log = open(self.path, "ab")
+            self._index_file = open(self.index_path, "a")
+
+    def _read_index(self):
+        """Reads the offsets from the index file. Rebuilds the index
+        from the log if the index file is missing or does not cover
+        the whole log."""
+        log_size = self.path.stat().st_size
+        end_of_indexed_log = 0
+        if self.index_path.is_file():
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        key, offset, length = json.loads(line)
+                    except ValueError:
+                        # half-written index line
+                        break
+                    if offset + length > log_size:
+                        # the record never made it to the log
+                        break
+                    self.index[key] = (offset, length)
+                    end_of_indexed_log = max(end_of_indexed_log, offset + length)
+        if end_of_indexed_log < log_size or not self.index_path.is_file():
+            self._scan_log(end_of_indexed_log)
+            if not self.read_only:
+                self._write_index()
+
+    def _scan_log(self, start):
+        """Indexes the records in the log from byte 'start'"""
+        with open(self.path, "rb") as log:
+            log.seek(start)
+            offset = start
+            for line in log:
+                length = len(line)
+                if not line.endswith(b"\n"):
+                    # half-written record at the end of the log
+                    # it is cut off, so that new records start on a new line
+                    if not self.read_only:
+                        os.truncate(self.path, offset)
+                    break
+                raw_key, _ = line.split(b"\t", 1)
+                self.index[json.loads(raw_key)] = (offset, length)
+                offset += length
+
+    def _write_index(self):
+        """Rewrites the whole index file"""
+        with open(self.index_path, "w") as index_file:
+            for key, (offset, length) in self.index.items():
+                index_file.write(json.dumps([key, offset, length]) + "\n")
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        if self._log:
+            self._log.flush()
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            line = f.read(length)
+        _, raw_value = line.split(b"\t", 1)
+        return json.loads(raw_value)
+
+    def __setitem__(self, key, value):
+        if self.read_only:
+            raise io.UnsupportedOperation(f"{self.path} is opened read-only")
+        # json escapes tabs and newlines, so they only
+        # appear as separators in the log
+        line = (
+            json.dumps(key) + "\t" + json.dumps(value, ensure_ascii=False) + "\n"
+        ).encode("utf-8")
+        offset = self._log.seek(0, os.SEEK_END)
+        self._log.write(line)
+        self._log.flush()
+        self.index[key] = (offset, len(line))
+        self._index_file.write(json.dumps([key, offset, len(line)]) + "\n")
+        self._index_file.flush()
+
+    def __delitem__(self, key):
+        # deletion is not logged, the key is just dropped
+        # from the index of the current session
+        del self.index[key]
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def sync(self):
+        """Forces the appended records to disc"""
+        if self.read_only:
+            return
+        for f in (self._log, self._index_file):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self):
+        """Rewrites the log without the records that have
+        been overwritten by later ones"""
+        self.sync()
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        new_index = {}
+        with open(self.path, "rb") as log, open(tmp_path, "wb") as tmp:
+            for key, (offset, length) in self.index.items():
+                log.seek(offset)
+                new_index[key] = (tmp.tell(), length)
+                tmp.write(log.read(length))
+        self._log.close()
+        self._index_file.close()
+        os.replace(tmp_path, self.path)
+        self.index = new_index
+        self._write_index()
+        self._log = open(self.path, "ab")
+        self._index_file = open(self.index_path, "a")
+
+    def close(self):
+        if self.read_only:
+            return
+        self.sync()
+        self._log.close()
+        self._index_file.close()
+
+
+def test_json_log_shelve(tmp_path):
+    path = tmp_path / "Spider.jsonl"
+    cache = JSONLogShelve(path)
+    cache["https://example.com/a"] = "<html>a</html>"
+    cache["https://example.com/b"] = "<html>b\n\tb</html>"
+    cache["https://example.com/a"] = "<html>å</html>"
+    cache.sync()
+    assert len(cache) == 2
+    assert cache["https://example.com/b"] == "<html>b\n\tb</html>"
+    cache.close()
+    # a crash in the middle of writing a record
+    with open(path, "ab") as log:
+        log.write(b'"https://example.com/c"\t"<ht')
+    cache = JSONLogShelve(path)
+    assert "https://example.com/c" not in cache
+    assert cache["https://example.com/a"] == "<html>å</html>"
+    cache["https://example.com/c"] = "<html>c</html>"
+    cache.compact()
+    cache.close()
+    # the index is rebuilt from the log if it is lost
+    (tmp_path / "Spider.jsonl.idx").unlink()
+    cache = JSONLogShelve(path)
+    assert sorted(cache) == [
+        "https://example.com/a",
+        "https://example.com/b",
+        "https://example.com/c",
+    ]
+    assert cache["https://example.com/c"] == "<html>c</html>"
+    # a reader while the crawl is writing a record
+    with open(path, "ab") as log:
+        log.write(b'"https://example.com/d"\t"<ht')
+    log_size = path.stat().st_size
+    reader = JSONLogShelve(path, read_only=True)
+    assert "https://example.com/d" not in reader
+    assert reader["https://example.com/c"] == "<html>c</html>"
+    reader.close()
+    assert path.stat().st_size == log_size
+    cache.close()
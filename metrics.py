@@ -0,0 +1,188 @@
+"""Counters and timers for a crawl, e.g. how long Firefox took to load
+the pages of a chain, and how many pages came from the cache."""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """The counters and timers of one spider. Safe to use from the
+    fetch worker threads.
+
+        >>> metrics = Metrics("ApoteketSpider")
+        >>> metrics.incr("pages", source="daily_cache")
+        >>> with metrics.timer("parse", url=url):
+        ...     page = ExtractedPage(page_source, FIELDS)
+        >>> metrics.as_dict()
+        {"chain": "ApoteketSpider", "counters": [...], "timers": [...], "urls": {...}}
+
+    Timers given a url are also summed per url.
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.counters = {}  # (name, labels) -> count
+        self.timers = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self.urls = {}  # url -> {timer name: total seconds}
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_time(self, name, seconds, url=None, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            if url:
+                url_timers = self.urls.setdefault(url, {})
+                url_timers[name] = url_timers.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name, url=None, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, url, **labels)
+
+    def as_dict(self):
+        """The metrics as plain data, which can be sent between
+        processes and saved as json"""
+        with self.lock:
+            return {
+                "chain": self.chain,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "timers": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": count,
+                        "seconds": total,
+                        "max_seconds": max_seconds,
+                    }
+                    for (name, labels), (count, total, max_seconds) in sorted(
+                        self.timers.items()
+                    )
+                ],
+                "urls": {url: dict(timers) for url, timers in self.urls.items()},
+            }
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "[" + ",".join(f"{key}={value}" for key, value in labels.items()) + "]"
+
+
+def summary_lines(all_metrics, no_slowest_urls=5):
+    """Returns a human readable summary of the metrics of each chain"""
+    lines = []
+    for metrics in all_metrics:
+        lines.append(f"{metrics['chain']}:")
+        for counter in metrics["counters"]:
+            lines.append(
+                f"    {counter['name']}{_labels_text(counter['labels'])}: {counter['value']}"
+            )
+        for timer in metrics["timers"]:
+            lines.append(
+                f"    {timer['name']}{_labels_text(timer['labels'])}: "
+                f"{timer['seconds']:.1f} s in {timer['count']} calls "
+                f"(max {timer['max_seconds']:.1f} s)"
+            )
+        slowest = sorted(
+            metrics["urls"].items(), key=lambda item: sum(item[1].values()), reverse=True
+        )
+        for url, timers in slowest[:no_slowest_urls]:
+            lines.append(f"    slow: {sum(timers.values()):.1f} s {url}")
+    return lines
+
+
+def _prometheus_labels(chain, labels):
+    labels = dict(chain=chain, **labels)
+    text = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in labels.items()
+    )
+    return "{" + text + "}"
+
+
+def to_prometheus(all_metrics):
+    """The metrics of all chains in Prometheus' text format. The per url
+    timings are left out, they are only in the json export."""
+    # the samples of a metric have to be grouped together
+    types, samples = {}, {}
+    for metrics in all_metrics:
+        chain = metrics["chain"]
+        for counter in metrics["counters"]:
+            name = f"skrapa_{counter['name']}_total"
+            types[name] = "counter"
+            samples.setdefault(name, []).append(
+                f"{name}{_prometheus_labels(chain, counter['labels'])} {counter['value']}"
+            )
+        for timer in metrics["timers"]:
+            name = f"skrapa_{timer['name']}_seconds"
+            types[name] = "summary"
+            labels = _prometheus_labels(chain, timer["labels"])
+            samples.setdefault(name, []).extend(
+                [
+                    f"{name}_sum{labels} {timer['seconds']}",
+                    f"{name}_count{labels} {timer['count']}",
+                ]
+            )
+    lines = []
+    for name, kind in sorted(types.items()):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(all_metrics, path):
+    """Saves the metrics as Prometheus text if path ends with .prom,
+    otherwise as json"""
+    path = Path(path)
+    if path.suffix == ".prom":
+        path.write_text(to_prometheus(all_metrics), encoding="utf-8")
+    else:
+        path.write_text(
+            json.dumps(all_metrics, ensure_ascii=False, indent=1), encoding="utf-8"
+        )
+
+
+def test_metrics(tmp_path):
+    metrics = Metrics("HjartatSpider")
+    for _ in range(3):
+        metrics.incr("pages", source="net")
+    metrics.incr("pages", source="daily_cache")
+    with metrics.timer("wait_condition", url="https://www.apotekhjartat.se/a/"):
+        pass
+    metrics.add_time("wait_condition", 240.0, url="https://www.apotekhjartat.se/b/")
+    metrics.add_time("page_load", 2.0, url="https://www.apotekhjartat.se/b/", via="firefox")
+    data = json.loads(json.dumps(metrics.as_dict()))
+    assert data["counters"][1] == {"name": "pages", "labels": {"source": "net"}, "value": 3}
+    wait = [timer for timer in data["timers"] if timer["name"] == "wait_condition"][0]
+    assert wait["count"] == 2 and wait["max_seconds"] == 240.0
+    assert data["urls"]["https://www.apotekhjartat.se/b/"]["page_load"] == 2.0
+    assert "    slow: 242.0 s https://www.apotekhjartat.se/b/" in summary_lines([data])
+    prometheus = to_prometheus([data])
+    assert "# TYPE skrapa_pages_total counter" in prometheus
+    assert 'skrapa_pages_total{chain="HjartatSpider",source="net"} 3' in prometheus
+    assert 'skrapa_page_load_seconds_count{chain="HjartatSpider",via="firefox"} 1' in prometheus
+    write_metrics([data], tmp_path.joinpath("metrics.json"))
+    assert json.loads(tmp_path.joinpath("metrics.json").read_text())[0]["chain"] == "HjartatSpider"
@@ -4,36 +4,52 @@ Usage:
     ./misc/extract_html_pages_from_cache.py [options] <cache_file> <output_directory>
 
 Options:
-    -h,--help      Help
+    -h,--help                   Help
+    --name-selector=<css>       Css selector of the store name, e.g. "h2.typography-title" for Kronans.
+                                Defaults to the page title.
+    --processes=<n>             No of processes parsing the pages. Defaults to the no of cpus.
+    --manifest=<file>           Remembers the exported pages in <file>, and skips
+                                the pages that have not changed since the last export
 
 Description:
-    Extracts the html pages in a .pickle cache file.
+    Extracts the html pages in a cache file as text files: a daily cache
+    (e.g. cache/2021-03-04/ApoteketSpider.jsonl), a json cache or
+    a legacy .pickle cache.
 
 """
 
 # configs
-from docopt import docopt
+import sys
 from pathlib import Path
-import shelve
-from bs4 import BeautifulSoup
+
+from docopt import docopt
+
+# the export engine is in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from export import export_cache, open_cache
 
 
-def main(cache_file, output_directory):
-    output = Path(output_directory)
-    with shelve.open(cache_file) as cache:
-        for key in cache:
-            try:
-                soup = BeautifulSoup(cache[key])
-                file_name = soup.title.text + ".txt"
-                path = Path.joinpath(output, file_name)
-                with open(path, "w") as page:
-                    print(file_name)
-                    page.write(soup.body.text)
-            except AttributeError:
-                print(f"{key} has no title")
+def main(cache_file, output_directory, name_selector=None, processes=None, manifest=None):
+    cache = open_cache(cache_file)
+    counts = export_cache(
+        cache,
+        output_directory,
+        manifest_path=manifest,
+        name_selector=name_selector,
+        processes=processes,
+    )
+    print(", ".join(f"{no_pages} {result}" for result, no_pages in counts.items()))
+    if hasattr(cache, "close"):
+        cache.close()
 
 
 if __name__ == "__main__":
     arguments = docopt(__doc__)
     # print(arguments)
-    main(arguments["<cache_file>"], arguments["<output_directory>"])
+    main(
+        arguments["<cache_file>"],
+        arguments["<output_directory>"],
+        name_selector=arguments["--name-selector"],
+        processes=int(arguments["--processes"]) if arguments["--processes"] else None,
+        manifest=arguments["--manifest"],
+    )
@@ -8,7 +8,7 @@ OPTIONS:
     --export-cache=<dir>        Includes the downloaded html text files in <dir> as zipped archive
 
 DESCRIPTION:
-    Sends the xlsx files in output <directory> to the email adresses listed in the .secrets file.
+    Sends the output files (xlsx, csv or parquet) in output <directory> to the email adresses listed in the .secrets file.
     The 'error.log' file in <directory> is appended to the message body.
 
 CONFIGURATION:
@@ -110,7 +110,11 @@ if __name__ == "__main__":
     if not folder_to_send.is_dir():
         raise FileNotFoundError(f"{folder_to_send} is not a valid directory")
     else:
-        files_to_send = list(folder_to_send.glob("*.xlsx"))
+        files_to_send = [
+            path
+            for suffix in ("xlsx", "csv", "parquet")
+            for path in folder_to_send.glob(f"*.{suffix}")
+        ]
         if arguments["--export-cache"]:
             exported_cache_dir = Path(arguments["--export-cache"])
             if exported_cache_dir.is_dir():
@@ -0,0 +1,225 @@
+"""Writers for the scraped rows. The rows are written one at a time,
+so the memory use does not grow with the number of stores."""
+import csv
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # parquet output is optional
+    pyarrow = None
+
+# the columns of the output, in order
+ROW_FIELDS = (
+    "chain",
+    "url",
+    "store_name",
+    "long",
+    "lat",
+    "address",
+    "zip_code",
+    "city",
+    "datetime",
+    "weekday",
+    "weekday_no",
+    "hours",
+    "mq_street",
+    "mq_zip_code",
+    "mq_lat",
+    "mq_long",
+    # where the mq_* fields came from, and the failed cross-checks
+    "geo_source",
+    "geo_check",
+    # the normalized opening hours, see hours.py
+    "day_no",
+    "open_minutes",
+    "close_minutes",
+    "closed",
+    "open_24h",
+    "deviating",
+)
+
+
+class RowWriter(object):
+    """Writes rows (dicts) to a file with a fixed set of columns.
+    Keys that are not in 'fields' are ignored and missing keys
+    are left empty.
+
+        >>> with CsvRowWriter("output/apoteket.csv") as writer:
+        ...     for row in spider.scrape():
+        ...         writer.write(row)
+    """
+
+    def __init__(self, path, fields=ROW_FIELDS):
+        self.path = str(path)
+        self.fields = tuple(fields)
+        self.no_rows = 0
+
+    def values(self, row):
+        return [row.get(field) for field in self.fields]
+
+    def write(self, row):
+        self.no_rows += 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class XlsxRowWriter(RowWriter):
+    """Uses openpyxl's write-only mode, which streams the rows to a
+    temporary file instead of keeping the whole workbook in memory"""
+
+    def __init__(self, path, fields=ROW_FIELDS):
+        super().__init__(path, fields)
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(self.fields)
+
+    def write(self, row):
+        super().write(row)
+        self.sheet.append(self.values(row))
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class CsvRowWriter(RowWriter):
+    """Each row is flushed to disk as soon as it is written"""
+
+    def __init__(self, path, fields=ROW_FIELDS):
+        super().__init__(path, fields)
+        self.file = open(self.path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.fields)
+
+    def write(self, row):
+        super().write(row)
+        self.writer.writerow(self.values(row))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetRowWriter(RowWriter):
+    """Writes a row group for each ROW_GROUP_SIZE rows. All columns are
+    strings, since e.g. 'lat' holds an error message on failed pages.
+    Requires pyarrow."""
+
+    ROW_GROUP_SIZE = 1000
+
+    def __init__(self, path, fields=ROW_FIELDS):
+        if pyarrow is None:
+            raise ImportError("Writing parquet files requires pyarrow")
+        super().__init__(path, fields)
+        self.schema = pyarrow.schema([(field, pyarrow.string()) for field in self.fields])
+        self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self.held_rows = []
+
+    def values(self, row):
+        return [None if value is None else str(value) for value in super().values(row)]
+
+    def write(self, row):
+        super().write(row)
+        self.held_rows.append(self.values(row))
+        if len(self.held_rows) >= self.ROW_GROUP_SIZE:
+            self.write_row_group()
+
+    def write_row_group(self):
+        columns = list(zip(*self.held_rows)) or [[] for _ in self.fields]
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(
+                [pyarrow.array(column, pyarrow.string()) for column in columns],
+                schema=self.schema,
+            )
+        )
+        self.held_rows = []
+
+    def close(self):
+        if self.held_rows:
+            self.write_row_group()
+        self.writer.close()
+
+
+WRITERS = {
+    "xlsx": XlsxRowWriter,
+    "csv": CsvRowWriter,
+    "parquet": ParquetRowWriter,
+}
+
+
+def available_formats():
+    """The output formats that can be written with the installed modules"""
+    return [fmt for fmt in WRITERS if fmt != "parquet" or pyarrow is not None]
+
+
+def open_writer(path, output_format="xlsx", fields=ROW_FIELDS):
+    """Returns a writer for the format, e.g. 'csv'"""
+    return WRITERS[output_format](path, fields)
+
+
+def write_rows(rows, path, output_format="xlsx", fields=ROW_FIELDS):
+    """Writes all the rows to path. Returns the number of rows."""
+    with open_writer(path, output_format, fields) as writer:
+        for row in rows:
+            writer.write(row)
+    return writer.no_rows
+
+
+def read_rows(path):
+    """Yields the rows of a file written by one of the writers,
+    one dict at a time. The format is taken from the file suffix."""
+    suffix = Path(path).suffix
+    if suffix == ".csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+    elif suffix == ".parquet":
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        workbook = load_workbook(path, read_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        for values in rows:
+            # empty cells at the end of a row are left out
+            values = tuple(values) + (None,) * (len(header) - len(values))
+            yield dict(zip(header, values))
+        workbook.close()
+
+
+def test_row_writers(tmp_path):
+    rows = [
+        {
+            "chain": "Apoteket",
+            "url": f"https://www.apoteket.se/apotek/{n}/",
+            "weekday": "Måndag",
+            "weekday_no": 0,
+            "hours": "09-18",
+            "geo_query": "not an output column",
+        }
+        for n in range(5)
+    ]
+    for output_format in available_formats():
+        path = tmp_path.joinpath(f"apoteket.{output_format}")
+        writer = open_writer(path, output_format)
+        if output_format == "parquet":
+            writer.ROW_GROUP_SIZE = 2
+        with writer:
+            for row in rows:
+                writer.write(row)
+        read_back = list(read_rows(path))
+        assert writer.no_rows == 5
+        assert len(read_back) == 5
+        assert tuple(read_back[0]) == ROW_FIELDS
+        assert read_back[4]["url"] == "https://www.apoteket.se/apotek/4/"
+        assert read_back[4]["weekday"] == "Måndag"
+        assert read_back[4]["store_name"] in (None, "")
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    ./pagestore.py [options] <cache_directory>
+
+Options:
+    -h,--help      Help
+
+Description:
+    Compressed, content-addressed storage of the page bodies.
+
+    The page caches (the daily cache and the persistent page store) keep a
+    reference to the body instead of the body itself. The bodies of a chain
+    are kept once each in a pack file, cache/bodies/<Chain>.pack, however
+    many days and urls they were seen on. Bodies are compressed with zstd
+    and a dictionary trained on the chain's own pages if the zstandard
+    package is installed, otherwise with gzip.
+
+    Run as a script, it converts the page caches in <cache_directory>
+    (e.g. cache) written before the bodies were split out.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from loguru import logger
+
+from jsonshelve import JSONLogShelve
+
+
+class BodyStore(object):
+    """An append-only pack of compressed bodies, addressed by the
+    sha256 digest of the body.
+
+        >>> bodies = BodyStore("cache/bodies", "ApoteketSpider")
+        >>> digest = bodies.add("<html>...</html>")
+        >>> bodies[digest]
+        "<html>...</html>"
+
+    Each record in the pack is a header line followed by the compressed body:
+
+        <digest> <codec> <length>\\n<compressed body>
+
+    The index file ("<Chain>.pack.idx") holds one json line per record with
+    the digest, the codec, and the offset and length of the compressed body.
+    It is rebuilt from the pack if it does not cover the whole pack.
+
+    With read_only, e.g. for exporting a cache while a crawl appends to the
+    pack, the pack and its index are never written to: records that are not
+    in the index yet are indexed in memory, and a half-written record at the
+    end of the pack is left alone.
+    """
+
+    GZIP_LEVEL = 6
+    ZSTD_LEVEL = 10
+    # a zstd dictionary is trained once this many bodies are stored
+    TRAIN_AFTER = 100
+    DICTIONARY_SIZE = 110 * 1024
+
+    def __init__(self, directory, name, use_zstd=True, read_only=False):
+        self.directory = Path(directory)
+        self.read_only = read_only
+        if not self.directory.is_dir() and not read_only:
+            self.directory.mkdir(parents=True)
+        self.name = name
+        self.path = Path.joinpath(self.directory, f"{name}.pack")
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self.index = {}  # digest -> (codec, offset, length)
+        self.lock = threading.Lock()
+        if self.path.is_file():
+            self._read_index()
+        self._pack = self._index_file = None
+        if not read_only:
+            self._pack = open(self.path, "ab")
+            self._index_file = open(self.index_path, "a")
+        self.use_zstd = use_zstd and zstandard is not None
+        self.dictionaries = {}  # dictionary id -> zstandard.ZstdCompressionDict
+        self.dictionary_id = None  # the one new bodies are compressed with
+        self.training = False
+        if self.use_zstd:
+            self._read_dictionaries()
+
+    def _read_index(self):
+        pack_size = self.path.stat().st_size
+        end_of_indexed_pack = 0
+        if self.index_path.is_file():
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        digest, codec, offset, length = json.loads(line)
+                    except ValueError:
+                        # half-written index line
+                        break
+                    if offset + length > pack_size:
+                        break
+                    self.index[digest] = (codec, offset, length)
+                    end_of_indexed_pack = max(end_of_indexed_pack, offset + length)
+        if end_of_indexed_pack < pack_size or not self.index_path.is_file():
+            self._scan_pack(end_of_indexed_pack)
+            if self.read_only:
+                return
+            with open(self.index_path, "w") as index_file:
+                for digest, (codec, offset, length) in self.index.items():
+                    index_file.write(json.dumps([digest, codec, offset, length]) + "\n")
+
+    def _scan_pack(self, start):
+        """Indexes the records in the pack from byte 'start'"""
+        pack_size = self.path.stat().st_size
+        with open(self.path, "rb") as pack:
+            pack.seek(start)
+            while True:
+                record_start = pack.tell()
+                header = pack.readline()
+                if not header:
+                    break
+                try:
+                    digest, codec, length = header.decode("ascii").split()
+                    length = int(length)
+                except ValueError:
+                    length = None
+                if length is None or pack.tell() + length > pack_size:
+                    # half-written record at the end of the pack, or
+                    # one that is being written when read_only
+                    if not self.read_only:
+                        os.truncate(self.path, record_start)
+                    break
+                self.index[digest] = (codec, pack.tell(), length)
+                pack.seek(length, os.SEEK_CUR)
+
+    def _read_dictionaries(self):
+        """Reads the zstd dictionaries trained so far. The newest is
+        used for new bodies, the older ones for the bodies they compressed."""
+        paths = self.directory.glob(f"{self.name}.*.zdict")
+        for path in sorted(paths, key=lambda path: path.stat().st_mtime):
+            dictionary_id = path.suffixes[-2].lstrip(".")
+            self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(
+                path.read_bytes()
+            )
+            self.dictionary_id = dictionary_id
+
+    def train_dictionary(self):
+        """Trains a zstd dictionary on the bodies stored so far"""
+        samples = [self[digest].encode("utf-8") for digest in list(self.index)[-1000:]]
+        try:
+            dictionary = zstandard.train_dictionary(self.DICTIONARY_SIZE, samples)
+        except zstandard.ZstdError as training_error:
+            logger.warning(f"Could not train a zstd dictionary for {self.name}: {training_error}")
+            return
+        dictionary_id = str(dictionary.dict_id())
+        Path.joinpath(self.directory, f"{self.name}.{dictionary_id}.zdict").write_bytes(
+            dictionary.as_bytes()
+        )
+        self.dictionaries[dictionary_id] = dictionary
+        self.dictionary_id = dictionary_id
+        logger.info(f"Trained a zstd dictionary for {self.name} on {len(samples)} pages")
+
+    def compress(self, data):
+        """Returns the codec and the compressed data"""
+        if not self.use_zstd:
+            return "gzip", gzip.compress(data, self.GZIP_LEVEL)
+        if self.dictionary_id is None:
+            return "zstd", zstandard.ZstdCompressor(level=self.ZSTD_LEVEL).compress(data)
+        compressor = zstandard.ZstdCompressor(
+            level=self.ZSTD_LEVEL, dict_data=self.dictionaries[self.dictionary_id]
+        )
+        return f"zstd:{self.dictionary_id}", compressor.compress(data)
+
+    def decompress(self, codec, data):
+        if codec == "gzip":
+            return gzip.decompress(data)
+        if zstandard is None:
+            raise RuntimeError(f"{self.path} holds zstd compressed pages, install zstandard")
+        _, _, dictionary_id = codec.partition(":")
+        if dictionary_id:
+            if dictionary_id not in self.dictionaries:
+                self._read_dictionaries()
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=self.dictionaries[dictionary_id]
+            )
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress(data)
+
+    def add(self, body):
+        """Stores the body, unless an identical body is already
+        stored. Returns its digest."""
+        if self.read_only:
+            raise io.UnsupportedOperation(f"{self.path} is opened read-only")
+        data = body.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.index:
+                return digest
+            codec, compressed = self.compress(data)
+            offset = self._pack.seek(0, os.SEEK_END)
+            header = f"{digest} {codec} {len(compressed)}\n".encode("ascii")
+            self._pack.write(header + compressed)
+            self._pack.flush()
+            self.index[digest] = (codec, offset + len(header), len(compressed))
+            self._index_file.write(
+                json.dumps([digest, codec, offset + len(header), len(compressed)]) + "\n"
+            )
+            self._index_file.flush()
+            train = (
+                self.use_zstd
+                and self.dictionary_id is None
+                and not self.training
+                and len(self.index) >= self.TRAIN_AFTER
+            )
+            if train:
+                self.training = True
+        if train:
+            self.train_dictionary()
+            self.training = False
+        return digest
+
+    def __getitem__(self, digest):
+        codec, offset, length = self.index[digest]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return self.decompress(codec, data).decode("utf-8")
+
+    def __contains__(self, digest):
+        return digest in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def sync(self):
+        if self.read_only:
+            return
+        with self.lock:
+            for f in (self._pack, self._index_file):
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        if self.read_only:
+            return
+        self.sync()
+        self._pack.close()
+        self._index_file.close()
+
+
+class CompressedPages(MutableMapping):
+    """A page cache (e.g. a JSONLogShelve) whose bodies are kept in a
+    BodyStore. A page is either the page source or, in the persistent
+    page store, a dict with the page source as "body". Either way only
+    the digest of the body is written to the cache.
+
+        >>> cache = CompressedPages(JSONLogShelve("cache/2021-03-04/ApoteketSpider.jsonl"), bodies)
+        >>> cache[url] = page_source
+
+    Caches written before the bodies were split out are read as before.
+    """
+
+    def __init__(self, pages, bodies):
+        self.pages = pages
+        self.bodies = bodies
+
+    def __getitem__(self, key):
+        value = self.pages[key]
+        if isinstance(value, dict):
+            if "body_sha256" in value:
+                value = dict(value)
+                value["body"] = self.bodies[value.pop("body_sha256")]
+            elif "sha256" in value and len(value) == 1:
+                value = self.bodies[value["sha256"]]
+        return value
+
+    def digest(self, key):
+        """The digest of a page's body, without reading the body.
+        None for pages written before the bodies were split out."""
+        value = self.pages[key]
+        if isinstance(value, dict):
+            return value.get("body_sha256") or value.get("sha256")
+        return None
+
+    def __setitem__(self, key, value):
+        if isinstance(value, str):
+            value = {"sha256": self.bodies.add(value)}
+        elif isinstance(value, dict) and isinstance(value.get("body"), str):
+            value = dict(value)
+            value["body_sha256"] = self.bodies.add(value.pop("body"))
+        self.pages[key] = value
+
+    def __delitem__(self, key):
+        del self.pages[key]
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, key):
+        return key in self.pages
+
+    def sync(self):
+        # the bodies first, so that a reference is never
+        # on disc before the body it points to
+        self.bodies.sync()
+        self.pages.sync()
+
+    def close(self):
+        self.bodies.sync()
+        self.pages.close()
+
+
+def convert_cache(path, bodies):
+    """Rewrites a page cache (.jsonl) with its bodies moved to 'bodies'.
+    Returns the no of bytes saved."""
+    path = Path(path)
+    size_before = path.stat().st_size
+    old_cache = JSONLogShelve(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    new_cache = CompressedPages(JSONLogShelve(tmp_path), bodies)
+    for key in old_cache:
+        new_cache[key] = old_cache[key]
+    new_cache.close()
+    old_cache.close()
+    os.replace(tmp_path, path)
+    os.replace(tmp_path.with_name(tmp_path.name + ".idx"), path.with_name(path.name + ".idx"))
+    return size_before - path.stat().st_size
+
+
+def test_compressed_pages(tmp_path):
+    bodies = BodyStore(tmp_path, "ApoteketSpider", use_zstd=False)
+    page = "<html><head>" + "<script>var x = 1;</script>" * 200 + "</head>å</html>"
+    day1 = CompressedPages(JSONLogShelve(tmp_path / "day1.jsonl"), bodies)
+    day2 = CompressedPages(JSONLogShelve(tmp_path / "day2.jsonl"), bodies)
+    day1["https://www.apoteket.se/apotek/a/"] = page
+    day2["https://www.apoteket.se/apotek/a/"] = page
+    day2["https://www.apoteket.se/apotek/b/"] = page.replace("å", "ä")
+    store = CompressedPages(JSONLogShelve(tmp_path / "pages.jsonl"), bodies)
+    store["https://www.apoteket.se/apotek/a/"] = {"body": page, "etag": '"v1"'}
+    # an old cache entry, before the bodies were split out
+    store.pages["https://www.apoteket.se/apotek/c/"] = {"body": "<html>c</html>"}
+    assert len(bodies) == 2  # the same body is stored once
+    assert bodies.path.stat().st_size < len(page)
+    assert day2["https://www.apoteket.se/apotek/a/"] == page
+    assert store["https://www.apoteket.se/apotek/a/"] == {"body": page, "etag": '"v1"'}
+    assert store["https://www.apoteket.se/apotek/c/"]["body"] == "<html>c</html>"
+    for cache in (day1, day2, store):
+        cache.close()
+    bodies.close()
+    # a crash in the middle of writing a body, and a lost index
+    with open(bodies.path, "ab") as pack:
+        pack.write(b"0123 gzip 1000\n\x1f\x8b")
+    bodies.index_path.unlink()
+    bodies = BodyStore(tmp_path, "ApoteketSpider", use_zstd=False)
+    assert len(bodies) == 2
+    day2 = CompressedPages(JSONLogShelve(tmp_path / "day2.jsonl"), bodies)
+    assert day2["https://www.apoteket.se/apotek/b/"] == page.replace("å", "ä")
+    bodies.close()
+
+
+def test_read_only_body_store(tmp_path):
+    bodies = BodyStore(tmp_path, "ApoteketSpider", use_zstd=False)
+    digest = bodies.add("<html>a</html>")
+    bodies.sync()
+    # a crawl is writing a body, which is not in the index yet
+    with open(bodies.path, "ab") as pack:
+        pack.write(b"0123 gzip 1000\n\x1f\x8b")
+    pack_size, index = bodies.path.stat().st_size, bodies.index_path.read_bytes()
+    reader = BodyStore(tmp_path, "ApoteketSpider", use_zstd=False, read_only=True)
+    assert reader[digest] == "<html>a</html>" and len(reader) == 1
+    reader.close()
+    assert bodies.path.stat().st_size == pack_size
+    assert bodies.index_path.read_bytes() == index
+    bodies.close()
+    assert not BodyStore(tmp_path.joinpath("none"), "X", read_only=True).index
+    assert not tmp_path.joinpath("none").exists()
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    cache_directory = Path(arguments["<cache_directory>"])
+    chains = {}  # the bodies of each chain
+    # the daily caches, e.g. cache/2021-03-04/ApoteketSpider.jsonl,
+    # and the persistent page store, cache/pages/ApoteketSpider.jsonl
+    for path in sorted(cache_directory.glob("*/*Spider.jsonl")):
+        chain = path.stem
+        if chain not in chains:
+            chains[chain] = BodyStore(Path.joinpath(cache_directory, "bodies"), chain)
+        saved = convert_cache(path, chains[chain])
+        logger.info(f"Converted {path}, {saved / 2**20:.1f} MB smaller")
+    for bodies in chains.values():
+        bodies.close()
@@ -0,0 +1,130 @@
+"""Streaming reader for xml sitemaps."""
+import gzip
+import io
+import re
+
+from lxml import etree
+
+# used when the xml is too broken for the parser
+LOC_REGEX = re.compile(rb"<loc>\s*(.*?)\s*</loc>", re.DOTALL)
+
+
+def _localname(element):
+    return etree.QName(element).localname
+
+
+def _read_entry(element):
+    """Returns the <loc> and <lastmod> of a <url> or <sitemap> element"""
+    loc, lastmod = None, None
+    for child in element:
+        if not isinstance(child.tag, str):
+            # comment or processing instruction
+            continue
+        name = _localname(child)
+        if name == "loc" and child.text:
+            loc = child.text.strip()
+        elif name == "lastmod" and child.text:
+            lastmod = child.text.strip()
+    return loc, lastmod
+
+
+def iter_sitemap(source, predicate=None, fetch=None, sitemap_predicate=None):
+    """Yields (loc, lastmod) pairs from a sitemap, one <url> at a time,
+    without building a tree of the whole document.
+
+        * source is the sitemap as bytes or str, gzipped or not.
+        * predicate(loc) filters the urls, e.g. to only yield store pages.
+        * fetch(loc) returns the source of another sitemap. If it is set,
+          the sitemaps listed in a sitemap index are read recursively,
+          otherwise the (loc, lastmod) of the listed sitemaps are yielded.
+        * sitemap_predicate(loc) filters the sitemaps in a sitemap index.
+
+        >>> for url, lastmod in iter_sitemap(xml, lambda url: "/apotek/" in url):
+        ...     print(url, lastmod)
+    """
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if source[:2] == b"\x1f\x8b":
+        source = gzip.decompress(source)
+    entries = etree.iterparse(
+        io.BytesIO(source), events=("end",), recover=True, resolve_entities=False
+    )
+    yielded = set()
+    no_entries = 0
+    try:
+        for _, element in entries:
+            if not isinstance(element.tag, str):
+                continue
+            name = _localname(element)
+            if name not in ("url", "sitemap"):
+                continue
+            loc, lastmod = _read_entry(element)
+            # free the memory used by the entries we have already read
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if not loc:
+                continue
+            no_entries += 1
+            if name == "sitemap":
+                if sitemap_predicate and not sitemap_predicate(loc):
+                    continue
+                if fetch:
+                    child_source = fetch(loc)
+                    if child_source:
+                        yield from iter_sitemap(
+                            child_source, predicate, fetch, sitemap_predicate
+                        )
+                    continue
+            elif predicate and not predicate(loc):
+                continue
+            yielded.add(loc)
+            yield loc, lastmod
+    except etree.XMLSyntaxError:
+        no_entries = 0
+    if no_entries == 0:
+        # the parser choked on the sitemap,
+        # we fall back to finding the urls with plain regex
+        for match in LOC_REGEX.finditer(source):
+            loc = match.group(1).decode("utf-8").replace("&amp;", "&")
+            if loc not in yielded and (not predicate or predicate(loc)):
+                yield loc, None
+
+
+def test_iter_sitemap():
+    index = b"""<?xml version="1.0" encoding="UTF-8"?>
+    <sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+      <sitemap><loc>https://www.example.se/sitemap-products.xml</loc></sitemap>
+      <sitemap><loc>https://www.example.se/sitemap-stores.xml.gz</loc>
+        <lastmod>2021-03-01</lastmod></sitemap>
+    </sitemapindex>"""
+    stores = gzip.compress(
+        """<?xml version="1.0" encoding="UTF-8"?>
+        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+          <url><loc>https://www.example.se/apotek/stockholm/</loc></url>
+          <url><loc>https://www.example.se/apotek/göteborg/?lat=57.7&amp;long=11.9</loc>
+            <lastmod>2021-03-04T10:00:00+01:00</lastmod></url>
+          <url><loc>https://www.example.se/produkt/alvedon/</loc></url>
+        </urlset>""".encode(
+            "utf-8"
+        )
+    )
+    sources = {"https://www.example.se/sitemap-stores.xml.gz": stores}
+    assert list(iter_sitemap(index)) == [
+        ("https://www.example.se/sitemap-products.xml", None),
+        ("https://www.example.se/sitemap-stores.xml.gz", "2021-03-01"),
+    ]
+    urls = iter_sitemap(
+        index, predicate=lambda url: "/apotek/" in url, fetch=sources.get
+    )
+    assert list(urls) == [
+        ("https://www.example.se/apotek/stockholm/", None),
+        (
+            "https://www.example.se/apotek/göteborg/?lat=57.7&long=11.9",
+            "2021-03-04T10:00:00+01:00",
+        ),
+    ]
+    broken = b"<sitemapindex><sitemap><loc>https://www.example.se/a.xml</loc>"
+    assert list(iter_sitemap(b"<<" + broken)) == [
+        ("https://www.example.se/a.xml", None)
+    ]
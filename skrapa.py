@@ -17,6 +17,18 @@ Options:
     --exec=<cmd>                          Executes <cmd>+cache+output, e.g. 'foo {} {}', afterwards.
     --keep-open                           Keeps FireFox open after scraping
     --export-cache=<dir>                  Exports the cache to separate text files in <dir>
+    --parallel=<n>                        Scrapes up to <n> chains at once in separate processes [default: 1]
+    --fetch-workers=<k>                   Fetches up to <k> store pages at once per chain [default: 1]
+    --rate-limit=<r>                      Max requests per second to each web server
+    --revalidate                          Reuses pages from previous days that have not been modified
+    --replay=<date>                       Re-extracts the output of <date> (e.g. 2021-03-04) from its cache, offline
+    --offline                             Never fetches from the net, fails on pages that are not in the cache
+    --format=<fmt>                        Output format: xlsx, csv or parquet [default: xlsx]
+    --diff                                Only writes the stores that have changed since the previous run
+    --metrics=<file>                      Saves timings and counters to <file>, as json or Prometheus text (*.prom)
+    --browser-pool=<dir>                  Attaches to long-lived Firefox instances in <dir>, see browserpool.py
+    --browser-pool-size=<n>               Max no of Firefox instances in the pool [default: 4]
+    --resume                              Continues the runs of the day where they stopped, see checkpoint.py
 
 Description:
     A set of scripts for retrieving opening hours from all the major pharmacy chains in Sweden.
@@ -53,50 +65,62 @@ Description:
 
 from docopt import docopt
 import sys
+import gzip
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import (
+    TimeoutException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+    WebDriverException,
+)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 
 import urllib.parse as p
 from bs4 import BeautifulSoup
 import time
-from datetime import datetime
-import petl as etl
+from datetime import datetime, timedelta, timezone
 import re
 import requests
 import configparser
 from pathlib import Path
 from loguru import logger
 import subprocess
-
-from jsonshelve import JSONShelve
-
-WEEKDAYS = {
-    "måndag": "1",
-    "tisdag": "2",
-    "onsdag": "3",
-    "torsdag": "4",
-    "fredag": "5",
-    "lördag": "6",
-    "söndag": "7",
-    "mån-fre": "1,2,3,4,5",
-    "må": "1",
-    "ti": "2",
-    "on": "3",
-    "to": "4",
-    "fr": "5",
-    "lö": "6",
-    "sö": "7",
-    "lördag-söndag": "6,7",
-    "måndag-tisdag": "1,2",
-    "måndag-onsdag": "1,2,3",
-    "måndag-torsdag": "1,2,3,4",
-    "måndag-fredag": "1,2,3,4,5",
-    "måndag-lördag": "1,2,3,4,5,6",
-    "måndag-söndag": "1,2,3,4,5,6,7",
-}
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from jsonshelve import JSONShelve, JSONLogShelve
+from fetching import HostRateLimiter
+from geocoding import MapQuestGeocoder
+# separate_zip_from_city and ZIPCODE are shared with the geo cache,
+# which needs them for its canonical addresses
+from geocache import (
+    ZIPCODE,
+    GeoCache,
+    Location,
+    address_key,
+    distance_m,
+    latlng_key,
+    location_from_response,
+    page_coordinates,
+    separate_zip_from_city,
+    zip_mismatch,
+)
+from sitemaps import iter_sitemap
+from extract import ExtractedPage, css, text_of, xpath
+from frontier import CrawlFrontier, normalize_url
+from output import available_formats, open_writer, read_rows, write_rows
+from stores import Store, iter_rows
+from hours import WEEKDAYS, normalize_stores
+from history import HistoryStore
+from metrics import Metrics, summary_lines, write_metrics
+from jsonapi import XHR_URLS_SCRIPT, find_stores
+from browser import PROFILES as BROWSER_PROFILES, firefox_options
+from browserpool import BrowserPool
+from pagestore import BodyStore, CompressedPages
+from export import export_cache, store_name
+from checkpoint import Checkpoint
 
 
 def weekday_text_to_int(txt, weekdaynow=None):
@@ -135,20 +159,6 @@ def test_weekday_text_to_int():
     assert output3 == WEEKDAYS
 
 
-ZIPCODE = re.compile(r"([0-9]{3}\s{0,1}[0-9]{2}\s{0,1})")
-
-
-def separate_zip_from_city(txt):
-    """Separates postal code from city"""
-    zip_code = ZIPCODE.findall(txt)
-    if zip_code:
-        zip_code = zip_code[0].replace(" ", "").strip()
-    else:
-        zip_code = None
-    city = ZIPCODE.sub("", txt).strip()
-    return zip_code, city
-
-
 def test_separate_zip_from_city():
     examples = (
         ("19272 Sollentuna", "19272", "Sollentuna"),
@@ -167,6 +177,37 @@ def test_separate_zip_from_city():
         assert c == city
 
 
+def parse_lastmod(txt):
+    """Converts a sitemap <lastmod> date to a local datetime without time zone.
+    Raises ValueError if it is not a date."""
+    txt = txt.strip()
+    # before Python 3.11, fromisoformat reads neither "Z", time zones
+    # without a colon nor fractions of a second other than 3 or 6 digits
+    txt = re.sub(r"[zZ]$", "+00:00", txt)
+    txt = re.sub(r"(T[\d:.]+[+-]\d{2})(\d{2})$", r"\1:\2", txt)
+    txt = re.sub(r"\.(\d+)", lambda match: "." + match.group(1)[:6].ljust(6, "0"), txt)
+    lastmod = datetime.fromisoformat(txt)
+    if lastmod.tzinfo:
+        lastmod = lastmod.astimezone().replace(tzinfo=None)
+    return lastmod
+
+
+def test_parse_lastmod():
+    assert parse_lastmod("2021-03-04") == datetime(2021, 3, 4)
+    assert parse_lastmod(" 2021-03-04T10:00:00 ") == datetime(2021, 3, 4, 10)
+    utc = parse_lastmod("2021-03-04T10:00:00+00:00")
+    assert utc == datetime(2021, 3, 4, 10, tzinfo=timezone.utc).astimezone().replace(
+        tzinfo=None
+    )
+    assert parse_lastmod("2021-03-04T10:00:00Z") == utc
+    assert parse_lastmod("2021-03-04T11:00:00+0100") == utc
+    assert parse_lastmod("2021-03-04T10:00:00.5Z") == utc + timedelta(microseconds=500000)
+    try:
+        parse_lastmod("yesterday")
+    except ValueError:
+        pass
+    else:
+        assert False, "not a date"
 
 
 class ScrapeFailure(Exception):
@@ -179,11 +220,34 @@ class ScrapeFailure(Exception):
 
 class MySpider(object):
     WAIT_TIME = 1  # sec pause between each url
+    RATE_LIMIT = None  # requests per sec and host, overrides WAIT_TIME
+    # urls matching these patterns are fetched with plain http requests
+    # instead of Firefox, unless we have to wait for a part of the page to load
+    HTTP_URL_PATTERNS = [re.compile(r"\.xml(\.gz)?($|\?)")]  # sitemaps
     START_URLS = []
-    VISITED_PAGES = []
-    NO_VISITED_PAGES = 0
-    NO_OK_PAGES = 0
     LIMIT_SCRAPING_FAILURE = 0.05  # if more than 5% of pages fail, raise error
+    IMPLICIT_WAIT = 60  # sec Firefox waits for a page element to show up
+    GEOCODING_BATCH_SIZE = MapQuestGeocoder.BATCH_SIZE
+    # where the geo-location of a store is taken from, in order:
+    # "page" the coordinates on the store page, "cache" the geo cache,
+    # "net" MapQuest. Overridden by the [geo_precedence] config section
+    GEO_PRECEDENCE = ("page", "cache", "net")
+    # finds the postal code of stores with coordinates but no postal code
+    REVERSE_GEOCODE = True
+    # page coordinates further than this from the geo-located
+    # address (meters) are flagged in geo_check
+    MAX_GEO_DISTANCE = 1000
+    # the compiled selectors for the fields on a store page,
+    # declared by each child class, see extract_fields
+    FIELDS = {}
+    CACHE_TTL_HOURS = 0  # pages from previous days are reused for this long
+    # the store name on a store page, used when exporting the cache.
+    # None uses the page title
+    STORE_NAME_SELECTOR = None
+    # the Firefox settings in browser.PROFILES, e.g. "fast" leaves out
+    # images and third-party scripts. A chain is only switched to "fast"
+    # once its pages have been checked to parse without them
+    BROWSER_PROFILE = "default"
 
     def __init__(
         self,
@@ -194,18 +258,49 @@ class MySpider(object):
         headless=False,
         ignore_errors_when_parsing_info_page=False,
         export_cache_to_directory=None,
+        geckodriver_log_name="geckodriver.log",
+        fetch_workers=1,
+        rate_limit=None,
+        revalidate=False,
+        cache_date=None,
+        offline=False,
+        history_path=None,
+        only_changes=False,
+        browser_pool=None,
+        browser_pool_size=4,
+        resume=False,
     ):
+        """
+        * geckodriver_log_name is the name of the geckodriver log file, which
+          has to be unique when several spiders run at the same time.
+        * fetch_workers is the number of Firefox instances that fetch store pages
+          at the same time.
+        * rate_limit is the max number of requests per second to each host.
+          Defaults to RATE_LIMIT, or one request per WAIT_TIME seconds.
+        * revalidate reuses pages from previous days that have not been modified,
+          according to conditional http requests or the sitemap's <lastmod>.
+        * cache_date, e.g. "2021-03-04", reads the daily cache of that day
+          instead of today's.
+        * offline forbids cache misses, ie pages and geo-locations are only
+          read from the caches and Firefox is never started.
+        * history_path is the SQLite database where a snapshot of each
+          store is saved, see history.py.
+        * only_changes leaves out the stores that have not changed since
+          their last snapshot in the history.
+        * browser_pool is the directory of a pool of long-lived Firefox
+          instances, see browserpool.py. Firefox is then only started if
+          all instances in the pool are in use.
+        * resume continues from the checkpoint of the day's previous run,
+          see checkpoint.py. Otherwise the checkpoint is started over.
+          Offline runs and replays (cache_date) do not save a checkpoint.
+        """
         self.quit_when_finished = quit_when_finished
+        # per-instance crawl statistics and seen store urls
+        self.frontier = CrawlFrontier()
+        self.NO_VISITED_PAGES = 0
+        self.NO_OK_PAGES = 0
+        self.metrics = Metrics(self.__class__.__name__)
         self.ignore_errors_when_parsing_info_page = ignore_errors_when_parsing_info_page
-        #####################
-        ## Firefox options ##
-        #####################
-        options = webdriver.FirefoxOptions()
-        #allow prompting for geo-location
-        options.set_preference("geo.prompt.testing", True)
-        #automatically deny requests for geo-location
-        options.set_preference("geo.prompt.testing.allow", False)
-        options.headless = headless #run headless or not?
         #location for the selenium geckodriver log
         geckodriver_log_directory = Path(geckodriver_log_directory)
         if not geckodriver_log_directory.exists():
@@ -213,89 +308,537 @@ class MySpider(object):
                 f"Could not find geckodriver log directory '{geckodriver_log_directory}'. Quitting."
             )
             sys.exit(1)
-        slp = Path.joinpath(geckodriver_log_directory, "geckodriver.log")
+        self.geckodriver_log_path = Path.joinpath(
+            geckodriver_log_directory, geckodriver_log_name
+        )
         #####################################################################
         #the driver object is then queried to start Firefox and scrape pages
         ######################################################################
-        self.driver = webdriver.Firefox(options=options, service_log_path=slp)
-        # set large window size
-        self.driver.set_window_position(0, 0)
-        self.driver.set_window_size(1920, 1080)
-
-        # implicit wait
-        # ie each time we request a page element
-        # firefox waits up to 60 seconds until it shows up
-        # I believe this overridden when we set the
-        # "timeout" option to the WebDriverWait function
-        # se my "get_url" class function
-        self.driver.implicitly_wait(60)
+        # self.driver is the Firefox instance of the current thread,
+        # see the "driver" property.
+        # Firefox is started the first time a page is not in the cache
+        self._thread_local = threading.local()
+        self._worker_drivers = []
+        self._worker_lock = threading.Lock()
+        self._main_driver = None
+        # offline=True forbids fetching anything from the net
+        self.offline = offline
+
+        ##############
+        ## fetching ##
+        ##############
+        # no of Firefox instances fetching pages at the same time
+        self.fetch_workers = max(1, fetch_workers)
+        # requests per second and host
+        if rate_limit is None:
+            rate_limit = self.RATE_LIMIT or 1 / self.WAIT_TIME
+        self.rate_limiter = HostRateLimiter(rate_limit)
+        # urls the fetch workers failed to retrieve
+        self.failed_urls = set()
+        # urls put in the daily cache by prefetch, already counted by source
+        self.prefetched_urls = set()
+        # pooled keep-alive connections for pages that do not need Firefox
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=max(10, self.fetch_workers)
+        )
+        self.http_session.mount("http://", adapter)
+        self.http_session.mount("https://", adapter)
+        self.http_session.headers.update(
+            {
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:91.0) Gecko/20100101 Firefox/91.0",
+                "Accept-Encoding": "gzip, deflate",
+            }
+        )
 
         #############
         ## caching ##
         #############
         self.cache_parent_directory = Path(cache_parent_directory)
+        # cache_date replays the cache from another day
         cache_dir = Path.joinpath(
-            self.cache_parent_directory, Path(f"{datetime.now().strftime('%G-%m-%d')}")
+            self.cache_parent_directory,
+            Path(cache_date or f"{datetime.now().strftime('%G-%m-%d')}"),
         )
         if not cache_dir.is_dir():
             cache_dir.mkdir(parents=True)
-        self.cache = JSONShelve(
-            str(Path.joinpath(cache_dir, Path(f"{self.__class__.__name__}.json")))
+        # the page bodies of all days are compressed and kept once each
+        # in cache/bodies, the caches below only refer to them
+        self.bodies = BodyStore(
+            Path.joinpath(self.cache_parent_directory, "bodies"),
+            self.__class__.__name__,
         )
-        self.geo_cache = JSONShelve(
-            str(Path.joinpath(self.cache_parent_directory, "geocache.json"))
+        # the page cache is an append-only log, ie each new page
+        # is written once instead of rewriting the whole cache file
+        self.cache = CompressedPages(
+            JSONLogShelve(
+                str(Path.joinpath(cache_dir, Path(f"{self.__class__.__name__}.jsonl")))
+            ),
+            self.bodies,
         )
+        # the persistent page store keeps the pages between days,
+        # with the time they were fetched and their http validators
+        page_store_dir = Path.joinpath(self.cache_parent_directory, "pages")
+        if not page_store_dir.is_dir():
+            page_store_dir.mkdir(parents=True)
+        self.page_store = CompressedPages(
+            JSONLogShelve(
+                str(Path.joinpath(page_store_dir, f"{self.__class__.__name__}.jsonl"))
+            ),
+            self.bodies,
+        )
+        self.revalidate = revalidate
+        self.sitemap_lastmod = {}  # url -> <lastmod> in the sitemap
+        # the progress of the crawl, saved as it goes. Offline runs and
+        # replays keep it in memory, ie the checkpoint of the day is kept
+        self.checkpoint = Checkpoint(
+            None
+            if offline or cache_date is not None
+            else Path.joinpath(cache_dir, f"{self.__class__.__name__}.checkpoint.jsonl"),
+            resume=resume,
+        )
+        self.resumed_urls = set()  # pages whose stores came from the checkpoint
+        # shared by the spiders running in parallel
+        self.geo_cache = GeoCache(
+            Path.joinpath(self.cache_parent_directory, "geocache.sqlite")
+        )
+        if not len(self.geo_cache):
+            # the json geo caches used before the database
+            for path in self.cache_parent_directory.glob("geocache*.json"):
+                self.geo_cache.import_json(path)
+        self.history = HistoryStore(history_path) if history_path else None
+        self.only_changes = only_changes
         if not (Path(config_path).exists() and Path(config_path).is_file()):
             logger.critical(f"Could not find config file '{config_path}'. Quitting.")
             sys.exit(1)
         else:
             self.secrets = configparser.ConfigParser()
             self.secrets.read(config_path)
+        # how long pages from the persistent page store are reused, in hours
+        # e.g. "ApoteketSpider = 24" in the [cache_ttl] section of the config file
+        self.cache_ttl = timedelta(
+            hours=self.secrets.getfloat(
+                "cache_ttl", self.__class__.__name__, fallback=self.CACHE_TTL_HOURS
+            )
+        )
+        #####################
+        ## Firefox options ##
+        #####################
+        # e.g. "ApoteketSpider = default" in the [browser_profile] section
+        self.browser_profile = self.secrets.get(
+            "browser_profile", self.__class__.__name__, fallback=self.BROWSER_PROFILE
+        )
+        if self.browser_profile not in BROWSER_PROFILES:
+            logger.critical(
+                f"Unknown browser profile '{self.browser_profile}', "
+                f"use one of {', '.join(BROWSER_PROFILES)}. Quitting."
+            )
+            sys.exit(1)
+        self.headless = headless
+        self.firefox_options = firefox_options(self.browser_profile, headless)
+        self.browser_pool = (
+            BrowserPool(browser_pool, size=browser_pool_size) if browser_pool else None
+        )
+        # e.g. "ApoteketSpider = cache, net" in the [geo_precedence] section
+        self.geo_precedence = [
+            source.strip()
+            for source in self.secrets.get(
+                "geo_precedence",
+                self.__class__.__name__,
+                fallback=", ".join(self.GEO_PRECEDENCE),
+            ).split(",")
+        ]
+        if not set(self.geo_precedence) <= {"page", "cache", "net"}:
+            logger.critical(
+                f"Unknown geo precedence '{', '.join(self.geo_precedence)}', "
+                f"use page, cache and/or net. Quitting."
+            )
+            sys.exit(1)
+        # the optional "url" setting points the geocoder to
+        # another server, e.g. a local stand-in server for testing
+        self.geocoder = MapQuestGeocoder(
+            self.secrets.get("mapquest", "key", fallback=None),
+            base_url=self.secrets.get("mapquest", "url", fallback=None),
+        )
         logger.info(f"Running {self.__class__.__name__}")
         self.export_cache_directory = export_cache_to_directory
 
-    def address_to_long_lat(self, address_string):
+    def start_driver(self, log_path):
+        """Starts a new Firefox instance, or attaches to
+        a free instance in the browser pool"""
+        driver = None
+        if self.browser_pool:
+            with self.metrics.timer("browser_start", via="pool"):
+                driver = self.browser_pool.acquire(self.browser_profile, self.headless)
+            if driver is None:
+                logger.warning("All Firefox instances in the browser pool are in use")
+        if driver is None:
+            with self.metrics.timer("browser_start", via="firefox"):
+                driver = webdriver.Firefox(
+                    options=self.firefox_options, service_log_path=log_path
+                )
+        # set large window size
+        driver.set_window_position(0, 0)
+        driver.set_window_size(1920, 1080)
+
+        # implicit wait
+        # ie each time we request a page element
+        # firefox waits up to 60 seconds until it shows up
+        # I believe this overridden when we set the
+        # "timeout" option to the WebDriverWait function
+        # se my "get_url" class function
+        driver.implicitly_wait(self.IMPLICIT_WAIT)
+        return driver
+
+    @property
+    def driver(self):
+        """The Firefox instance of the current thread.
+        The fetch worker threads have their own instances,
+        all other code uses the main instance, which is started
+        the first time it is needed."""
+        driver = getattr(self._thread_local, "driver", None)
+        if driver:
+            return driver
+        if self._main_driver is None:
+            if self.offline:
+                raise ScrapeFailure("Firefox is needed, but we are running offline")
+            self._main_driver = self.start_driver(self.geckodriver_log_path)
+        return self._main_driver
+
+    @driver.setter
+    def driver(self, driver):
+        self._main_driver = driver
+
+    def quit_driver(self):
+        """Quits the main Firefox instance, if it was started"""
+        if self._main_driver is not None:
+            self._main_driver.quit()
+            self._main_driver = None
+
+    def _start_worker_driver(self):
+        """Starts a Firefox instance for the current fetch worker thread"""
+        if self.offline:
+            return
+        with self._worker_lock:
+            worker_no = len(self._worker_drivers) + 1
+            self._worker_drivers.append(None)
+        log_path = self.geckodriver_log_path.with_name(
+            f"{self.geckodriver_log_path.name}.worker{worker_no}"
+        )
+        self._thread_local.driver = self.start_driver(log_path)
+        self._worker_drivers[worker_no - 1] = self._thread_local.driver
+
+    def quit_worker_drivers(self):
+        for driver in self._worker_drivers:
+            if driver:
+                driver.quit()
+        self._worker_drivers = []
+
+    def cached_location(self, address_string, key=None):
+        """The location of an address in the geo cache, or None.
+        'key' is the street address without the store name (see
+        geocache.address_key), which may have been geo-located for
+        another chain or under another store name."""
+        location = self.geo_cache.get(address_string)
+        if (location is None or location.lat is None) and key:
+            # not found under this name (or not yet geo-located),
+            # may have been found under another one
+            location_by_key = self.geo_cache.get(key)
+            if location_by_key is not None and location_by_key.lat is not None:
+                location = location_by_key
+        return location
+
+    def save_location(self, address_string, geo_info, key=None):
+        """Saves a response from MapQuest to the geo cache, under the
+        address and the street address. Returns the Location."""
+        self.geo_cache.add(address_string, geo_info)
+        location = self.geo_cache.get(address_string)
+        if key and location.lat is not None:
+            self.geo_cache.add_location(address_string, location, key=key)
+        return location
+
+    def address_to_long_lat(self, address_string, key=None):
         """Geo-location using MapQuests API
-        Checks if address is already in cache"""
-        # check cache
-        # if not cache
-        try:
-            geo_info = self.geo_cache[address_string]
+        Checks if address is already in cache.
+        Returns a geocache.Location, or None if it could not be found."""
+        with self.metrics.timer("geocode", source="cache"):
+            location = self.cached_location(address_string, key)
+        if location is not None:
+            self.metrics.incr("geocode", source="cache")
             logger.info(f"Geo from cache: {address_string}")
-        except KeyError:
-            # ask for password
+        else:
+            if self.offline:
+                return None
             # query mapquest
             # save cache
             logger.info(f"Geo from net: {address_string}")
-            key = self.secrets["mapquest"]["key"]
-            url = f"http://www.mapquestapi.com/geocoding/v1/address?key={key}"
-            r = requests.post(url, data={"location": address_string})
-            if r:
-                geo_info = r.json()
-                self.geo_cache[address_string] = geo_info
-                self.geo_cache.sync()
-        if geo_info["results"]:
-            # returns only first hit
-            res, *_ = geo_info["results"]
-            if res:
-                loc = res["locations"][0]
-                return loc["street"], loc["postalCode"], loc["latLng"]
-            else:
+            self.metrics.incr("geocode", source="net")
+            with self.metrics.timer("geocode", source="net"):
+                geo_info = self.geocoder.geocode(address_string)
+            if not geo_info:
                 return None
+            location = self.save_location(address_string, geo_info, key)
+            self.geo_cache.sync()
+        if location.lat is None:
+            return None
+        return location
+
+    def geocode_addresses(self, addresses):
+        """Geo-locates the addresses that are not in the geo cache
+        with MapQuest's batch API, and saves them to the geo cache
+        in one write. 'addresses' maps each address to its key
+        (see cached_location). Returns the addresses sent to MapQuest."""
+        new_addresses = {
+            address: key
+            for address, key in addresses.items()
+            if self.cached_location(address, key) is None
+        }
+        if not new_addresses or self.offline:
+            return set()
+        logger.info(f"Geo from net: {len(new_addresses)} addresses")
+        self.metrics.incr("geocode", len(new_addresses), source="net_batch")
+        with self.metrics.timer("geocode", source="net_batch"):
+            geo_info = self.geocoder.batch_geocode(list(new_addresses))
+        for address_string, response in geo_info.items():
+            self.save_location(address_string, response, new_addresses[address_string])
+        self.geo_cache.sync()
+        return set(new_addresses)
+
+    def reverse_geocode(self, points):
+        """Finds the postal codes of the points (latlng_key -> (lat, lng))
+        that are not in the geo cache with MapQuest's batch API"""
+        new_points = {
+            key: point for key, point in points.items() if self.geo_cache.get_key(key) is None
+        }
+        if not new_points or self.offline:
+            return
+        logger.info(f"Reverse geo from net: {len(new_points)} coordinates")
+        self.metrics.incr("geocode", len(new_points), source="net_reverse")
+        with self.metrics.timer("geocode", source="net_reverse"):
+            geo_info = self.geocoder.batch_reverse(new_points)
+        for key, response in geo_info.items():
+            self.geo_cache.add_location(key, location_from_response(response), key=key)
+        self.geo_cache.sync()
+
+    @staticmethod
+    def geo_key(store):
+        """The street address of the store, without the store name"""
+        if not store.address:
+            return None
+        return address_key(store.address, store.zip_code, store.city)
+
+    def page_location(self, store):
+        """The coordinates on the store page as a Location, with the
+        postal code from the page, or else from a reverse geo-location.
+        None if the page has no coordinates."""
+        point = page_coordinates(store.lat, store.long)
+        if point is None:
+            return None
+        postal_code = store.zip_code or None
+        if not postal_code:
+            reverse = self.geo_cache.get_key(latlng_key(*point))
+            postal_code = reverse.postal_code if reverse else None
+        return Location(store.address or None, postal_code, *point)
+
+    def geo_request(self, store):
+        """What has to be asked from MapQuest before the store can be
+        geo-located, following geo_precedence:
+        ("reverse", latlng_key, (lat, lng)), ("address", geo_query, key) or None"""
+        key = self.geo_key(store)
+        for source in self.geo_precedence:
+            if source == "page":
+                point = page_coordinates(store.lat, store.long)
+                if point is None:
+                    continue
+                if store.zip_code or not self.REVERSE_GEOCODE:
+                    return None
+                if self.geo_cache.get_key(latlng_key(*point)) is None:
+                    return ("reverse", latlng_key(*point), point)
+                return None
+            if not store.geo_query:
+                continue
+            if self.cached_location(store.geo_query, key) is not None:
+                return None
+            if source == "net":
+                return ("address", store.geo_query, key)
+        return None
+
+    def add_geo_info(self, stores):
+        """Fills in the mq_* fields of each store, see resolve_location.
+        The stores are held back until GEOCODING_BATCH_SIZE new addresses
+        or coordinates have been collected, which are then geo-located
+        in one request."""
+        held_stores = []
+        from_net = set()  # addresses geo-located by MapQuest in this run
+        new_addresses = {}  # address -> key
+        new_points = {}  # latlng_key -> (lat, lng)
+        for store in stores:
+            held_stores.append(store)
+            request = None if self.geo_located(store) else self.geo_request(store)
+            if request and request[0] == "address":
+                new_addresses[request[1]] = request[2]
+            elif request:
+                new_points[request[1]] = request[2]
+            if len(new_addresses) + len(new_points) >= self.GEOCODING_BATCH_SIZE:
+                from_net |= self.geocode_addresses(new_addresses)
+                self.reverse_geocode(new_points)
+                new_addresses, new_points = {}, {}
+            if not (new_addresses or new_points):
+                # all the held stores can be geo-located from the cache
+                yield from (self._add_geo_info_to_store(s, from_net) for s in held_stores)
+                held_stores = []
+        from_net |= self.geocode_addresses(new_addresses)
+        self.reverse_geocode(new_points)
+        yield from (self._add_geo_info_to_store(s, from_net) for s in held_stores)
+
+    def resolve_location(self, store, from_net=()):
+        """Returns the source ("page", "cache" or "net") and the
+        Location of a store, following geo_precedence, or (None, None).
+        from_net are the addresses that were just batch geo-located."""
+        key = self.geo_key(store)
+        for source in self.geo_precedence:
+            if source == "page":
+                location = self.page_location(store)
+                if location:
+                    return source, location
+            elif store.geo_query and source == "cache":
+                location = self.cached_location(store.geo_query, key)
+                if location is None:
+                    continue
+                if location.lat is None:
+                    # MapQuest has found nothing
+                    return None, None
+                return ("net" if store.geo_query in from_net else source), location
+            elif store.geo_query and source == "net":
+                location = self.address_to_long_lat(store.geo_query, key)
+                if location:
+                    return source, location
+        return None, None
+
+    def check_location(self, store, source, location):
+        """Cross-checks the postal code and coordinates on the store page
+        against the geo-located address. Returns the failed checks."""
+        checks = []
+        point = page_coordinates(store.lat, store.long)
+        if source == "page":
+            # compared with the address if it is known, without asking MapQuest
+            address_location = (
+                self.cached_location(store.geo_query, self.geo_key(store))
+                if store.geo_query
+                else None
+            )
+            if address_location is not None and address_location.lat is None:
+                address_location = None
+        else:
+            address_location = location
+        if address_location:
+            postal_code = address_location.postal_code
+        else:
+            # the postal code at the coordinates, if it has been looked up
+            reverse = self.geo_cache.get_key(latlng_key(*point)) if point else None
+            postal_code = reverse.postal_code if reverse else None
+        if zip_mismatch(store.zip_code, postal_code):
+            checks.append("zip")
+        if point and address_location:
+            distance = distance_m(
+                *point, float(address_location.lat), float(address_location.lng)
+            )
+            if distance > self.MAX_GEO_DISTANCE:
+                checks.append("distance")
+        return checks
+
+    @staticmethod
+    def geo_located(store):
+        """True for stores that are not to be geo-located, ie dummy
+        stores for pages we could not parse, and the stores that were
+        geo-located before, e.g. resumed from the checkpoint"""
+        return store.parsing_failed or store.geo_source is not None
+
+    def _add_geo_info_to_store(self, store, from_net=()):
+        if self.geo_located(store) or not (
+            store.geo_query or page_coordinates(store.lat, store.long)
+        ):
+            # e.g. a dummy store for a page we could not parse
+            return store
+        source, location = self.resolve_location(store, from_net)
+        if location:
+            store.mq_street = location.street
+            store.mq_zip_code = location.postal_code
+            store.mq_lat = location.lat
+            store.mq_long = location.lng
+            store.geo_source = source
+            checks = self.check_location(store, source, location)
+            store.geo_check = ",".join(checks)
+            self.metrics.incr("geo", source=source)
+            for check in checks:
+                self.metrics.incr("geo_mismatch", check=check)
+            if checks:
+                logger.warning(
+                    f"Geo-location of {store.store_name} failed the {store.geo_check} check: {store.url}"
+                )
+        else:
+            logger.warning(f"Could not geo-locate {store.geo_query}")
+            store.mq_street = store.mq_zip_code = store.mq_lat = store.mq_long = ""
+            store.geo_source = store.geo_check = ""
+        return store
+
+    def use_http(self, url, wait_condition=False):
+        """Returns True if the url can be fetched without Firefox,
+        ie it matches HTTP_URL_PATTERNS and we do not have to wait
+        for a part of the page to load"""
+        if wait_condition:
+            return False
+        return any(pattern.search(url) for pattern in self.HTTP_URL_PATTERNS)
+
+    def http_request(self, url, pause=60, headers=None):
+        """Sends a plain http GET request. Returns the response,
+        or None if the request failed."""
+        try:
+            with self.metrics.timer("page_load", url=url, via="http"):
+                r = self.http_session.get(url, timeout=pause, headers=headers)
+            r.raise_for_status()
+        except requests.RequestException as http_error:
+            logger.error(f"Could not retrieve {url}: {http_error}")
+            return None
+        if "charset" not in r.headers.get("Content-Type", ""):
+            # requests assumes latin-1 for text/xml without a charset
+            r.encoding = "utf-8"
+        return r
+
+    @staticmethod
+    def response_text(r):
+        """The page source of a response. Gzipped sitemaps (.xml.gz)
+        are decompressed, as the page caches only keep text."""
+        if r.content[:2] == b"\x1f\x8b":
+            return gzip.decompress(r.content).decode("utf-8", errors="replace")
+        return r.text
+
+    def http_get(self, url, pause=60):
+        """Retrieves a url with a plain http request. Returns the page source."""
+        r = self.http_request(url, pause=pause)
+        if r is None:
+            return False, None
+        return True, self.response_text(r)
 
     def get_url(self, url, wait_condition=False, pause=60):
         """Retrieves a particular url using FireFox. Returns the
         page source. Waits until the "wait_condition" function
         returns True.
+        Urls that do not need Firefox are fetched with http_get.
         get_url is overwritten when we need a specific algorithm for
         retrieving the page"""
-        self.driver.get(url)  # wait condition efter get?
+        if self.use_http(url, wait_condition):
+            return self.http_get(url, pause=pause)
+        with self.metrics.timer("page_load", url=url, via="firefox"):
+            self.driver.get(url)  # wait condition efter get?
         # waiting for a particular element of the page to load
         # before returning the whole page
         if wait_condition:
             try:
-                WebDriverWait(self.driver, timeout=pause).until(wait_condition)
+                with self.metrics.timer("wait_condition", url=url):
+                    WebDriverWait(self.driver, timeout=pause).until(wait_condition)
             except TimeoutException:
+                self.metrics.incr("wait_condition_timeouts")
                 # Waited for an element that never showed up
                 logger.error(
                     f"TimeoutException: The html part we waited for never showed up in {url}"
@@ -305,79 +848,203 @@ class MySpider(object):
         page_source = self.driver.page_source
         return True, page_source
 
-    def make_soup(
-        self, url, parser="lxml", wait_condition=False, soup_cache=None, pause=60
-    ):
+    def is_fresh(self, stored_page, url):
+        """Returns True if a page from the persistent page store
+        can be reused instead of fetching it again, ie if it is younger
+        than the chain's cache ttl, or if we revalidate and the page
+        has not been modified according to the sitemap."""
+        fetched_at = datetime.fromisoformat(stored_page["fetched_at"])
+        if datetime.now() - fetched_at < self.cache_ttl:
+            return True
+        if self.revalidate and url in self.sitemap_lastmod:
+            return self.sitemap_lastmod[url] <= fetched_at
+        return False
+
+    def fetch(self, url, wait_condition=False, pause=60, stored_page=None):
+        """Retrieves a page from the net. Returns the page source and the
+        http validators (ETag and Last-Modified) of the page.
+        If we revalidate and the page is in the persistent page store,
+        plain http requests are sent as conditional requests,
+        ie the stored page is reused if the server answers 304 Not Modified.
+        Safe to call from the fetch worker threads."""
+        if self.offline:
+            logger.error(f"Not in the cache, and we are running offline: {url}")
+            return False, None, {}
+        # avoid hammering the server
+        self.rate_limiter.wait(url)
+        if not self.use_http(url, wait_condition):
+            got_source, page_source = self.get_url(url, wait_condition, pause=pause)
+            return got_source, page_source, {}
+        headers = {}
+        if self.revalidate and stored_page:
+            if stored_page.get("etag"):
+                headers["If-None-Match"] = stored_page["etag"]
+            if stored_page.get("last_modified"):
+                headers["If-Modified-Since"] = stored_page["last_modified"]
+        r = self.http_request(url, pause=pause, headers=headers)
+        if r is None:
+            return False, None, {}
+        validators = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+        if r.status_code == 304:
+            logger.info(f"Web page not modified: {url}")
+            # a 304 response may leave out the validators
+            validators = {
+                key: validators[key] or stored_page.get(key) for key in validators
+            }
+            return True, stored_page["body"], validators
+        return True, self.response_text(r), validators
+
+    def store_page(self, url, page_source, validators):
+        """Saves a fetched page to the persistent page store"""
+        with self.metrics.timer("cache_write", url=url):
+            self.page_store[url] = {
+                "body": page_source,
+                "fetched_at": datetime.now().isoformat(timespec="seconds"),
+                "etag": validators.get("etag"),
+                "last_modified": validators.get("last_modified"),
+            }
+            self.page_store.sync()
+
+    def remember_lastmod(self, url, lastmod):
+        """Saves the <lastmod> date of a url in a sitemap,
+        used when revalidating the page"""
+        if not (lastmod and self.revalidate):
+            return
+        try:
+            self.sitemap_lastmod[url] = parse_lastmod(lastmod)
+        except ValueError:
+            logger.warning(f"Could not read <lastmod> {lastmod!r} of {url}")
+
+    def get_page_source(self, url, wait_condition=False, soup_cache=None, pause=60):
         """This function retrieves the page source from a webpage.
         The function first tests if the page is in the cache.
             * wait_condition is a lambda function that returns true if a page element is finished loading
             * pause give us the no seconds to wait for wait_condition to turn true.
             * soup_cache makes it possible to use a custom cache object"""
-        # TODO: add timestamp to each entry in the cache
-        if not soup_cache:
+        if soup_cache is None:
             # soup_cache not set
             # using standard cache
             soup_cache = self.cache
-        if url in self.VISITED_PAGES and not soup_cache:
-            # already visited page during current session
-            # if soup_cache!=None then we should not care about
-            # that we already visited the page, since we might have
-            # failed to retrieve the page from another cache file
-            return False, None
-        else:
-            self.VISITED_PAGES.append(url)
-            self.NO_VISITED_PAGES += 1
-            try:
-                # test if page source is already in the cache file
+        # duplicate store pages are already skipped by the
+        # crawl frontier in scrape, see CrawlFrontier
+        self.NO_VISITED_PAGES += 1
+        try:
+            # test if page source is already in the cache file
+            with self.metrics.timer("cache_read", url=url):
                 page_source = soup_cache[url]
+            if url in self.prefetched_urls:
+                self.prefetched_urls.discard(url)
+            else:
+                self.metrics.incr("pages", source="daily_cache")
                 logger.info(f"Web page from cache: {url}")
-            except KeyError:
-                # url not in cache
-                got_source, page_source = self.get_url(
-                    url, wait_condition, pause=pause
-                )
-                # add page source to cache
+        except KeyError:
+            # url not in cache
+            if url in self.failed_urls:
+                # a fetch worker already tried and failed
+                self.metrics.incr("pages", source="failed")
+                raise ScrapeFailure(f"Could not retrieve source for {url}")
+            with self.metrics.timer("cache_read", url=url):
+                stored_page = self.page_store.get(url)
+            if stored_page and self.is_fresh(stored_page, url):
+                # fetched on a previous day and still valid
+                logger.info(f"Web page from page store: {url}")
+                self.metrics.incr("pages", source="page_store")
+                got_source, page_source = True, stored_page["body"]
+            else:
+                with self.metrics.timer("fetch", url=url):
+                    got_source, page_source, validators = self.fetch(
+                        url, wait_condition, pause=pause, stored_page=stored_page
+                    )
                 if got_source:
                     logger.info(f"Web page from net: {url}")
+                    self.metrics.incr("pages", source="net")
+                    self.store_page(url, page_source, validators)
+            # add page source to the daily cache
+            if got_source:
+                with self.metrics.timer("cache_write", url=url):
                     soup_cache[url] = page_source
-                    soup_cache.sync()  # saves cache
-                    # cache is also saved when scraping
-                    # is finished with write_xlsx
-                    # avoid hammering the server
-                    time.sleep(self.WAIT_TIME)
-                else:
-                    # timeout error or such prevented
-                    # us from retrieving the source code
-                    # for the page
-                    raise ScrapeFailure(f"Could not retrieve source for {url}")
-            return True, BeautifulSoup(page_source, parser)
+                    soup_cache.sync()  # appends the page to the cache
+                # cache is also saved when scraping
+                # is finished with write_output
+            else:
+                # timeout error or such prevented
+                # us from retrieving the source code
+                # for the page
+                self.metrics.incr("pages", source="failed")
+                raise ScrapeFailure(f"Could not retrieve source for {url}")
+        return True, page_source
+
+    def make_soup(
+        self, url, parser="lxml", wait_condition=False, soup_cache=None, pause=60
+    ):
+        """Retrieves the page source with get_page_source and
+        parses it with BeautifulSoup"""
+        new_page, page_source = self.get_page_source(
+            url, wait_condition=wait_condition, soup_cache=soup_cache, pause=pause
+        )
+        if not new_page:
+            return False, None
+        with self.metrics.timer("parse", url=url):
+            soup = BeautifulSoup(page_source, parser)
+        return True, soup
+
+    def extract_fields(self, url, wait_condition=False, pause=60):
+        """Retrieves the page source with get_page_source and
+        parses it with lxml. Returns the page's FIELDS."""
+        new_page, page_source = self.get_page_source(
+            url, wait_condition=wait_condition, pause=pause
+        )
+        if not new_page:
+            return False, None
+        with self.metrics.timer("parse", url=url):
+            page = ExtractedPage(page_source, self.FIELDS)
+        return True, page
+
+    def read_sitemap(self, url, predicate=None, sitemap_predicate=None):
+        """Yields the (url, lastmod) pairs in a sitemap that match predicate.
+        Sitemaps listed in a sitemap index are read recursively, unless
+        sitemap_predicate is False, in which case the listed sitemaps
+        are yielded instead."""
+        new_page, page_source = self.get_page_source(url)
+        if not new_page:
+            return
+        fetch = None
+        if sitemap_predicate is not False:
+            fetch = lambda sitemap_url: self.get_page_source(sitemap_url)[1]
+        for loc, lastmod in iter_sitemap(
+            page_source,
+            predicate=predicate,
+            fetch=fetch,
+            sitemap_predicate=sitemap_predicate or None,
+        ):
+            self.remember_lastmod(loc, lastmod)
+            yield loc, lastmod
 
     def get_current_store_name(self, soup):
         """Simply returns the name of the store from the
-        web page title.
-        Can be overridden by child classes to MySpider"""
-        return soup.title.text
+        web page title, or from STORE_NAME_SELECTOR if it is set"""
+        return store_name(soup, self.STORE_NAME_SELECTOR)
 
     def export_cache(self, export_cache_directory):
-        """Exports the web pages in the the cache to separate text files"""
+        """Exports the web pages in the the cache to separate text files,
+        parsed in a pool of processes. Pages that have not changed since
+        the last export are linked from that export instead."""
         subdirectory = Path(datetime.now().strftime("%G-%m-%d"))
         output = Path.joinpath(Path(export_cache_directory), subdirectory)
-        if not output.is_dir():
-            output.mkdir(parents=True)
-        for key in self.cache:
-            if (".xml" in key) or ("hjartat_store_list") in key:
-                # The cached page is a sitemap. Do not export
-                pass
-            else:
-                try:
-                    soup = BeautifulSoup(self.cache[key], features="lxml")
-                    file_name = self.get_current_store_name(soup) + ".txt"
-                    path = Path.joinpath(output, file_name)
-                    with open(path, "w") as page:
-                        logger.info(f"Exporting to {file_name}")
-                        page.write(soup.body.text)
-                except AttributeError:
-                    logger.warning(f"Could not export {key}, has no title")
+        with self.metrics.timer("export_cache"):
+            counts = export_cache(
+                self.cache,
+                output,
+                manifest_path=Path.joinpath(
+                    Path(export_cache_directory), f"{self.__class__.__name__}.export.json"
+                ),
+                name_selector=self.STORE_NAME_SELECTOR,
+            )
+        for result, no_pages in counts.items():
+            self.metrics.incr("exported_pages", no_pages, result=result)
 
     def write_cache(self):
         if self.export_cache_directory:
@@ -387,13 +1054,41 @@ class MySpider(object):
 
     @logger.catch()
     #catches errors to the log
-    def write_xlsx(self, path):
+    def write_output(self, path, output_format="xlsx"):
         """This functions kicks off the whole
         process for scraping the pages from a store."""
-        result = self.scrape()
-        table = etl.fromdicts(result)
-        etl.toxlsx(table, path)
-        logger.info(f"Wrote result to {path}")
+        # the addresses are geo-located in batches and the opening
+        # hours normalized while the stores are written,
+        # one row per weekday
+        self.checkpoint.save_output(path)
+        stores = normalize_stores(self.save_stores(self.add_geo_info(self.scrape())))
+        if self.history:
+            stores = self.history.record(stores, self.only_changes)
+        # the rows are written as the stores come in, so only the
+        # time spent in the writer is summed up
+        write_seconds = 0.0
+        try:
+            with open_writer(path, output_format) as writer:
+                for row in iter_rows(stores):
+                    start = time.perf_counter()
+                    writer.write(row)
+                    write_seconds += time.perf_counter() - start
+                start = time.perf_counter()
+            write_seconds += time.perf_counter() - start  # closing the file
+            self.metrics.add_time("output_write", write_seconds)
+        finally:
+            if self.history:
+                self.history.close()
+        self.metrics.incr("rows_written", writer.no_rows)
+        logger.info(f"Wrote {writer.no_rows} rows to {path}")
+        self.checkpoint.save_output(path, finished=True)
+
+    def save_stores(self, stores):
+        """Saves each geo-located store to the checkpoint"""
+        for store in stores:
+            if store.url not in self.resumed_urls:
+                self.checkpoint.save_store(store)
+            yield store
 
     def get_info_page_urls(self, start_url):
         """ Creates an iterator of all the individual store pages
@@ -406,6 +1101,114 @@ class MySpider(object):
         Overwritten by the child classes to MySpider"""
         pass
 
+    def needs_page(self, url):
+        """Returns False if the store's info is already known without
+        fetching its page, e.g. from a json api or the checkpoint.
+        Such pages are not prefetched.
+        Can be overridden by child classes to MySpider"""
+        return not self.checkpoint.completed(url)
+
+    def restore_info_page_urls(self, start_url):
+        """Called on resume when the store pages of start_url are read
+        from the checkpoint and some of them are still to be scraped.
+        Can be overridden by child classes that have to set up
+        more than the list of urls, e.g. HjartatSpider"""
+        pass
+
+    def discover_info_page_urls(self, start_url):
+        """The store pages of start_url from get_info_page_urls, saved
+        to the checkpoint. On resume they are read from the checkpoint."""
+        urls = self.checkpoint.urls(start_url)
+        if urls is not None:
+            logger.info(f"{len(urls)} store urls from the checkpoint: {start_url}")
+            if not all(self.checkpoint.completed(url) for url in urls):
+                self.restore_info_page_urls(start_url)
+            return urls
+        # a start url that fails, e.g. a region page that is not in the
+        # cache when running offline, is handled like a failed store page
+        try:
+            urls = list(self.get_info_page_urls(start_url))
+        except Exception as whatever_exception:
+            self.metrics.incr("start_pages", result="failed")
+            if not self.ignore_errors_when_parsing_info_page:
+                raise whatever_exception
+            logger.error(f"Could not find the store pages of {start_url}: {whatever_exception}")
+            return []
+        self.checkpoint.save_urls(start_url, urls)
+        return urls
+
+    def get_info_page_fetch_options(self, info_page_url):
+        """Returns the wait_condition and pause used by make_soup
+        when retrieving a store info page.
+        Overwritten by child classes that have to wait for
+        parts of the page to load"""
+        return {}
+
+    def _fetch_in_worker(self, url, stored_page):
+        """Retrieves a store info page using the Firefox
+        instance of the current fetch worker thread"""
+        got_source, page_source, validators = self.fetch(
+            url, stored_page=stored_page, **self.get_info_page_fetch_options(url)
+        )
+        return url, got_source, page_source, validators
+
+    def prefetch(self, info_page_urls):
+        """Retrieves the store info pages that are not in the cache
+        using several Firefox instances at the same time.
+        Yields each url as soon as its page is in the cache,
+        ie a slow page does not hold back the others."""
+        new_urls = []
+        for url in info_page_urls:
+            if url in self.cache or not self.needs_page(url):
+                yield url
+                continue
+            stored_page = self.page_store.get(url)
+            if stored_page and self.is_fresh(stored_page, url):
+                logger.info(f"Web page from page store: {url}")
+                self.metrics.incr("pages", source="page_store")
+                self.cache[url] = stored_page["body"]
+                self.prefetched_urls.add(url)
+                yield url
+            else:
+                new_urls.append((url, stored_page))
+        if not new_urls:
+            return
+        try:
+            with ThreadPoolExecutor(
+                max_workers=min(self.fetch_workers, len(new_urls)),
+                initializer=self._start_worker_driver,
+            ) as executor:
+                futures = {
+                    executor.submit(self._fetch_in_worker, url, stored_page): url
+                    for url, stored_page in new_urls
+                }
+                try:
+                    for future in as_completed(futures):
+                        try:
+                            url, got_source, page_source, validators = future.result()
+                        except Exception as e:
+                            # e.g. a crashed Firefox, or a worker whose Firefox
+                            # could not be started, which breaks the pool.
+                            # The page then fails like any other page.
+                            url, got_source = futures[future], False
+                            logger.error(f"Fetch worker failed on {url}: {e!r}")
+                        if got_source:
+                            logger.info(f"Web page from net: {url}")
+                            self.metrics.incr("pages", source="net")
+                            # the caches are only written to from the main thread
+                            self.store_page(url, page_source, validators)
+                            self.cache[url] = page_source
+                            self.cache.sync()
+                            self.prefetched_urls.add(url)
+                        else:
+                            self.failed_urls.add(url)
+                        yield url
+                finally:
+                    for future in futures:
+                        future.cancel()
+        finally:
+            self.quit_worker_drivers()
+
     # def save_urls_to_cache(self):
     #     urls = []
     #     for start_url in self.START_URLS:
@@ -420,123 +1223,247 @@ class MySpider(object):
         each item.
         """
         for start_url in self.START_URLS:
-            for info_page_url in self.get_info_page_urls(start_url):
+            # duplicate urls, e.g. the same store listed in two Hjärtat
+            # regions, are skipped before they are fetched
+            info_page_urls = (
+                url
+                for url in self.discover_info_page_urls(start_url)
+                if self.frontier.add(url)
+            )
+            if self.fetch_workers > 1:
+                # the pages are parsed in the order they finish loading
+                info_page_urls = self.prefetch(info_page_urls)
+            for info_page_url in info_page_urls:
+                if self.checkpoint.completed(info_page_url):
+                    # scraped and geo-located before the previous run stopped
+                    self.resumed_urls.add(info_page_url)
+                    stores = self.checkpoint.stores(info_page_url)
+                    self.metrics.incr("store_pages", result="resumed")
+                    if not any(store.parsing_failed for store in stores):
+                        self.NO_OK_PAGES += 1
+                    yield from stores
+                    continue
+                self.checkpoint.restart_page(info_page_url)
+                no_stores = 0
                 # Catches exceptions when parsing individual store pages
                 # if self.ignore_errors_when_parsing_info_page=True
-                # the program just passes a dummy row to the excel writer,
+                # the program just passes a dummy store to the output writer,
                 # else it raises the same exception,
                 # which then is caught by logger
                 try:
-                    yield from self.get_info_page(info_page_url)
+                    for store in self.get_info_page(info_page_url):
+                        no_stores += 1
+                        yield store
                 except Exception as whatever_exception:
+                    self.metrics.incr("store_pages", result="failed")
                     if self.ignore_errors_when_parsing_info_page:
                         parsing_error_message = "COULD NOT PARSE PAGE"
                         # todo: add chain name to class variables for each subclass
-                        yield {
-                            "chain": self.__class__.__name__,  # todo: replace this
-                            "url": info_page_url,
-                            "store_name": parsing_error_message,
-                            "long": parsing_error_message,
-                            "lat": parsing_error_message,
-                            "address": parsing_error_message,
-                            "zip_code": parsing_error_message,
-                            "city": parsing_error_message,
-                            "datetime": datetime.now().isoformat(),
-                            "weekday": parsing_error_message,
-                            "weekday_no": parsing_error_message,
-                            "hours": parsing_error_message,
-                            "mq_street": parsing_error_message,
-                            "mq_zip_code": parsing_error_message,
-                            "mq_lat": parsing_error_message,
-                            "mq_long": parsing_error_message,
-                        }
+                        no_stores += 1
+                        yield Store.failed(
+                            self.__class__.__name__,  # todo: replace this
+                            info_page_url,
+                            parsing_error_message,
+                        )
                         logger.error(f"Could note parse page {info_page_url}")
                     else:
                         raise whatever_exception
                 else:
                     # no exception during parsing of page
                     self.NO_OK_PAGES += 1
+                    self.metrics.incr("store_pages", result="ok")
+                self.checkpoint.save_page(info_page_url, no_stores)
         # end of scraping
-        page_stats = self.NO_OK_PAGES / self.NO_VISITED_PAGES
         logger.info(
-            f"{self.NO_VISITED_PAGES-self.NO_OK_PAGES} out of {self.NO_VISITED_PAGES} failed ({(1-page_stats)*100:.1f} %)."
+            f"{len(self.frontier)} store urls, {self.frontier.no_duplicates} duplicates skipped."
         )
-        if page_stats < self.LIMIT_SCRAPING_FAILURE:
-            logger.error(
-                f"More than {round(self.LIMIT_SCRAPING_FAILURE*100,0)} of the pages failed"
+        # the sitemaps etc are not store pages, ie
+        # the failure rate is taken over the store pages
+        no_store_pages = len(self.frontier)
+        no_failed_pages = no_store_pages - self.NO_OK_PAGES
+        if no_store_pages:
+            failure_rate = no_failed_pages / no_store_pages
+            logger.info(
+                f"{no_failed_pages} out of {no_store_pages} store pages failed ({failure_rate*100:.1f} %)."
             )
+            if failure_rate > self.LIMIT_SCRAPING_FAILURE:
+                logger.error(
+                    f"More than {round(self.LIMIT_SCRAPING_FAILURE*100,0)} % of the pages failed"
+                )
+        else:
+            logger.error("Found no store pages")
         if self.quit_when_finished:
-            self.driver.quit()
+            self.quit_driver()
         self.write_cache()
 
 
+def test_prefetch_worker_failure(tmp_path):
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    spider = ApoteketSpider(tmp_path, config_path, tmp_path, fetch_workers=2)
+    urls = ["https://www.apoteket.se/apotek/a/", "https://www.apoteket.se/apotek/b/"]
+
+    def fetch_in_worker(url, stored_page):
+        if url == urls[0]:
+            raise WebDriverException("Firefox crashed")
+        return url, True, "<html></html>", {}
+
+    spider._start_worker_driver = lambda: None  # no Firefox
+    spider._fetch_in_worker = fetch_in_worker
+    assert sorted(spider.prefetch(urls)) == urls
+    assert spider.failed_urls == {urls[0]} and urls[1] in spider.cache
+    # the prefetched page is counted once, as fetched from the net
+    spider.get_page_source(urls[1])
+    pages = {
+        counter["labels"]["source"]: counter["value"]
+        for counter in spider.metrics.as_dict()["counters"]
+        if counter["name"] == "pages"
+    }
+    assert pages == {"net": 1}
+
+    # a worker whose Firefox cannot be started breaks the whole pool
+    def start_worker_driver():
+        raise WebDriverException("geckodriver not found")
+
+    spider._start_worker_driver = start_worker_driver
+    more_urls = ["https://www.apoteket.se/apotek/c/", "https://www.apoteket.se/apotek/d/"]
+    assert sorted(spider.prefetch(more_urls)) == more_urls
+    assert spider.failed_urls == {urls[0], *more_urls}
+
+
+def test_gzipped_sitemap(tmp_path):
+    sitemap = (
+        "<urlset><url><loc>https://www.apoteket.se/apotek/ekorren/</loc>"
+        "<lastmod>2021-03-01</lastmod></url></urlset>"
+    )
+
+    class Session(requests.Session):
+        def get(self, url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = gzip.compress(sitemap.encode("utf-8"))
+            response.headers["Content-Type"] = "application/x-gzip"
+            return response
+
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    spider = ApoteketSpider(tmp_path, config_path, tmp_path, rate_limit=1e9)
+    spider.http_session = Session()
+    url = "https://www.apoteket.se/sitemap-stores.xml.gz"
+    assert spider.use_http(url)
+    _, page_source = spider.get_page_source(url)
+    assert page_source == sitemap
+    # and from the daily cache
+    _, page_source = spider.get_page_source(url)
+    assert list(iter_sitemap(page_source)) == [
+        ("https://www.apoteket.se/apotek/ekorren/", "2021-03-01")
+    ]
+
+
+def test_cached_location(tmp_path):
+    def response(*locations):
+        return {"results": [{"locations": list(locations)}]}
+
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    spider = ApoteketSpider(tmp_path, config_path, tmp_path)
+    key = address_key("Ekorrens väg 1", "41251", "Göteborg")
+    found = {"street": "Ekorrens väg 1", "postalCode": "41251", "latLng": {"lat": 57.69, "lng": 11.98}}
+    spider.save_location(f"Apoteket Ekorren, {key}", response(found), key=key)
+    # not found under one name, but found under another
+    spider.save_location(f"Lloyds Ekorren, {key}", response())
+    assert spider.cached_location(f"Lloyds Ekorren, {key}", key=key).lat == 57.69
+    assert spider.cached_location(f"Lloyds Ekorren, {key}").lat is None
+
+
+def test_replay_keeps_checkpoint(tmp_path):
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    day = tmp_path.joinpath("2021-03-04")
+    day.mkdir()
+    checkpoint = Checkpoint(day.joinpath("ApoteketSpider.checkpoint.jsonl"))
+    checkpoint.save_output("output/apoteket.xlsx", finished=True)
+    checkpoint.close()
+    spider = ApoteketSpider(tmp_path, config_path, tmp_path, cache_date="2021-03-04", offline=True)
+    assert spider.checkpoint.output() is None
+    checkpoint = Checkpoint(day.joinpath("ApoteketSpider.checkpoint.jsonl"), resume=True)
+    assert checkpoint.output()["finished"]
+
+
 class ApoteksgruppenSpider(MySpider):
 
     START_URLS = ["https://www.apoteksgruppen.se/sitemap.xml?type=1"]
+    # the store pages are static html
+    HTTP_URL_PATTERNS = MySpider.HTTP_URL_PATTERNS + [
+        re.compile(r"^https://www\.apoteksgruppen\.se/apotek/")
+    ]
 
     url_regex = re.compile(
         r"(https://www.apoteksgruppen.se/apotek/\w+/(\w+-){1,3}\w+/)"
     )
 
+    FIELDS = {
+        "title": css("title"),
+        "street_address": xpath('//*[@itemprop="streetAddress"]'),
+        "city": xpath('//*[@itemprop="addressLocality"]'),
+        "opening_hours": css("section.pharmacy-opening-hours li"),
+    }
+
+    @staticmethod
+    def is_store_url(store_url):
+        """True for urls that match urls for stores"""
+        components = store_url.split("/")
+        if len(components) != 7:
+            return False
+        http, _, domain, subcat, *remainder = components
+        return subcat == "apotek" and len(remainder) > 1
+
     def get_info_page_urls(self, starting_url):
         """Trawls the sitemap for urls that link to individual store pages"""
         # apoteksgruppens sitemap
         logger.debug("Apoteksgruppen: Retrieves sitemap")
-        new_page, soup = self.make_soup(starting_url, parser="lxml-xml")
-        locs = soup.find_all("loc")
         no_search_hits = 0
-        for loc in locs:
+        for store_url, lastmod in self.read_sitemap(
+            starting_url, predicate=self.is_store_url
+        ):
             # yields the urls that match urls for stores
-            store_url = loc.text  # self.url_regex.findall(loc.text)
-            components = store_url.split("/")
-            http, _, domain, subcat, *remainder = components
-            if subcat == "apotek" and len(remainder) > 1 and len(components) == 7:
-                yield store_url
-                no_search_hits += 1
+            yield store_url
+            no_search_hits += 1
         if no_search_hits == 0:
             raise ScrapeFailure(f"Could not find any of apoteksgruppens store pages")
         logger.info(f"Apoteksgruppen: Found {no_search_hits} url candidates")
 
     def get_info_page(self, url):
         """Retrieves the store's opening hours and street address"""
-        new_page, soup = self.make_soup(url)
+        new_page, page = self.extract_fields(url)
         if new_page:
             # we found a new page to retrieve
             # new_page == False means that we have retrieved this page before
-            street_address = soup.find(itemprop="streetAddress").string
-            city = soup.find(itemprop="addressLocality").string
-            opening_hours = soup.select("section.pharmacy-opening-hours li")
-            store_name, *_ = soup.title.string.split(" - ")
-            # from mapquest
+            street_address = page.text("street_address")
+            city = page.text("city")
+            opening_hours = page.all("opening_hours")
+            store_name, *_ = page.text("title").split(" - ")
+            # address for the geo-location by mapquest
             address_string = f"{store_name}, {street_address}, {city}, Sweden"
-            mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(address_string)
+            # todo: add long and lat
+            # todo: is there not a zip code?
+            store = Store(
+                self.__class__.__name__,
+                url,
+                store_name,
+                address=street_address,
+                city=city,
+                geo_query=address_string,
+            )
             for day in opening_hours:
-                weekday, *hours = day.text.split()
+                weekday, *hours = text_of(day).split()
                 if len(hours) > 3:  # when "idag" is included in the opening hours
                     hours = hours[1:]
                 weekday_no = weekday_text_to_int(weekday)
-                # todo: add long and lat
-                # todo: is there not a zip code?
-                yield {
-                    "chain": self.__class__.__name__,
-                    "url": url,
-                    "store_name": store_name,
-                    "long": "",
-                    "lat": "",
-                    "address": street_address,
-                    "zip_code": "",
-                    "city": city,
-                    "datetime": datetime.now().isoformat(),
-                    "weekday": weekday,
-                    "weekday_no": weekday_no,
-                    "hours": " ".join(hours),
-                    "mq_street": mq_street,
-                    "mq_zip_code": mq_zip_code,
-                    "mq_lat": mq_latLng["lat"],
-                    "mq_long": mq_latLng["lng"],
-                }
+                store.add_hours(weekday_no, weekday, " ".join(hours))
             if not opening_hours:
                 raise ScrapeFailure(f"{store_name} had no opening hours. {url}")
+            yield store
             # else:
             #     logger.info(f"{store_name}, {weekday}: {hours}")
 
@@ -544,53 +1471,77 @@ class ApoteksgruppenSpider(MySpider):
 class ApoteketSpider(MySpider):
     #Apotekets sitemap
     START_URLS = ["https://www.apoteket.se/sitemap.xml"]
+    # the store pages are parsed from the DOM, the map <img> keeps its src
+    BROWSER_PROFILE = "fast"
+
+    FIELDS = {
+        "title": css("title"),
+        "location": css("#main > div:nth-child(1) > div > p:nth-child(1)"),
+        "map_image": css("#pharmaciesmap-root img"),
+        "opening_hours": css("ul.underlined-list li"),
+        # inside each opening hours row
+        "weekday": css("span.date"),
+        "hours": css("span.time"),
+    }
+
+    @staticmethod
+    def is_store_url(store_url):
+        """True for urls to store pages. The sitemap also lists
+        thousands of product pages."""
+        store_url_parts = store_url.split("/")
+        if len(store_url_parts) >= 4:
+            #e.g https://www.apoteket.se/apotek/apoteket-ekorren-goteborg/
+            http, _, domain, subcat, *remainder = store_url_parts
+            if subcat == "apotek" and len(remainder) > 1:
+                return "-lan/" not in store_url and "/ombud" not in store_url
+        return False
 
     def get_info_page_urls(self, starting_url):
         """Trawls the sitemap for urls that link to individual store pages"""
         logger.debug("Apoteket AB: Fetching sitemap")
-        new_page, soup = self.make_soup(starting_url, parser="lxml-xml")
-        locs = soup.find_all("loc")  # all urls
         no_search_hits = 0
-        for loc in locs:
-            store_url = loc.text
-            store_url_parts = store_url.split("/")
-            if len(store_url_parts) >= 4:
-                #e.g https://www.apoteket.se/apotek/apoteket-ekorren-goteborg/
-                http, _, domain, subcat, *remainder = store_url_parts
-                if subcat == "apotek" and len(remainder) > 1:
-                    if "-lan/" not in store_url and "/ombud" not in store_url:
-                        no_search_hits += 1
-                        yield store_url
+        for store_url, lastmod in self.read_sitemap(
+            starting_url, predicate=self.is_store_url
+        ):
+            no_search_hits += 1
+            yield store_url
         if no_search_hits == 0:
             raise ScrapeFailure(f"Could not find any of Apoteket ABs store pages")
         logger.info(f"Apoteket AB: Found {no_search_hits} url candidates")
 
-    def get_info_page(self, url):
-        """Retrieves the store's opening hours and street address"""
+    def get_info_page_fetch_options(self, url):
+        """Waits for the map to load"""
         # map_selector = ".mapImage-0-2-38"
         map_selector = "#pharmaciesmap-root > div > a > img"
         # map_selector = "#pharmaciesmap-root"
-        new_page, soup = self.make_soup(
-            url, wait_condition=lambda d: d.find_element_by_css_selector(map_selector)
+        return {
+            "wait_condition": lambda d: d.find_element_by_css_selector(map_selector)
+        }
+
+    def get_info_page(self, url):
+        """Retrieves the store's opening hours and street address"""
+        new_page, page = self.extract_fields(
+            url, **self.get_info_page_fetch_options(url)
         )
         if new_page:
-            # soup = self.make_soup(url)
             # Store name and address
-            store_name, *_ = soup.title.string.strip().split(" - ")
+            store_name, *_ = page.text("title").strip().split(" - ")
             if "Hemofili" not in store_name:
                 # Hemofili - annan aktör, Pajala is an hidden, fake store that still is in the sitemap.
-                location_selector = "#main > div:nth-child(1) > div > p:nth-child(1)"
-                store_location = soup.select(location_selector)[0].string.strip()
+                store_location = page.text("location")
+                if store_location is None:
+                    raise ScrapeFailure(f"{store_name} had no address. {url}")
+                store_location = store_location.strip()
                 *street_address, zip_city = store_location.split(",")
                 # *zip_code, city = zip_city.split()
                 zip_code, city = separate_zip_from_city(zip_city)
 
                 # geo-coordinates
-                mapimage = soup.select_one("#pharmaciesmap-root img")
+                mapimage = page.first("map_image")
                 # logger.debug(mapimage)
 
-                if mapimage:
-                    src = mapimage["src"]
+                if mapimage is not None:
+                    src = mapimage.get("src")
                     lat, long, *_ = re.findall(
                         "([0-9]{2}\.[0-9]{1,13})", src
                     )  # eller är det long, lat?
@@ -598,84 +1549,83 @@ class ApoteketSpider(MySpider):
                     logger.warning(f"No geo-info: {url}")
                     lat, long = "", ""
 
-                # from mapquest
+                # address for the geo-location by mapquest
                 # zip_code = "".join(zip_code)
                 street_address = ", ".join(street_address)
                 address_string = (
                     f"{store_name}, {street_address},{zip_code} {city}, Sweden"
                 )
-                mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(
-                    address_string
+
+                store = Store(
+                    self.__class__.__name__,
+                    url,
+                    store_name,
+                    long,
+                    lat,
+                    street_address,
+                    zip_code,
+                    city,
+                    geo_query=address_string,
                 )
 
                 # opening hours
-                opening_hours = soup.select("ul.underlined-list li")
+                opening_hours = page.all("opening_hours")
                 for day in opening_hours:
-                    try:
-                        weekday = day.select("span.date")[0].string.strip()
-                        hours = day.select("span.time")[0].string.strip()
-                        weekday_no = weekday_text_to_int(weekday)
-                    except IndexError:
+                    weekday = page.text("weekday", day)
+                    hours = page.text("hours", day)
+                    if weekday is None or hours is None:
                         raise ScrapeFailure(f"{store_name} had no opening hours. {url}")
-                    yield {
-                        "chain": self.__class__.__name__,
-                        "url": url,
-                        "store_name": store_name,
-                        "long": long,
-                        "lat": lat,
-                        "address": street_address,
-                        "zip_code": zip_code,
-                        "city": city,
-                        "datetime": datetime.now().isoformat(),
-                        "weekday": weekday,
-                        "weekday_no": weekday_no,
-                        "hours": hours,
-                        "mq_street": mq_street,
-                        "mq_zip_code": mq_zip_code,
-                        "mq_lat": mq_latLng["lat"],
-                        "mq_long": mq_latLng["lng"],
-                    }
+                    weekday, hours = weekday.strip(), hours.strip()
+                    weekday_no = weekday_text_to_int(weekday)
+                    store.add_hours(weekday_no, weekday, hours)
                 if not opening_hours:
                     if "ICA NÄRA" in store_name:
                         # We cannot expect opening hours here.
                         pass
                     else:
                         raise ScrapeFailure(f"{store_name} had no opening hours. {url}")
+                yield store
 
 
 class LloydsSpider(MySpider):
 
     START_URLS = ["https://www.lloydsapotek.se/sitemap.xml"]
 
+    FIELDS = {
+        "title": css("title"),
+        "location": css(".hidden-xs"),
+        "opening_hours": css("div.col-md-6:nth-child(1) > div:nth-child(2)"),
+    }
+
     def get_info_page_urls(self, starting_url):
         """Trawls the sitemap for urls that link to individual store pages"""
         logger.debug("Lloyds Apotek: Hämtar sitemap")
-        new_page, soup = self.make_soup(starting_url, parser="lxml-xml")
-        locs = soup.find_all("loc")
-        new_page, stores_sitemap = self.make_soup(locs[4].text, parser="lxml-xml")
-        store_list = stores_sitemap.select("loc")
-        for store in store_list:
-            yield store.text
-        if not store_list:
+        # the fifth sitemap in the sitemap index lists the stores
+        sitemaps = list(self.read_sitemap(starting_url, sitemap_predicate=False))
+        stores_sitemap, _ = sitemaps[4]
+        no_stores = 0
+        for store_url, lastmod in self.read_sitemap(stores_sitemap):
+            no_stores += 1
+            yield store_url
+        if not no_stores:
             raise ScrapeFailure(f"Could not find any of Lloyds store pages")
-        logger.info(f"Lloyds: Found {len(store_list)} url candidates")
+        logger.info(f"Lloyds: Found {no_stores} url candidates")
 
     def get_info_page(self, url):
         """Retrieves the store's opening hours and street address"""
-        new_page, soup = self.make_soup(url)
+        new_page, page = self.extract_fields(url)
         if new_page:
             # Store name and address
             # todo: fix this
-            store_name, *_ = soup.title.string.strip().split(" | ")
+            store_name, *_ = page.text("title").strip().split(" | ")
         if store_name not in [
             "Parallellexport lager",
             "Lloydsapotek Handen Handenterminalen",
             "LloydsApotek Uppsala Samariten2",
             "LloydsApotek Lund Västra Mårtensgatan2",
         ]:
-            location_selector = ".hidden-xs"
-            store_location = soup.select_one(location_selector)
-            street_address, zip_code, city = store_location.get_text().split("\xa0")
+            store_location = page.text("location")
+            street_address, zip_code, city = store_location.split("\xa0")
             zip_code = zip_code.strip()
             street_address = street_address.strip()
 
@@ -685,16 +1635,13 @@ class LloydsSpider(MySpider):
             *_, url_params = url.split("?")
             lat, long, *_ = re.findall("\d{2}\.\d{1,13}", url_params)
 
-            # mapquest
+            # address for the geo-location by mapquest
             address_string = (
                 f"{store_name}, {street_address}, {zip_code} {city}, Sweden"
             )
-            mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(address_string)
 
             # opening hours
-            opening_hours = soup.select_one(
-                "div.col-md-6:nth-child(1) > div:nth-child(2)"
-            )
+            opening_hours = page.first("opening_hours")
             # Example
             # """Ordinarie öppettider
             # Måndag-Fredag: 09:00-17:00
@@ -702,43 +1649,141 @@ class LloydsSpider(MySpider):
             # Avvikande öppettider
             # Valborgsmässoaf (30/04): 07:30-19:00
             # Första maj (01/05): 11:00-16:00"""
-            txt = opening_hours.get_text(";").split(";")
+            txt = text_of(opening_hours, ";").split(";")
             rows = [row.strip() for row in txt if ":" in row]
+            store = Store(
+                self.__class__.__name__,
+                url,
+                store_name,
+                long,
+                lat,
+                street_address,
+                zip_code,
+                city,
+                geo_query=address_string,
+            )
             for day in rows:
                 weekday, *hours = day.split(":")
                 weekday_no = weekday_text_to_int(weekday)
-                yield {
-                    "chain": self.__class__.__name__,
-                    "url": url,
-                    "store_name": store_name,
-                    "long": long,
-                    "lat": lat,
-                    "address": street_address,
-                    "zip_code": zip_code,
-                    "city": city,
-                    "datetime": datetime.now().isoformat(),
-                    "weekday": weekday,
-                    "weekday_no": weekday_no,
-                    "hours": ":".join(hours).strip(),
-                    "mq_street": mq_street,
-                    "mq_zip_code": mq_zip_code,
-                    "mq_lat": mq_latLng["lat"],
-                    "mq_long": mq_latLng["lng"],
-                }
+                store.add_hours(weekday_no, weekday, ":".join(hours).strip())
             if not rows:
                 raise ScrapeFailure(
                     f"Could not extract opening hours from '{store_name}'"
                 )
+            yield store
 
 
 class KronansApotekSpider(MySpider):
 
     START_URLS = ["https://www.kronansapotek.se/sitemap.xml"]
 
-    def get_current_store_name(self, soup):
-        store_name_selector = "h2.typography-title"
-        store_name = soup.select_one(store_name_selector).string
-        return store_name
+    FIELDS = {
+        "store_name": css("h2.typography-title"),
+        "street_address": css("address.typography-subtitle > p:nth-child(1)"),
+        "zip_city": css("address.typography-subtitle > span:nth-child(2)"),
+        "opening_hours": css(
+            "div.container:nth-child(3) > div:nth-child(2) > div:nth-child(1) > div:nth-child(1) > section:nth-child(2) > ul:nth-child(2) li"
+        ),
+        # inside each opening hours row
+        "spans": css("span"),
+    }
+
+    STORE_NAME_SELECTOR = "h2.typography-title"
+
+    STORE_FINDER_URL = "https://www.kronansapotek.se/store-finder/"
+    # resolves the store page urls of all the stores in the sitemap
+    # before the store pages are fetched, on one store finder page
+    RESOLVE_STORE_PAGES_FIRST = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # store name -> store page url, kept between days
+        self.store_page_urls = JSONShelve(
+            str(Path.joinpath(self.cache_parent_directory, "kronans_store_pages.json"))
+        )
+        # the fetch workers save the store page urls they find
+        self.store_page_urls_lock = threading.Lock()
+
+    def sync_store_page_urls(self):
+        with self.store_page_urls_lock:
+            self.store_page_urls.sync()
+
+    @staticmethod
+    def store_name_from_url(url):
+        """The links in Kronan's sitemap end with the name of the store"""
+        return p.unquote(url).split("/")[-1].split("?")[0]
+
+    def find_store_page_url(self, store_name, pause=60):
+        """Searches for a store with the "hitta butik" search function
+        and returns the url of the first search result, or None.
+        The store finder page is only loaded if the browser is not
+        already on it, ie several stores can be searched for in a row."""
+        driver = self.driver
+        wait = WebDriverWait(
+            driver, pause, ignored_exceptions=[StaleElementReferenceException]
+        )
+        # the CSS locators of the search form and the results
+        search_field_locator = (By.ID, "gps-search")
+        search_button_locator = (By.CSS_SELECTOR, ".button")
+        list_tab_locator = (By.CSS_SELECTOR, "li:nth-child(2) > label")
+        first_result_locator = (By.CSS_SELECTOR, "li:nth-child(1) .link:nth-child(2)")
+
+        def new_first_result_url(driver):
+            # the results of the previous search are replaced, even if
+            # this search finds the same store first
+            if previous_results and not EC.staleness_of(previous_results[0])(driver):
+                return False
+            links = driver.find_elements(*first_result_locator)
+            return (links[0].get_attribute("href") or False) if links else False
+
+        # the results are polled, so find_elements must not wait
+        # IMPLICIT_WAIT seconds each time there are none
+        driver.implicitly_wait(0)
+        try:
+            if not driver.current_url.startswith(self.STORE_FINDER_URL):
+                driver.get(self.STORE_FINDER_URL)
+            # the results of the previous search, if any
+            previous_results = driver.find_elements(*first_result_locator)
+            # We enter the name of the store in the search field
+            search_field = wait.until(EC.element_to_be_clickable(search_field_locator))
+            search_field.clear()
+            search_field.send_keys(store_name)
+            # We click the search button
+            driver.find_element(*search_button_locator).click()
+            # We click on the list "LISTA" tab as soon as it shows up
+            wait.until(EC.element_to_be_clickable(list_tab_locator)).click()
+            # and wait for the first search result of this search
+            return wait.until(new_first_result_url)
+        except (TimeoutException, NoSuchElementException):
+            # We failed our search-and-click dance
+            logger.error(f"Could not find the store page for {store_name}")
+            return None
+        finally:
+            driver.implicitly_wait(self.IMPLICIT_WAIT)
+
+    def resolve_store_page_urls(self, urls, pause=60):
+        """Finds the store page urls of the stores that are neither in the
+        daily cache nor in store_page_urls, in one pass"""
+        store_names = []
+        for url in urls:
+            store_name = self.store_name_from_url(url)
+            if url in self.cache or store_name in self.store_page_urls:
+                continue
+            stored_page = self.page_store.get(url)
+            if stored_page and self.is_fresh(stored_page, url):
+                continue
+            store_names.append(store_name)
+        if not store_names or self.offline:
+            return
+        logger.info(f"Kronans: Searching for {len(store_names)} store pages")
+        for store_name in store_names:
+            self.rate_limiter.wait(self.STORE_FINDER_URL)
+            with self.metrics.timer("store_search"):
+                store_page_url = self.find_store_page_url(store_name, pause)
+            if store_page_url:
+                with self.store_page_urls_lock:
+                    self.store_page_urls[store_name] = store_page_url
+        self.sync_store_page_urls()
 
     def get_url(self, url, wait_condition=False, pause=60):
         """
@@ -748,112 +1793,88 @@ class KronansApotekSpider(MySpider):
         valid store pages. Therefore we have to extract the
         name of the store from the url from the sitemap,
         and then search for the store using their search
-        engine."""
+        engine. The url of the store page is saved in
+        store_page_urls, so the search is only done once."""
         if ".xml" in url:
             # The url is a sitemap
-            # We just downloading it using the standard function
+            # We just downloading it using the standard function,
+            # ie a plain http request
             return super().get_url(url, wait_condition,pause=pause)
-        else:
-            # Url is not a sitemap
-            # We find the store page by searching for it
-            # with the "hitta butik" search function
-
-            # We extract the store name from the url's GET command
-            unquoted_url = p.unquote(url)
-            store_name = unquoted_url.split("/")[-1].split("?")[0]
-            # the CSS locator for the search field
-            search_field_locator = "gps-search"
-            search_page_url = "https://www.kronansapotek.se/store-finder/"
-            self.driver.get(search_page_url)
+        # Url is not a sitemap
+        store_name = self.store_name_from_url(url)
+        store_page_url = self.store_page_urls.get(store_name)
+        searched = False
+        while True:
+            if not store_page_url:
+                # We find the store page by searching for it
+                # with the "hitta butik" search function
+                store_page_url = self.find_store_page_url(store_name, pause)
+                searched = True
+                if not store_page_url:
+                    return False, None
+                with self.store_page_urls_lock:
+                    self.store_page_urls[store_name] = store_page_url
+            with self.metrics.timer("page_load", url=url, via="firefox"):
+                self.driver.get(store_page_url)
             try:
-                # We wait for the search field to show up
-                element = WebDriverWait(self.driver, pause).until(
-                    EC.presence_of_element_located((By.ID, search_field_locator))
-                )
+                # We wait until the page shows the opening hours
+                with self.metrics.timer("wait_condition", url=url):
+                    WebDriverWait(self.driver, pause).until(
+                        EC.text_to_be_present_in_element(
+                            (By.CSS_SELECTOR, "h3.typography-subtitle"), "Öppettider"
+                        )
+                    )
+                return True, self.driver.page_source
             except TimeoutException:
-                # Waited for an element that never showed up
-                logger.error(
-                    f"TimeoutException: The html part we waited for never showed up in {url}"
-                )
-                logger.error(f"Could not retrieve {search_page_url}")
-                return False, None
-            try:
-                # We try to find all the elements for Selenium to click on
-                # We start by searching for a store
-                # We enter the name of the store in the search field
-                self.driver.find_element(By.ID, search_field_locator).send_keys(
-                    store_name
-                )
-                # We click the search button
-                self.driver.find_element(By.CSS_SELECTOR, ".button").click()
-                time.sleep(1)
-                # We now get a page with search results
-                # We click on the list "LISTA" tab
-                self.driver.find_element(
-                    By.CSS_SELECTOR, "li:nth-child(2) > label"
-                ).click()
-                time.sleep(1)
-                # We click on the link for the first search result
-                self.driver.find_element(
-                    By.CSS_SELECTOR, "li:nth-child(1) .link:nth-child(2)"
-                ).click()
-                time.sleep(2)
-                # We now test that the found page actually contains
-                # opening hours
-                required_header_selector = "h3.typography-subtitle"
-                testheader = self.driver.find_element(
-                    By.CSS_SELECTOR, required_header_selector
-                ).text
-                if testheader == "Öppettider":
-                    # We retrieve the page source for the store page
-                    page_source = self.driver.page_source
-                    return True, page_source
-                else:
-                    # Nope, this is not a page with opening hours
+                # Nope, this is not a page with opening hours
+                if searched:
                     logger.error(f"Could not find any opening hours for {store_name}")
                     return False, None
-            except NoSuchElementException:
-                # We failed our search-and-click dance
-                logger.error(f"Could not find any opening hours for {store_name}")
-                return False, None
+                # The saved url may be out of date, ie we search again
+                logger.warning(f"No opening hours on {store_page_url}, searching again")
+                store_page_url = None
+
+    def write_cache(self):
+        super().write_cache()
+        self.sync_store_page_urls()
 
     def get_info_page_urls(self, starting_url):
         """Trawls the sitemap for urls that link to individual store pages"""
         logger.debug("Kronans Apotek: Hämtar sitemap")
-        new_page, soup = self.make_soup(starting_url, parser="lxml-xml")
         # there is a bug in either the xml parser or
         # - more likely - in kronans sitemap index
-        # that makes the parser choke
-        # instead I have to find the links using plain old
-        # regex.
-        links = re.findall("https://www\..*\.xml", soup.text)
-        next_url = links[4]
-        new_page, stores_sitemap = self.make_soup(next_url, parser="lxml-xml")
-        store_list = stores_sitemap.select("loc")
-        for store in store_list:
-            yield store.text
-        if not store_list:
+        # that makes the parser choke.
+        # read_sitemap then falls back to finding
+        # the links using plain old regex.
+        # The fifth sitemap lists the stores
+        sitemaps = list(self.read_sitemap(starting_url, sitemap_predicate=False))
+        next_url, _ = sitemaps[4]
+        store_urls = [store_url for store_url, lastmod in self.read_sitemap(next_url)]
+        if self.RESOLVE_STORE_PAGES_FIRST:
+            self.resolve_store_page_urls(store_urls)
+        no_stores = 0
+        for store_url in store_urls:
+            no_stores += 1
+            yield store_url
+        if not no_stores:
             raise ScrapeFailure(f"Could not find any of Kronans store pages")
-        logger.info(f"Kronans: Found {len(store_list)} url candidates")
+        logger.info(f"Kronans: Found {no_stores} url candidates")
 
     def get_info_page(self, url):
         """Retrieves the store's opening hours and street address"""
-        new_page, soup = self.make_soup(url)
+        new_page, page = self.extract_fields(url)
         if new_page:
             # Store name and address
-            store_name = self.get_current_store_name(soup)
+            store_name = page.text("store_name")
             if not (store_name and "Kronans Apotek" in store_name):
                 raise ScrapeFailure(f"{url} did not have a valid store name")
-            street_address_selector = "address.typography-subtitle > p:nth-child(1)"
-            street_address = soup.select_one(street_address_selector)
+            street_address = page.text("street_address")
             if street_address:
                 # url is a valid store page
-                street_address = street_address.string
-                zip_city_selector = "address.typography-subtitle > span:nth-child(2)"
                 # The first word is the zip code
                 # The rest is assumed to be the name
                 # of the city
-                zip_code, *city = soup.select_one(zip_city_selector).string.split()
+                zip_code, *city = page.text("zip_city").split()
                 # We join the name of the city together
                 # eg. ["Västra","Frölunda"] becomes "Västra Frölunda"
                 city = " ".join(city)
@@ -864,42 +1885,90 @@ class KronansApotekSpider(MySpider):
                 *_, url_params = url.split("?")
                 lat, long, *_ = re.findall("\d{2}\.\d{1,8}", url_params)
 
-                # mapquest
+                # address for the geo-location by mapquest
                 address_string = (
                     f"{store_name}, {street_address}, {zip_code} {city}, Sweden"
                 )
-                mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(
-                    address_string
-                )
 
                 # opening hours
-                opening_hours_selector = "div.container:nth-child(3) > div:nth-child(2) > div:nth-child(1) > div:nth-child(1) > section:nth-child(2) > ul:nth-child(2)"
-                opening_hours = soup.select_one(opening_hours_selector).find_all("li")
+                opening_hours = page.all("opening_hours")
                 if not opening_hours:
                     raise ScrapeFailure(
                         f"Could not extract opening hours from {store_name}"
                     )
+                store = Store(
+                    self.__class__.__name__,
+                    url,
+                    store_name,
+                    long,
+                    lat,
+                    street_address.strip(),
+                    zip_code.strip(),
+                    city.strip(),
+                    geo_query=address_string,
+                )
                 for row in opening_hours:
-                    weekday, hours = row.find_all("span")
-                    weekday_no = weekday_text_to_int(weekday.text)
-                    yield {
-                        "chain": self.__class__.__name__,
-                        "url": url,
-                        "store_name": store_name,
-                        "long": long,
-                        "lat": lat,
-                        "address": street_address.strip(),
-                        "zip_code": zip_code.strip(),
-                        "city": city.strip(),
-                        "datetime": datetime.now().isoformat(),
-                        "weekday": weekday.text.strip(),
-                        "weekday_no": weekday_no,
-                        "hours": hours.text.strip(),
-                        "mq_street": mq_street,
-                        "mq_zip_code": mq_zip_code,
-                        "mq_lat": mq_latLng["lat"],
-                        "mq_long": mq_latLng["lng"],
-                    }
+                    weekday, hours = [text_of(span) for span in page.all("spans", row)]
+                    weekday_no = weekday_text_to_int(weekday)
+                    store.add_hours(weekday_no, weekday.strip(), hours.strip())
+                yield store
+
+
+def test_kronans_store_name_from_url():
+    url = "https://www.kronansapotek.se/store/Kronans%20Apotek%20Kungsgatan?lat=57.70&long=11.97"
+    assert KronansApotekSpider.store_name_from_url(url) == "Kronans Apotek Kungsgatan"
+
+
+def test_kronans_find_store_page_url(tmp_path):
+    class Element(object):
+        def __init__(self, href=None):
+            self.href, self.stale = href, False
+
+        def is_displayed(self):
+            return True
+
+        def is_enabled(self):
+            if self.stale:
+                raise StaleElementReferenceException()
+            return True
+
+        def get_attribute(self, name):
+            return self.href
+
+        def clear(self):
+            pass
+
+        def click(self):
+            pass
+
+        def send_keys(self, text):
+            # each search replaces the result list
+            for result in driver.results:
+                result.stale = True
+            driver.results = [Element(f"https://www.kronansapotek.se/store/{text.split()[0]}")]
+
+    class Driver(object):
+        current_url = KronansApotekSpider.STORE_FINDER_URL
+        results, implicit_waits = [], []
+
+        def implicitly_wait(self, seconds):
+            self.implicit_waits.append(seconds)
+
+        def find_element(self, by, value):
+            return Element()
+
+        def find_elements(self, by, value):
+            return self.results if "link" in value else [Element()]
+
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    spider = KronansApotekSpider(tmp_path, config_path, tmp_path)
+    spider.driver = driver = Driver()
+    # two stores in a row with the same first search result
+    for store_name in ("Centrum Kungsgatan", "Centrum Torget"):
+        url = spider.find_store_page_url(store_name, pause=1)
+        assert url == "https://www.kronansapotek.se/store/Centrum"
+    assert driver.implicit_waits == [0, 60, 0, 60]
 
 
 class HjartatSpider(MySpider):
@@ -933,15 +2002,136 @@ class HjartatSpider(MySpider):
     #     "https://www\.apotekhjartat\.se/hitta-apotek-hjartat/\w+/apotek_hjartat_.+/"
     # )
 
+    FIELDS = {
+        "title": css("title"),
+        "info_box": css("#findPharmacyContentHolder2"),
+        "address": css(
+            "#findPharmacyContentHolder2 > div:nth-child(2) > p:nth-child(2)"
+        ),
+        "map_link": css("div.pharmacyMap a"),
+        "hours": css("span.opening_Hours"),
+        "weekdays": css("span.day_of_week"),
+    }
+    # reads the stores from the json the region pages load, if possible,
+    # instead of rendering the region and store pages
+    USE_STORE_API = True
+    API_HOST = "apotekhjartat.se"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # region page -> the json urls with stores it loads, kept between days
+        self.api_urls = JSONShelve(
+            str(Path.joinpath(self.cache_parent_directory, "hjartat_api.json"))
+        )
+        self.api_stores = {}  # normalized store url -> Store
+
+    def use_http(self, url, wait_condition=False):
+        if any(url in api_urls for api_urls in self.api_urls.values()):
+            return True
+        return super().use_http(url, wait_condition)
+
+    def needs_page(self, url):
+        return super().needs_page(url) and normalize_url(url) not in self.api_stores
+
+    def restore_info_page_urls(self, start_url):
+        """The stores found in the store api are needed as well"""
+        if self.USE_STORE_API:
+            self.read_store_api(start_url)
+
+    def capture_store_api(self, start_url):
+        """Finds the json requests made by the region page in Firefox that
+        return stores, and saves their urls for the coming days"""
+        try:
+            xhr_urls = self.driver.execute_script(XHR_URLS_SCRIPT) or []
+        except Exception as script_error:
+            logger.warning(f"Hjärtat: Could not list the requests of {start_url}: {script_error}")
+            return
+        api_urls = []
+        for xhr_url in dict.fromkeys(xhr_urls):
+            if not p.urlsplit(xhr_url).netloc.endswith(self.API_HOST):
+                continue
+            self.rate_limiter.wait(xhr_url)
+            r = self.http_request(xhr_url)
+            if r is not None and any(find_stores(r.text)):
+                api_urls.append(xhr_url)
+        if api_urls:
+            logger.info(f"Hjärtat: Found the store api of {start_url}: {api_urls}")
+            self.api_urls[start_url] = api_urls
+            self.api_urls.sync()
+
+    def read_store_api(self, start_url):
+        """Reads the stores of a region from the json urls found by
+        capture_store_api, with plain http requests.
+        Returns the urls of the stores, or [] if it failed."""
+        store_urls = []
+        for api_url in self.api_urls.get(start_url, []):
+            try:
+                _, source = self.get_page_source(api_url)
+            except ScrapeFailure:
+                return []
+            with self.metrics.timer("parse", url=api_url):
+                for fields in find_stores(source):
+                    url = self.api_store_url(api_url, fields)
+                    self.api_stores[normalize_url(url)] = self.store_from_api(url, fields)
+                    store_urls.append(url)
+        return store_urls
+
+    @staticmethod
+    def api_store_url(api_url, fields):
+        """The url of a store found in the json. Stores without a page
+        get the api url with the store name as a query parameter, which
+        (unlike a #fragment) is kept by normalize_url"""
+        if fields["url"]:
+            return p.urljoin(api_url, fields["url"])
+        separator = "&" if p.urlsplit(api_url).query else "?"
+        return f"{api_url}{separator}{p.urlencode({'store': fields['name']})}"
+
+    def store_from_api(self, url, fields):
+        """A store from the fields found in the json"""
+        address_string = (
+            f"{fields['name']}, {fields['address']}, {fields['zip_code']} {fields['city']}, Sweden"
+        )
+        store = Store(
+            self.__class__.__name__,
+            url,
+            fields["name"],
+            fields["long"],
+            fields["lat"],
+            fields["address"],
+            fields["zip_code"],
+            fields["city"],
+            geo_query=address_string,
+        )
+        for weekday, hours in fields["opening_hours"]:
+            store.add_hours(weekday_text_to_int(weekday), weekday, hours)
+        return store
+
     def get_info_page_urls(self, start_url):
+        if self.USE_STORE_API:
+            store_urls = self.read_store_api(start_url)
+            if store_urls:
+                logger.info(f"Hjärtat: {len(store_urls)} stores from the store api of {start_url}")
+                self.metrics.incr("store_api", result="ok")
+                yield from store_urls
+                return
+            if start_url in self.api_urls:
+                # falls back to the rendered pages
+                logger.warning(f"Hjärtat: The store api of {start_url} did not work")
+                self.metrics.incr("store_api", result="failed")
+        yield from self.get_rendered_info_page_urls(start_url)
+
+    def get_rendered_info_page_urls(self, start_url):
+        """Finds the store pages in a region page rendered by Firefox"""
         # todo: pröva 3 ggr, sedan ge upp
         # todo: lägg till cache?
+        hits_found = []
         try:
             # test if list of stores is already in the cache file
             hits_found = self.cache["hjartat_store_list"][start_url]
             logger.info(f"Hjartat store list from cache: {start_url}")
         except KeyError:
             # list not in cache
+            self.rate_limiter.wait(start_url)
             self.driver.get(start_url)
 
             def wanted_elements(driver):
@@ -958,6 +2148,8 @@ class HjartatSpider(MySpider):
                     f"TimeoutException: The search result we waited for never showed up in {start_url}"
                 )
             store_links = wanted_elements(self.driver)
+            if self.USE_STORE_API:
+                self.capture_store_api(start_url)
             logger.info(f"Hjärtat: Looking for correct links in {start_url}")
             hits_found = []
             for item in store_links:
@@ -968,9 +2160,11 @@ class HjartatSpider(MySpider):
                 if "hitta-apotek-hjarta" in url:
                     if len(url.split("/")) >= 7:
                         hits_found.append(url)
-            if "hjartat_store_list" not in self.cache:
-                self.cache["hjartat_store_list"] = {}
-            self.cache["hjartat_store_list"][start_url] = hits_found
+            # the cache only saves values when they are set,
+            # so the whole store list is written back
+            store_list = self.cache.get("hjartat_store_list", {})
+            store_list[start_url] = hits_found
+            self.cache["hjartat_store_list"] = store_list
             self.cache.sync()
         finally:
             if not hits_found:
@@ -980,74 +2174,106 @@ class HjartatSpider(MySpider):
                 for hit in hits_found:
                     yield hit
 
-    def get_info_page(self, url):
-        """Retrieves the store's opening hours and street address"""
+    def get_info_page_fetch_options(self, url):
+        """Waits for the map link to load"""
         detail_pane_selector = "div.pharmacyMap a"
-        new_page, soup = self.make_soup(
-            url,
-            wait_condition=lambda d: d.find_element_by_css_selector(
+        return {
+            "wait_condition": lambda d: d.find_element_by_css_selector(
                 detail_pane_selector
             ),
-            pause=240
+            "pause": 240,
+        }
+
+    def get_info_page(self, url):
+        """Retrieves the store's opening hours and street address"""
+        if not self.needs_page(url):
+            # found in the store api
+            yield self.api_stores[normalize_url(url)]
+            return
+        new_page, page = self.extract_fields(
+            url, **self.get_info_page_fetch_options(url)
         )
         if new_page:
-            info_box = soup.find(id="findPharmacyContentHolder2")
-            if not info_box:
+            info_box = page.first("info_box")
+            if info_box is None:
                 raise ScrapeFailure(
                     f"Could not find the element containing opening hours in {url}"
                 )
             else:
                 # Store name and address
-                *_, store_name = soup.title.string.strip().split(" vid ")
+                *_, store_name = page.text("title").strip().split(" vid ")
 
                 # postal adress
-                adr = soup.select_one(
-                    "#findPharmacyContentHolder2 > div:nth-child(2) > p:nth-child(2)"
-                )
-                zip_code, city, *street_address = adr.text.strip().split("\n")
+                adr = page.text("address")
+                zip_code, city, *street_address = adr.strip().split("\n")
                 street_address = " ".join(street_address)
 
                 # geo-coordinates
-                map_link = soup.select_one("div.pharmacyMap a")
-                if map_link:
+                map_link = page.first("map_link")
+                if map_link is not None:
                     lat, long = re.findall(
-                        "ll=(\d{2}\.\d{1,10}),(\d{2}\.\d{1,10})", map_link["href"]
+                        "ll=(\d{2}\.\d{1,10}),(\d{2}\.\d{1,10})", map_link.get("href")
                     )[0]
                 else:
                     lat, long = "", ""
 
                 # opening hours
-                h = soup.select("span.opening_Hours")
-                d = soup.select("span.day_of_week")
-                opening_hours = [(day.text, hours.text) for day, hours in zip(d, h)]
+                h = page.all("hours")
+                d = page.all("weekdays")
+                opening_hours = [
+                    (text_of(day), text_of(hours)) for day, hours in zip(d, h)
+                ]
 
-                # mapquest
+                # address for the geo-location by mapquest
                 address_string = (
                     f"{store_name}, {street_address}, {zip_code} {city}, Sweden"
                 )
-                mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(
-                    address_string
+                store = Store(
+                    self.__class__.__name__,
+                    url,
+                    store_name,
+                    long,
+                    lat,
+                    street_address,
+                    zip_code,
+                    city,
+                    geo_query=address_string,
                 )
                 for weekday, hours in opening_hours:
                     weekday_no = weekday_text_to_int(weekday)
-                    yield {
-                        "chain": self.__class__.__name__,
-                        "url": url,
-                        "store_name": store_name,
-                        "long": long,
-                        "lat": lat,
-                        "address": street_address,
-                        "zip_code": zip_code,
-                        "city": city,
-                        "datetime": datetime.now().isoformat(),
-                        "weekday": weekday,
-                        "weekday_no": weekday_no,
-                        "hours": hours,
-                        "mq_street": mq_street,
-                        "mq_zip_code": mq_zip_code,
-                        "mq_lat": mq_latLng["lat"],
-                        "mq_long": mq_latLng["lng"],
-                    }
+                    store.add_hours(weekday_no, weekday, hours)
+                yield store
+
+
+def test_hjartat_api_store_url():
+    api_url = "https://www.apotekhjartat.se/api/stores?r=1"
+    urls = [
+        HjartatSpider.api_store_url(api_url, {"url": None, "name": name})
+        for name in ("Apotek Hjärtat Ica Maxi", "Apotek Hjärtat Centrum")
+    ]
+    frontier = CrawlFrontier()
+    assert all(frontier.add(url) for url in urls)
+    assert len({normalize_url(url) for url in urls}) == 2
+    assert HjartatSpider.api_store_url(api_url, {"url": "/a/", "name": "A"}) == (
+        "https://www.apotekhjartat.se/a/"
+    )
+
+
+def test_hjartat_offline_region_page(tmp_path):
+    config_path = tmp_path.joinpath("test.secrets")
+    config_path.write_text("[mapquest]\nkey = test\n")
+    spider = HjartatSpider(
+        tmp_path,
+        config_path,
+        tmp_path,
+        ignore_errors_when_parsing_info_page=True,
+        rate_limit=1e9,
+        offline=True,
+    )
+    spider.START_URLS = spider.START_URLS[:2]
+    # the region pages are not in the cache, and Firefox is not started
+    assert list(spider.scrape()) == []
+    assert spider.checkpoint.urls(spider.START_URLS[0]) is None
 
 
 class SOAFSpider(MySpider):
@@ -1096,33 +2322,22 @@ class SOAFSpider(MySpider):
                     ]
                     if "Kontakt:" not in store_name:
                         # skips the box with SOAFs contact info
-                        # mapquest
+                        # address for the geo-location by mapquest
                         zip_city_region = ",".join(zip_city_region)
                         address_string = f"{store_name}, {street_address},  {zip_city_region}, Sweden"
-                        mq_street, mq_zip_code, mq_latLng = self.address_to_long_lat(
-                            address_string
+                        store = Store(
+                            self.__class__.__name__,
+                            url,
+                            store_name,
+                            address=street_address,
+                            zip_code=" ",
+                            city=zip_city_region,
+                            geo_query=address_string,
                         )
                         for weekday in weekdays:
                             weekday_no = weekday_text_to_int(weekday)
-                            zip_code = " "
-                            yield {
-                                "chain": self.__class__.__name__,
-                                "url": url,
-                                "store_name": store_name,
-                                "long": "",
-                                "lat": "",
-                                "address": street_address,
-                                "zip_code": zip_code,
-                                "city": zip_city_region,
-                                "datetime": datetime.now().isoformat(),
-                                "weekday": weekday,
-                                "weekday_no": weekday_no,
-                                "hours": "",
-                                "mq_street": mq_street,
-                                "mq_zip_code": mq_zip_code,
-                                "mq_lat": mq_latLng["lat"],
-                                "mq_long": mq_latLng["lng"],
-                            }
+                            store.add_hours(weekday_no, weekday, "")
+                        yield store
                 nr += 1
 
             else:
@@ -1130,10 +2345,86 @@ class SOAFSpider(MySpider):
                 break
 
     def scrape(self):
-        for row in self.get_members_page(self.START_URLS):
-            yield row
+        for store in self.get_members_page(self.START_URLS):
+            yield store
         if self.quit_when_finished:
-            self.driver.quit()
+            self.quit_driver()
+
+
+# the chains on the command line and their spiders
+CHAINS = {
+    "apoteksgruppen": ApoteksgruppenSpider,
+    "apoteket": ApoteketSpider,
+    "lloyds": LloydsSpider,
+    "kronans": KronansApotekSpider,
+    "hjartat": HjartatSpider,
+    "soaf": SOAFSpider,
+}
+
+
+def scrape_chain(
+    chain_name, spider_class, spider_options, output_directory, output_format="xlsx"
+):
+    """Scrapes one pharmacy chain and writes the result to a xlsx, csv or parquet file.
+    Returns the path to the file and the page statistics of the chain.
+    Runs in a separate process when several chains are scraped in parallel.
+    When resuming, a chain that was finished is not scraped again, and the
+    output file of an unfinished chain is written over."""
+    start_time = time.time()
+    spider = spider_class(**spider_options)
+    previous_output = spider.checkpoint.output()
+    if previous_output and Path(previous_output["path"]).suffix == f".{output_format}":
+        path_to_output_file = previous_output["path"]
+    else:
+        path_to_output_file = str(
+            Path.joinpath(
+                Path(output_directory),
+                f"{chain_name}_{datetime.now().isoformat().replace(':', '_')}.{output_format}",
+            )
+        )
+    if (
+        previous_output
+        and previous_output["finished"]
+        and previous_output["path"] == path_to_output_file
+        and Path(path_to_output_file).is_file()
+    ):
+        logger.info(f"{chain_name} was finished by the previous run: {path_to_output_file}")
+    else:
+        spider.write_output(path_to_output_file, output_format)
+    return {
+        "chain": chain_name,
+        "path": path_to_output_file,
+        "visited_pages": spider.NO_VISITED_PAGES,
+        "ok_pages": spider.NO_OK_PAGES,
+        "seconds": time.time() - start_time,
+        "metrics": spider.metrics.as_dict(),
+    }
+
+
+def merge_output_files(paths, path_to_merged_file, output_format="xlsx"):
+    """Concatenates the per-chain output files into one file,
+    one row at a time"""
+    paths = [path for path in paths if Path(path).is_file()]
+    if paths:
+        rows = (row for path in paths for row in read_rows(path))
+        write_rows(rows, path_to_merged_file, output_format)
+        logger.info(f"Wrote merged result to {path_to_merged_file}")
+
+
+def log_crawl_statistics(results):
+    """Writes the page statistics of each chain to the log"""
+    for result in results:
+        failed_pages = result["visited_pages"] - result["ok_pages"]
+        logger.info(
+            f"{result['chain']}: {failed_pages} out of {result['visited_pages']} pages failed "
+            f"in {result['seconds']:.0f} s"
+        )
+    logger.info(
+        f"Total: {sum(r['visited_pages'] for r in results)} pages visited, "
+        f"{sum(r['ok_pages'] for r in results)} ok"
+    )
+    for line in summary_lines([result["metrics"] for result in results]):
+        logger.info(line)
 
 
 if __name__ == "__main__":
@@ -1141,16 +2432,14 @@ if __name__ == "__main__":
     #extracted using the docopt module
     #See http://docopt.org/
     arguments = docopt(__doc__, version="skrapa 0.2")
+    # --replay=<date> regenerates the output of that day
+    output_date = arguments["--replay"] or f"{datetime.now().strftime('%G-%m-%d')}"
     if not arguments["--output"]:
         output_parent_directory = Path("output")
-        output_directory = Path.joinpath(
-            output_parent_directory, Path(f"{datetime.now().strftime('%G-%m-%d')}")
-        )
+        output_directory = Path.joinpath(output_parent_directory, Path(output_date))
     else:
         output_parent_directory = Path(arguments["--output"])
-        output_directory = Path.joinpath(
-            output_parent_directory, Path(f"{datetime.now().strftime('%G-%m-%d')}")
-        )
+        output_directory = Path.joinpath(output_parent_directory, Path(output_date))
     if not output_directory.is_dir():
         # create output directory if needed
         output_directory.mkdir(parents=True)
@@ -1158,32 +2447,34 @@ if __name__ == "__main__":
     #####################################
     ## logging using the loguru module ##
     #####################################
+    # several processes write to the same logs
+    # when chains are scraped in parallel
+    parallel = int(arguments["--parallel"])
     logger.add(
         Path.joinpath(output_parent_directory, "skrapa.error.log"),
         rotation="4h",
         retention="6 week",
         level="ERROR",
+        enqueue=parallel > 1,
+    )
+    logger.add(
+        Path.joinpath(output_directory, Path("error.log")),
+        level="WARNING",
+        enqueue=parallel > 1,
     )
-    logger.add(Path.joinpath(output_directory, Path("error.log")), level="WARNING")
     logger.add(
         Path.joinpath(output_parent_directory, "skrapa.info.log"),
         rotation="1 week",
         retention="6 week",
         level="INFO",
+        enqueue=parallel > 1,
     )
 
     #################################
     ### Now we start the scraping ###
     #################################
     # case-then-switch for which module to run
-    all_modules = {
-        "apoteksgruppen": ApoteksgruppenSpider,
-        "apoteket": ApoteketSpider,
-        "lloyds": LloydsSpider,
-        "kronans": KronansApotekSpider,
-        "hjartat": HjartatSpider,
-        "soaf": SOAFSpider,
-    }
+    all_modules = CHAINS
     # select chain to scrape or ALLA for all
     if arguments["APOTEK"] == "ALLA":
         pharmacies = all_modules.keys()
@@ -1196,25 +2487,89 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    output_format = arguments["--format"]
+    if output_format not in available_formats():
+        logger.critical(
+            f'Can not write "{output_format}" files. Choose one of: {", ".join(available_formats())}'
+        )
+        sys.exit(1)
+
+    if arguments["--diff"] and arguments["--replay"]:
+        # a replayed day is not compared with the history
+        logger.critical('"--diff" can not be used with "--replay"')
+        sys.exit(1)
+    if arguments["--resume"] and (arguments["--replay"] or arguments["--offline"]):
+        # offline runs do not save checkpoints
+        logger.critical('"--resume" can not be used with "--replay" or "--offline"')
+        sys.exit(1)
+
     # scrape one or all chains
-    for current_pharmacy in pharmacies:
-        curr_module = all_modules[current_pharmacy](
-            cache_parent_directory=arguments["--cache"],
-            config_path=arguments["--config"],
-            geckodriver_log_directory=output_parent_directory,
-            headless=arguments["--headless"],
-            quit_when_finished=not arguments["--keep-open"],  # False -> True
-            ignore_errors_when_parsing_info_page=arguments["--suppress-errors"],
-            export_cache_to_directory=arguments["--export-cache"],
+    spider_options = dict(
+        cache_parent_directory=arguments["--cache"],
+        config_path=arguments["--config"],
+        geckodriver_log_directory=output_parent_directory,
+        headless=arguments["--headless"],
+        quit_when_finished=not arguments["--keep-open"],  # False -> True
+        ignore_errors_when_parsing_info_page=arguments["--suppress-errors"],
+        export_cache_to_directory=arguments["--export-cache"],
+        fetch_workers=int(arguments["--fetch-workers"]),
+        rate_limit=float(arguments["--rate-limit"]) if arguments["--rate-limit"] else None,
+        revalidate=arguments["--revalidate"],
+        cache_date=arguments["--replay"],
+        # a replayed day is never mixed with pages fetched today
+        offline=arguments["--offline"] or bool(arguments["--replay"]),
+        # a replayed day is not added to the history again
+        history_path=None
+        if arguments["--replay"]
+        else str(Path.joinpath(Path(arguments["--cache"]), "history.sqlite")),
+        only_changes=arguments["--diff"],
+        browser_pool=arguments["--browser-pool"],
+        browser_pool_size=int(arguments["--browser-pool-size"]),
+        resume=arguments["--resume"],
+    )
+    if parallel > 1 and len(pharmacies) > 1:
+        # each chain gets its own process, Firefox instance
+        # and geckodriver log. The geo cache is shared
+        with ProcessPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(
+                    scrape_chain,
+                    current_pharmacy,
+                    all_modules[current_pharmacy],
+                    dict(
+                        spider_options,
+                        geckodriver_log_name=f"geckodriver.{current_pharmacy}.log",
+                    ),
+                    output_directory,
+                    output_format,
+                )
+                for current_pharmacy in pharmacies
+            ]
+            results = [future.result() for future in futures]
+        merge_output_files(
+            [result["path"] for result in results],
+            str(
+                Path.joinpath(
+                    output_directory,
+                    f"{arguments['APOTEK']}_{datetime.now().isoformat().replace(':', '_')}.{output_format}",
+                )
+            ),
+            output_format,
         )
-        path_to_xlsx_file = str(
-            Path.joinpath(
+    else:
+        results = [
+            scrape_chain(
+                current_pharmacy,
+                all_modules[current_pharmacy],
+                spider_options,
                 output_directory,
-                f"{current_pharmacy}_{datetime.now().isoformat().replace(':', '_')}.xlsx",
+                output_format,
             )
-        )
-
-        curr_module.write_xlsx(path_to_xlsx_file)
+            for current_pharmacy in pharmacies
+        ]
+    log_crawl_statistics(results)
+    if arguments["--metrics"]:
+        write_metrics([result["metrics"] for result in results], arguments["--metrics"])
     logger.info(f"Finished scraping: {', '.join(pharmacies)}")
 
     ###############################################
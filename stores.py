@@ -0,0 +1,187 @@
+"""The stores found by the spiders. Each store is kept as one record
+with a list of opening hours, and is only flattened to one row per
+weekday when the output is written."""
+from collections import namedtuple
+from datetime import datetime
+
+# one entry per row of opening hours on the store page,
+# e.g. OpeningHours(1, "Måndag", "09:00-18:00")
+OpeningHours = namedtuple("OpeningHours", ["weekday_no", "weekday", "hours"])
+# the opening hours of one weekday in minutes after midnight, added by
+# hours.normalize_stores. 'entry' is the index of the OpeningHours it
+# was parsed from, e.g. "Måndag-Fredag" gives five NormalizedHours
+NormalizedHours = namedtuple(
+    "NormalizedHours",
+    ["entry", "day_no", "open_minutes", "close_minutes", "closed", "open_24h", "deviating"],
+)
+
+
+class Store(object):
+    """A store and its opening hours.
+
+        >>> store = Store("ApoteketSpider", url, "Apoteket Ekorren", city="Göteborg")
+        >>> store.add_hours(1, "Måndag", "09:00-18:00")
+        >>> list(store.rows())
+        [{"chain": "ApoteketSpider", ..., "weekday": "Måndag", "hours": "09:00-18:00", ...}]
+
+    geo_query is the address sent to MapQuest. The mq_* fields are
+    filled in by MySpider.add_geo_info. geo_source tells where they came
+    from ("page", "cache" or "net") and geo_check lists the cross-checks
+    that failed, e.g. "zip,distance".
+    """
+
+    __slots__ = (
+        "chain",
+        "url",
+        "store_name",
+        "long",
+        "lat",
+        "address",
+        "zip_code",
+        "city",
+        "scraped_at",
+        "opening_hours",
+        "normalized_hours",
+        "geo_query",
+        "mq_street",
+        "mq_zip_code",
+        "mq_lat",
+        "mq_long",
+        "geo_source",
+        "geo_check",
+        "parsing_failed",
+    )
+
+    def __init__(
+        self,
+        chain,
+        url,
+        store_name,
+        long="",
+        lat="",
+        address="",
+        zip_code="",
+        city="",
+        geo_query=None,
+    ):
+        self.chain = chain
+        self.url = url
+        self.store_name = store_name
+        self.long = long
+        self.lat = lat
+        self.address = address
+        self.zip_code = zip_code
+        self.city = city
+        self.scraped_at = datetime.now().isoformat()
+        self.opening_hours = []
+        self.normalized_hours = None
+        self.geo_query = geo_query
+        self.mq_street = None
+        self.mq_zip_code = None
+        self.mq_lat = None
+        self.mq_long = None
+        self.geo_source = None
+        self.geo_check = None
+        self.parsing_failed = False
+
+    @classmethod
+    def failed(cls, chain, url, message):
+        """A dummy store for a page we could not parse,
+        with the error message in every field"""
+        store = cls(chain, url, message, message, message, message, message, message)
+        store.add_hours(message, message, message)
+        store.normalized_hours = [NormalizedHours(0, *[message] * 6)]
+        store.mq_street = store.mq_zip_code = store.mq_lat = store.mq_long = message
+        store.geo_source = store.geo_check = message
+        store.parsing_failed = True
+        return store
+
+    def add_hours(self, weekday_no, weekday, hours):
+        self.opening_hours.append(OpeningHours(weekday_no, weekday, hours))
+
+    def as_dict(self):
+        """All the fields of the store as plain data, see from_dict"""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, fields):
+        """The store saved with as_dict, e.g. in a checkpoint"""
+        store = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(store, field, fields[field])
+        store.opening_hours = [OpeningHours(*entry) for entry in store.opening_hours]
+        if store.normalized_hours is not None:
+            store.normalized_hours = [NormalizedHours(*hours) for hours in store.normalized_hours]
+        return store
+
+    def rows(self):
+        """Yields one row (dict) per row of opening hours, or one row
+        per weekday if the hours have been normalized,
+        with the columns in output.ROW_FIELDS"""
+        if self.normalized_hours is None:
+            normalized_hours = [
+                NormalizedHours(entry, *[None] * 6)
+                for entry in range(len(self.opening_hours))
+            ]
+        else:
+            normalized_hours = self.normalized_hours
+        for normalized in normalized_hours:
+            weekday_no, weekday, hours = self.opening_hours[normalized.entry]
+            yield {
+                "chain": self.chain,
+                "url": self.url,
+                "store_name": self.store_name,
+                "long": self.long,
+                "lat": self.lat,
+                "address": self.address,
+                "zip_code": self.zip_code,
+                "city": self.city,
+                "datetime": self.scraped_at,
+                "weekday": weekday,
+                "weekday_no": weekday_no,
+                "hours": hours,
+                "mq_street": self.mq_street,
+                "mq_zip_code": self.mq_zip_code,
+                "mq_lat": self.mq_lat,
+                "mq_long": self.mq_long,
+                "geo_source": self.geo_source,
+                "geo_check": self.geo_check,
+                "day_no": normalized.day_no,
+                "open_minutes": normalized.open_minutes,
+                "close_minutes": normalized.close_minutes,
+                "closed": normalized.closed,
+                "open_24h": normalized.open_24h,
+                "deviating": normalized.deviating,
+            }
+
+
+def iter_rows(stores):
+    """Flattens the stores to rows"""
+    for store in stores:
+        yield from store.rows()
+
+
+def test_store_rows():
+    import json
+
+    from output import ROW_FIELDS
+
+    store = Store(
+        "ApoteketSpider",
+        "https://www.apoteket.se/apotek/apoteket-ekorren-goteborg/",
+        "Apoteket Ekorren, Göteborg",
+        city="Göteborg",
+        geo_query="Apoteket Ekorren, Göteborg, Sweden",
+    )
+    store.add_hours(1, "Måndag", "09:00-18:00")
+    store.add_hours(2, "Tisdag", "09:00-18:00")
+    rows = list(iter_rows([store, Store("ApoteketSpider", "", "ICA NÄRA")]))
+    assert len(rows) == 2
+    assert tuple(rows[0]) == ROW_FIELDS
+    assert rows[1]["weekday"] == "Tisdag"
+    assert rows[0]["datetime"] == rows[1]["datetime"]
+    assert list(Store.from_dict(json.loads(json.dumps(store.as_dict()))).rows()) == rows
+    failed = list(Store.failed("LloydsSpider", "u", "COULD NOT PARSE PAGE").rows())
+    assert len(failed) == 1
+    assert failed[0]["url"] == "u"
+    assert failed[0]["mq_long"] == failed[0]["weekday_no"] == "COULD NOT PARSE PAGE"